@@ -26,6 +26,8 @@ class Settings(BaseSettings):
     # MCP服务配置
     mcp_database_url: Optional[str] = os.getenv("MCP_DATABASE_URL")
     mcp_api_key: Optional[str] = os.getenv("MCP_API_KEY")
+    mcp_pool_size: int = 32  # MCP服务HTTP连接池大小
+    mcp_cache_ttl: int = 300  # 班级表现/知识薄弱点缓存有效期（秒）
     
     # Context7配置
     context7_api_key: Optional[str] = os.getenv("CONTEXT7_API_KEY")
@@ -45,9 +47,56 @@ class Settings(BaseSettings):
     chunk_size: int = 512
     chunk_overlap: int = 50
     similarity_top_k: int = 5
+    max_concurrent_queries: int = 8  # 同时进行的问答链查询上限
+    
+    # FAISS HNSW索引配置
+    faiss_hnsw_m: int = 32  # 每个节点的邻居数
+    faiss_hnsw_ef_construction: int = 200
+    faiss_hnsw_ef_search: int = 64  # 越大召回率越高、查询越慢
+    faiss_hnsw_min_size: int = 1000  # 向量数低于该值时保留精确的Flat索引
+    
+    # 语义缓存配置
+    semantic_cache_threshold: float = 0.92  # 命中所需的最小余弦相似度
+    semantic_cache_size: int = 1024
+    semantic_cache_ttl: int = 600  # 秒
+    query_embedding_cache_size: int = 1024  # 内存中缓存的查询向量数量
+    reference_cache_ttl: int = 300  # 教案参考材料缓存有效期（秒）
+    lesson_cache_threshold: float = 0.95  # 教案缓存命中阈值（比检索缓存更严格）
+    lesson_cache_size: int = 256
+    lesson_cache_ttl: int = 3600  # 秒
+    
+    # 嵌入缓存配置
+    embedding_cache_dtype: str = "float16"  # 磁盘缓存中向量的存储精度
+    
+    # 记忆存储配置
+    memory_flush_interval: float = 1.0  # 用户偏好/教学模式两次写盘的最小间隔（秒）
+    
+    # 生成结果缓存配置
+    completion_cache_size: int = 10000  # 磁盘中保留的生成结果条数
+    completion_semantic_threshold: float = 0.95  # 提示词语义命中阈值
     
     # 教案生成配置
+    verbose_chains: bool = False  # 将链条/Agent的中间过程和流式token输出到控制台（调试用）
+    max_workers: int = 8  # 运行同步链条/Agent的共享线程池大小
+    prompt_cache_key: str = ""  # 非空时随请求发送给OpenAI以提升提示词前缀缓存命中（兼容接口可能不支持）
+    llm_max_concurrency: int = 4  # 同时进行的教案生成LLM调用上限
+    llm_max_connections: int = 64  # LLM客户端连接池大小
+    llm_max_keepalive_connections: int = 32
+    llm_connect_timeout: float = 5.0  # 秒
+    llm_read_timeout: float = 60.0  # 秒，超时即重试，避免请求长时间挂起
+    llm_max_retries: int = 3
+    agent_max_iters: int = 3  # Agent最多推理轮数
+    agent_skip_context_score: int = 3  # 已获取的上下文项数达到该值时跳过Agent分析
+    use_multistage_chain: bool = False  # True时使用结构→内容→优化三段式链条（多3倍往返）
     max_lesson_plans: int = 3  # 每次最多参考的优秀教案数量
+    lesson_max_tokens: int = 2048  # 单份教案的最大输出token数
+    use_structured_output: bool = False  # 要求模型按JSON Schema输出教案（需模型支持response_format=json_schema）
+    max_concurrent_generations: int = 8  # 同时进行的教案LLM调用上限，避免批量生成触发限流
+    pipeline_width: int = 8  # 批量生成流水线每个阶段的worker数量
+    pipeline_queue_size: int = 32  # 流水线阶段之间的队列长度
+    use_batch_api: bool = False  # 批量生成时使用OpenAI Batch API（异步作业，适合离线批量，最长24小时）
+    batch_api_min_requests: int = 10  # 批量请求数达到该值才提交Batch作业
+    batch_api_poll_interval: float = 10.0  # Batch作业状态轮询间隔（秒）
     student_analysis_weight: float = 0.4  # 学情分析权重
     knowledge_base_weight: float = 0.6  # 知识库权重
     
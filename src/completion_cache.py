@@ -0,0 +1,98 @@
+"""
+LLM生成结果缓存模块
+以 (模型, 提示词) 的SHA-256为键持久化生成文本，完全相同的提示词无需再次调用模型
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+
+class CompletionCache:
+    """基于SQLite的生成结果精确缓存（按最近使用时间淘汰）"""
+    
+    def __init__(self, db_path: Union[str, Path], max_entries: int = 10000):
+        """
+        初始化生成结果缓存
+        
+        Args:
+            db_path: SQLite数据库文件路径
+            max_entries: 最多保留的条目数，超出时淘汰最久未使用的条目
+        """
+        self.db_path = Path(db_path)
+        self.max_entries = max_entries
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions "
+            "(key TEXT PRIMARY KEY, text TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_completions_last_used ON completions (last_used)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        """生成缓存键"""
+        return hashlib.sha256(f"{model}\n{prompt}".encode('utf-8')).hexdigest()
+    
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        """
+        读取缓存
+        
+        Args:
+            model: 模型名称
+            prompt: 提示词
+            
+        Returns:
+            缓存的生成文本，未命中返回None
+        """
+        key = self.make_key(model, prompt)
+        
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            
+            self._conn.execute(
+                "UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+        
+        return row[0]
+    
+    def put(self, model: str, prompt: str, text: str):
+        """
+        写入缓存
+        
+        Args:
+            model: 模型名称
+            prompt: 提示词
+            text: 生成文本
+        """
+        key = self.make_key(model, prompt)
+        
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, text, last_used) VALUES (?, ?, ?)",
+                (key, text, time.time())
+            )
+            # 超出容量时淘汰最久未使用的条目
+            self._conn.execute(
+                "DELETE FROM completions WHERE key IN ("
+                "SELECT key FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
@@ -0,0 +1,66 @@
+"""
+教案文档文本提取模块
+只依赖文档解析库，导入时不创建任何客户端或全局实例，
+可在进程池的工作进程中安全导入（spawn方式启动时工作进程会重新导入本模块）
+"""
+import logging
+from pathlib import Path
+from typing import Tuple
+from docx import Document
+
+try:
+    # PDFium后端解析速度远高于PyPDF2，且解析时释放GIL
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+    import PyPDF2
+
+logger = logging.getLogger(__name__)
+
+# PDF解析是否会释放GIL（决定批量提取时能否只用线程池）
+PDF_RELEASES_GIL = pdfium is not None
+
+
+def extract_content(path: str) -> Tuple[str, str]:
+    """
+    从文件中提取文本内容（模块级函数，可被进程池序列化调用）
+    
+    Args:
+        path: 文件路径
+    
+    Returns:
+        (文件路径, 提取的文本内容)
+    """
+    file_path = Path(path)
+    content = ""
+    
+    try:
+        if file_path.suffix.lower() == '.docx':
+            # 处理Word文档
+            doc = Document(file_path)
+            content = '\n'.join(paragraph.text for paragraph in doc.paragraphs)
+        
+        elif file_path.suffix.lower() == '.pdf':
+            # 处理PDF文档
+            if pdfium is not None:
+                pdf = pdfium.PdfDocument(str(file_path))
+                try:
+                    content = '\n'.join(page.get_textpage().get_text_range() for page in pdf)
+                finally:
+                    pdf.close()
+            else:
+                with open(file_path, 'rb') as file:
+                    pdf_reader = PyPDF2.PdfReader(file)
+                    # extract_text() 可能返回None，直接跳过
+                    texts = (page.extract_text() for page in pdf_reader.pages)
+                    content = '\n'.join(text for text in texts if text)
+        
+        elif file_path.suffix.lower() == '.txt':
+            # 处理文本文件
+            with open(file_path, 'r', encoding='utf-8') as file:
+                content = file.read()
+    
+    except Exception as e:
+        logger.error(f"提取文件内容失败 {file_path}: {e}")
+    
+    return path, content.strip()
@@ -0,0 +1,132 @@
+"""
+嵌入向量磁盘缓存模块
+以 (模型, 文本哈希) 为键持久化嵌入向量，相同文本无需再次调用嵌入接口
+"""
+import hashlib
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """基于SQLite的嵌入向量缓存"""
+    
+    def __init__(self, db_path: Union[str, Path], dtype: str = "float16"):
+        """
+        初始化嵌入缓存
+        
+        Args:
+            db_path: SQLite数据库文件路径
+            dtype: 向量的存储精度，默认float16（体积为float32的一半，检索召回基本无损）
+        """
+        self.db_path = Path(db_path)
+        self.dtype = np.dtype(dtype)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(model: str, text: str) -> bytes:
+        """生成缓存键"""
+        return hashlib.blake2b(f"{model}:{text}".encode('utf-8'), digest_size=16).digest()
+    
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """
+        批量读取缓存
+        
+        Args:
+            model: 嵌入模型名称
+            texts: 文本列表
+            
+        Returns:
+            与texts一一对应的向量列表，未命中的位置为None
+        """
+        # 键中包含存储精度，修改精度配置后不会误读旧格式的数据
+        namespace = f"{model}/{self.dtype.name}"
+        keys = [self.make_key(namespace, text) for text in texts]
+        found = {}
+        
+        with self._lock:
+            # 分批查询，避免超出SQLite的参数数量上限
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                )
+                found.update(rows)
+        
+        results = []
+        for key in keys:
+            blob = found.get(key)
+            if blob is None:
+                results.append(None)
+            else:
+                results.append(np.frombuffer(blob, dtype=self.dtype).astype(np.float32).tolist())
+        return results
+    
+    def put_many(self, model: str, texts: Sequence[str],
+                 embeddings: Sequence[Sequence[float]]) -> List[List[float]]:
+        """
+        批量写入缓存
+        
+        Args:
+            model: 嵌入模型名称
+            texts: 文本列表
+            embeddings: 与texts一一对应的向量列表
+            
+        Returns:
+            按存储精度舍入后的向量列表，与之后命中缓存时读到的值完全一致
+        """
+        namespace = f"{model}/{self.dtype.name}"
+        stored = [np.asarray(embedding, dtype=self.dtype) for embedding in embeddings]
+        rows = [
+            (self.make_key(namespace, text), vector.tobytes())
+            for text, vector in zip(texts, stored)
+        ]
+        
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows
+            )
+            self._conn.commit()
+        
+        return [vector.astype(np.float32).tolist() for vector in stored]
+    
+    def get_or_compute(self, model: str, texts: Sequence[str],
+                       embed_fn: Callable[[List[str]], List[List[float]]]) -> List[List[float]]:
+        """
+        读取缓存，仅对未命中的文本调用嵌入函数并回写缓存
+        
+        Args:
+            model: 嵌入模型名称
+            texts: 文本列表
+            embed_fn: 批量计算嵌入的函数
+            
+        Returns:
+            与texts一一对应的向量列表
+        """
+        results = self.get_many(model, texts)
+        missing = [i for i, vector in enumerate(results) if vector is None]
+        
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            # 返回与缓存命中时相同精度的向量，同一文本无论是否命中结果都一致
+            computed = self.put_many(model, missing_texts, embed_fn(missing_texts))
+            for i, vector in zip(missing, computed):
+                results[i] = vector
+        
+        logger.debug(f"嵌入缓存命中 {len(texts) - len(missing)}/{len(texts)}")
+        return results
@@ -21,7 +21,7 @@ from src.langchain_document_processor import langchain_processor
 from src.memory_manager import memory_manager
 from src.student_data import student_data_manager
 from src.lesson_generator import lesson_generator, LessonPlanRequest
-from src.langchain_lesson_generator import langchain_lesson_generator, EnhancedLessonPlanRequest
+from src.langchain_lesson_generator import get_generator, EnhancedLessonPlanRequest
 from src.hybrid_rag_system import hybrid_rag, HybridQuery
 
 # 配置日志
@@ -242,7 +242,7 @@ class EnhancedRAGEducationApp:
                         )
                         
                         response = asyncio.run(
-                            langchain_lesson_generator.generate_enhanced_lesson_plan(request)
+                            get_generator().generate_enhanced_lesson_plan(request)
                         )
                     else:
                         # 使用基础模式
@@ -3,12 +3,16 @@
 负责教案文档的加载、处理、向量化和检索
 """
 import os
+import re
+import hashlib
 import logging
-from typing import List, Dict, Any, Optional
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 from pathlib import Path
-import pandas as pd
-from docx import Document
-import PyPDF2
 
 from llama_index.core import (
     Document as LlamaDocument,
@@ -17,20 +21,144 @@ from llama_index.core import (
     Settings
 )
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import QueryBundle, BaseNode, TextNode, MetadataMode, NodeRelationship
+from llama_index.core.vector_stores import MetadataFilters, ExactMatchFilter
 from llama_index.vector_stores.chroma import ChromaVectorStore
+from llama_index.core.bridge.pydantic import PrivateAttr
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llms.openai import OpenAI
 import chromadb
 
 from config import settings
+from src.document_extraction import PDF_RELEASES_GIL, extract_content
+from src.embedding_cache import EmbeddingCache
+from src.semantic_cache import SemanticCache
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 文件名中的学科、年级关键词（按匹配优先级排列）
+_SUBJECTS = ['语文', '数学', '英语', '物理', '化学', '生物', '历史', '地理', '政治']
+_GRADES = ['一年级', '二年级', '三年级', '四年级', '五年级', '六年级',
+           '七年级', '八年级', '九年级', '高一', '高二', '高三']
+
+# 预编译的关键词匹配模式，前瞻断言使一次扫描即可找出包括重叠在内的全部关键词
+_SUBJECT_PATTERN = re.compile('(?=(%s))' % '|'.join(map(re.escape, _SUBJECTS)))
+_GRADE_PATTERN = re.compile('(?=(%s))' % '|'.join(map(re.escape, _GRADES)))
+_SUBJECT_RANK = {subject: i for i, subject in enumerate(_SUBJECTS)}
+_GRADE_RANK = {grade: i for i, grade in enumerate(_GRADES)}
+
+
+def _match_keyword(pattern: re.Pattern, rank: Dict[str, int], text: str, default: str) -> str:
+    """返回文本中优先级最高的关键词，未命中时返回默认值"""
+    hits = {match.group(1) for match in pattern.finditer(text)}
+    return min(hits, key=rank.__getitem__) if hits else default
+
+
+@lru_cache(maxsize=4096)
+def _classify_filename(filename: str) -> Tuple[str, str]:
+    """从文件名提取 (学科, 年级)，结果按文件名缓存"""
+    return (
+        _match_keyword(_SUBJECT_PATTERN, _SUBJECT_RANK, filename, "未知学科"),
+        _match_keyword(_GRADE_PATTERN, _GRADE_RANK, filename, "未知年级"),
+    )
+
+
+class CachedOpenAIEmbedding(OpenAIEmbedding):
+    """带磁盘缓存的OpenAI嵌入模型，已计算过的文本直接读取缓存"""
+    
+    _cache: EmbeddingCache = PrivateAttr()
+    
+    def __init__(self, cache: EmbeddingCache, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._cache = cache
+    
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+    
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._cache.get_or_compute(
+            self.model_name, texts, super()._get_text_embeddings
+        )
+    
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+    
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        results = self._cache.get_many(self.model_name, texts)
+        missing = [i for i, vector in enumerate(results) if vector is None]
+        
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            computed = self._cache.put_many(
+                self.model_name, missing_texts, await super()._aget_text_embeddings(missing_texts)
+            )
+            for i, vector in zip(missing, computed):
+                results[i] = vector
+        
+        return results
+
+
+def _content_id(text: str) -> str:
+    """以内容的哈希作为ID"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _document_id(file_path: str) -> str:
+    """以文件路径的哈希作为文档ID，同一文件重复导入时ID不变"""
+    return _content_id(file_path)
+
+
+def _chunk_id(doc_id: str, text: str) -> str:
+    """片段ID：来源文档ID与片段内容共同决定，不同文件中的相同片段各自保留"""
+    return _content_id(f"{doc_id}\x00{text}")
+
+
+# 流水线阶段间传递的结束标记
+_PIPELINE_END = object()
+
+
+def _run_pipeline_stage(stage, inbox: Optional[queue.Queue], outbox: Optional[queue.Queue],
+                        errors: List[Exception]):
+    """
+    运行流水线的一个阶段
+    
+    stage接收上游数据的迭代器和向下游投递数据的函数。阶段出错时记录异常并
+    继续排空上游队列，保证上游不会阻塞；无论成功与否都向下游发送结束标记。
+    """
+    inbox_done = inbox is None
+    
+    def receive():
+        nonlocal inbox_done
+        yield from iter(inbox.get, _PIPELINE_END)
+        inbox_done = True
+    
+    try:
+        stage(receive() if inbox is not None else None, outbox.put if outbox is not None else None)
+    except Exception as e:
+        errors.append(e)
+        if not inbox_done:
+            for _ in iter(inbox.get, _PIPELINE_END):
+                pass
+    finally:
+        if outbox is not None:
+            outbox.put(_PIPELINE_END)
+
+
 class LessonPlanKnowledgeBase:
     """教案知识库管理类"""
     
+    # 文件数超过该阈值时才启用多进程提取，避免小批量时的进程启动开销
+    parallel_extract_threshold = 4
+    
+    # 流水线构建索引时各阶段间的队列容量，以及每批嵌入的片段数
+    pipeline_queue_size = 4
+    embed_batch_size = 100
+    
+    # 支持加载的文档扩展名
+    supported_extensions = ('.docx', '.pdf', '.txt')
+    
     def __init__(self):
         """初始化知识库"""
         self.knowledge_base_dir = Path(settings.knowledge_base_dir)
@@ -40,8 +168,16 @@ class LessonPlanKnowledgeBase:
         self.knowledge_base_dir.mkdir(parents=True, exist_ok=True)
         self.chroma_persist_dir.mkdir(parents=True, exist_ok=True)
         
+        # 知识库目录扫描结果缓存，按目录修改时间失效
+        self._file_index: Dict[str, List[Path]] = {}
+        self._file_index_mtime: int = 0
+        
         # 配置LlamaIndex
-        Settings.embed_model = OpenAIEmbedding(
+        Settings.embed_model = CachedOpenAIEmbedding(
+            cache=EmbeddingCache(
+                self.chroma_persist_dir / "embedding_cache.sqlite3",
+                dtype=settings.embedding_cache_dtype
+            ),
             model=settings.embedding_model,
             api_key=settings.openai_api_key,
             api_base=settings.openai_api_base
@@ -52,6 +188,23 @@ class LessonPlanKnowledgeBase:
             api_base=settings.openai_api_base
         )
         
+        # 检索结果语义缓存
+        self._query_cache = SemanticCache(
+            threshold=settings.semantic_cache_threshold,
+            max_size=settings.semantic_cache_size,
+            ttl_seconds=settings.semantic_cache_ttl
+        )
+        
+        # 文本分割器
+        self.text_splitter = SentenceSplitter(
+            chunk_size=settings.chunk_size,
+            chunk_overlap=settings.chunk_overlap
+        )
+        
+        # 缓存的检索器及其 (top_k, 学科, 年级)
+        self._retriever = None
+        self._retriever_key: Optional[Tuple[int, Optional[str], Optional[str]]] = None
+        
         # 初始化ChromaDB
         self.chroma_client = chromadb.PersistentClient(path=str(self.chroma_persist_dir))
         self.collection_name = "lesson_plans"
@@ -91,40 +244,131 @@ class LessonPlanKnowledgeBase:
         Returns:
             LlamaDocument列表
         """
-        documents = []
+        documents = list(self._iter_documents(file_paths))
         
+        logger.info(f"总共加载了 {len(documents)} 个教案文档")
+        return documents
+    
+    def _iter_documents(self, file_paths: List[str] = None,
+                        executor: Optional[Executor] = None) -> Iterator[LlamaDocument]:
+        """
+        逐个产出加载成功的教案文档
+        
+        Args:
+            file_paths: 指定文件路径列表，如果为None则加载所有支持的文档
+            executor: 调用方预先创建的提取执行器，为None时按需创建
+            
+        Yields:
+            LlamaDocument实例
+        """
         if file_paths is None:
             # 扫描知识库目录下的所有文档
-            file_paths = []
-            for ext in ['*.docx', '*.pdf', '*.txt']:
-                file_paths.extend(self.knowledge_base_dir.glob(ext))
+            file_paths = self._list_supported_files()
+        
+        paths = [str(file_path) for file_path in file_paths]
         
-        for file_path in file_paths:
+        for path, content in self._extract_contents(paths, executor):
             try:
-                file_path = Path(file_path)
-                content = self._extract_content(file_path)
+                file_path = Path(path)
                 
                 if content:
+                    subject, grade = _classify_filename(file_path.name)
+                    
                     # 创建LlamaDocument实例
                     doc = LlamaDocument(
+                        id_=_document_id(str(file_path)),
                         text=content,
                         metadata={
                             "file_name": file_path.name,
                             "file_path": str(file_path),
                             "file_type": file_path.suffix,
-                            "subject": self._extract_subject(file_path.name),
-                            "grade": self._extract_grade(file_path.name),
+                            "subject": subject,
+                            "grade": grade,
                         }
                     )
-                    documents.append(doc)
                     logger.info(f"成功加载文档: {file_path.name}")
+                    yield doc
                     
             except Exception as e:
-                logger.error(f"加载文档失败 {file_path}: {e}")
+                logger.error(f"加载文档失败 {path}: {e}")
                 continue
+    
+    def _scan_files(self) -> Dict[str, List[Path]]:
+        """
+        扫描知识库目录并按扩展名分组
         
-        logger.info(f"总共加载了 {len(documents)} 个教案文档")
-        return documents
+        目录修改时间未变化时直接返回缓存结果，避免重复遍历目录。
+        
+        Returns:
+            扩展名 -> 文件路径列表
+        """
+        mtime = self.knowledge_base_dir.stat().st_mtime_ns
+        if mtime == self._file_index_mtime:
+            return self._file_index
+        
+        file_index: Dict[str, List[Path]] = {ext: [] for ext in self.supported_extensions}
+        with os.scandir(self.knowledge_base_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    file_index.setdefault(Path(entry.name).suffix.lower(), []).append(Path(entry.path))
+        
+        self._file_index = file_index
+        self._file_index_mtime = mtime
+        return file_index
+    
+    def _list_supported_files(self) -> List[Path]:
+        """列出知识库目录下所有支持的文档"""
+        file_index = self._scan_files()
+        return [path for ext in self.supported_extensions for path in file_index[ext]]
+    
+    def _create_extract_executor(self, paths: List[str]) -> Optional[Executor]:
+        """
+        为一批文件创建并行提取的执行器，文件数不超过阈值时返回None（串行提取）
+        
+        PDFium解析PDF时释放GIL，批次中没有Word文档时使用线程池即可，
+        避免进程池的启动和序列化开销；否则使用进程池。进程池固定以spawn方式
+        启动工作进程：调用方可能是已有其他线程在运行的进程（Web服务、索引流水线），
+        在多线程进程中fork可能复制到被其他线程持有的锁而死锁。
+        
+        Args:
+            paths: 文件路径列表
+            
+        Returns:
+            执行器实例或None
+        """
+        if len(paths) <= self.parallel_extract_threshold:
+            return None
+        
+        if PDF_RELEASES_GIL and not any(path.lower().endswith('.docx') for path in paths):
+            return ThreadPoolExecutor(max_workers=os.cpu_count())
+        return ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    
+    def _extract_contents(self, paths: List[str],
+                          executor: Optional[Executor] = None) -> Iterator[Tuple[str, str]]:
+        """
+        批量提取文件内容，文件较多时并行解析
+        
+        Args:
+            paths: 文件路径列表
+            executor: 调用方预先创建的执行器（由调用方负责关闭），为None时按需创建
+            
+        Yields:
+            按输入顺序产出的 (文件路径, 文本内容)
+        """
+        if executor is not None:
+            yield from executor.map(extract_content, paths, chunksize=4)
+            return
+        
+        executor = self._create_extract_executor(paths)
+        if executor is None:
+            yield from map(extract_content, paths)
+            return
+        
+        with executor:
+            yield from executor.map(extract_content, paths, chunksize=4)
     
     def _extract_content(self, file_path: Path) -> str:
         """
@@ -136,84 +380,189 @@ class LessonPlanKnowledgeBase:
         Returns:
             提取的文本内容
         """
-        content = ""
-        
-        try:
-            if file_path.suffix.lower() == '.docx':
-                # 处理Word文档
-                doc = Document(file_path)
-                content = '\n'.join([paragraph.text for paragraph in doc.paragraphs])
-                
-            elif file_path.suffix.lower() == '.pdf':
-                # 处理PDF文档
-                with open(file_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    content = '\n'.join([page.extract_text() for page in pdf_reader.pages])
-                    
-            elif file_path.suffix.lower() == '.txt':
-                # 处理文本文件
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    content = file.read()
-                    
-        except Exception as e:
-            logger.error(f"提取文件内容失败 {file_path}: {e}")
-            
-        return content.strip()
+        return extract_content(str(file_path))[1]
     
     def _extract_subject(self, filename: str) -> str:
         """从文件名提取学科信息"""
-        subjects = ['语文', '数学', '英语', '物理', '化学', '生物', '历史', '地理', '政治']
-        for subject in subjects:
-            if subject in filename:
-                return subject
-        return "未知学科"
+        return _classify_filename(filename)[0]
     
     def _extract_grade(self, filename: str) -> str:
         """从文件名提取年级信息"""
-        grades = ['一年级', '二年级', '三年级', '四年级', '五年级', '六年级',
-                 '七年级', '八年级', '九年级', '高一', '高二', '高三']
-        for grade in grades:
-            if grade in filename:
-                return grade
-        return "未知年级"
+        return _classify_filename(filename)[1]
     
     def build_index(self, documents: List[LlamaDocument] = None) -> VectorStoreIndex:
         """
         构建向量索引
         
         Args:
-            documents: 要索引的文档列表，如果为None则加载所有文档
+            documents: 要索引的文档列表，如果为None则以流水线方式加载并索引所有文档
             
         Returns:
             向量索引实例
         """
         if documents is None:
-            documents = self.load_documents()
+            return self._build_index_pipelined()
         
         if not documents:
             raise ValueError("没有找到可用的文档来构建索引")
         
         try:
-            # 创建文本分割器
-            text_splitter = SentenceSplitter(
-                chunk_size=settings.chunk_size,
-                chunk_overlap=settings.chunk_overlap
-            )
+            # 分割文档并跳过向量库中已存在的片段，避免重复计算嵌入
+            nodes = self._filter_new_nodes(self._split_into_nodes(documents))
             
             # 构建索引
-            self.index = VectorStoreIndex.from_documents(
-                documents,
-                storage_context=self.storage_context,
-                transformations=[text_splitter]
-            )
+            if nodes:
+                self.index = VectorStoreIndex(
+                    nodes,
+                    storage_context=self.storage_context
+                )
+            else:
+                self.index = VectorStoreIndex.from_vector_store(
+                    vector_store=self.vector_store,
+                    storage_context=self.storage_context
+                )
+            self._retriever = None
             
-            logger.info(f"成功构建向量索引，包含 {len(documents)} 个文档")
+            self._query_cache.clear()
+            logger.info(f"成功构建向量索引，包含 {len(documents)} 个文档，新增 {len(nodes)} 个片段")
             return self.index
             
         except Exception as e:
             logger.error(f"构建向量索引失败: {e}")
             raise
     
+    def _build_index_pipelined(self) -> VectorStoreIndex:
+        """
+        以流水线方式加载知识库目录中的全部文档并构建向量索引
+        
+        加载、分割、嵌入、写入四个阶段各自在线程中运行，经有界队列衔接，
+        文件解析、嵌入接口的网络等待和向量库写入相互重叠。提取文件内容的
+        执行器在各阶段线程启动前创建，不在流水线线程中创建进程池。
+        
+        Returns:
+            向量索引实例
+        """
+        doc_queue = queue.Queue(maxsize=self.pipeline_queue_size)
+        node_queue = queue.Queue(maxsize=self.pipeline_queue_size)
+        embedded_queue = queue.Queue(maxsize=self.pipeline_queue_size)
+        errors: List[Exception] = []
+        counts = {"documents": 0, "nodes": 0}
+        
+        paths = [str(path) for path in self._list_supported_files()]
+        extract_executor = self._create_extract_executor(paths)
+        
+        def load(_, put):
+            for document in self._iter_documents(paths, executor=extract_executor):
+                put(document)
+        
+        def split(documents, put):
+            seen_ids = set()
+            pending: List[BaseNode] = []
+            for document in documents:
+                counts["documents"] += 1
+                for node in self._filter_new_nodes(self._split_into_nodes([document])):
+                    if node.node_id not in seen_ids:
+                        seen_ids.add(node.node_id)
+                        pending.append(node)
+                while len(pending) >= self.embed_batch_size:
+                    put(pending[:self.embed_batch_size])
+                    pending = pending[self.embed_batch_size:]
+            if pending:
+                put(pending)
+        
+        def embed(batches, put):
+            for nodes in batches:
+                texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+                embeddings = Settings.embed_model.get_text_embedding_batch(texts)
+                for node, embedding in zip(nodes, embeddings):
+                    node.embedding = embedding
+                put(nodes)
+        
+        def insert(batches, _):
+            for nodes in batches:
+                self.vector_store.add(nodes)
+                counts["nodes"] += len(nodes)
+        
+        stages = [
+            (load, None, doc_queue),
+            (split, doc_queue, node_queue),
+            (embed, node_queue, embedded_queue),
+            (insert, embedded_queue, None),
+        ]
+        threads = [
+            threading.Thread(target=_run_pipeline_stage, args=(stage, inbox, outbox, errors), daemon=True)
+            for stage, inbox, outbox in stages
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if extract_executor is not None:
+                extract_executor.shutdown()
+        
+        if errors:
+            logger.error(f"构建向量索引失败: {errors[0]}")
+            raise errors[0]
+        
+        if counts["documents"] == 0:
+            raise ValueError("没有找到可用的文档来构建索引")
+        
+        self.index = VectorStoreIndex.from_vector_store(
+            vector_store=self.vector_store,
+            storage_context=self.storage_context
+        )
+        self._retriever = None
+        
+        self._query_cache.clear()
+        logger.info(f"成功构建向量索引，包含 {counts['documents']} 个文档，新增 {counts['nodes']} 个片段")
+        return self.index
+    
+    def _split_into_nodes(self, documents: List[LlamaDocument]) -> List[BaseNode]:
+        """
+        将文档分割为片段，并以来源文档ID和片段内容的哈希作为节点ID
+        
+        同一文件中相同内容的片段总是得到相同的ID，重复导入时可据此去重；
+        前后片段关系随ID一起更新，仍指向存在的节点。
+        
+        Args:
+            documents: 文档列表
+            
+        Returns:
+            片段节点列表
+        """
+        nodes = self.text_splitter.get_nodes_from_documents(documents)
+        id_map = {node.node_id: _chunk_id(node.ref_doc_id or "", node.get_content()) for node in nodes}
+        for node in nodes:
+            node.id_ = id_map[node.node_id]
+            for relationship in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT):
+                related = node.relationships.get(relationship)
+                if related is not None:
+                    related.node_id = id_map.get(related.node_id, related.node_id)
+        return nodes
+    
+    def _filter_new_nodes(self, nodes: List[BaseNode]) -> List[BaseNode]:
+        """
+        过滤掉向量库中已存在或批次内重复的片段
+        
+        Args:
+            nodes: 片段节点列表
+            
+        Returns:
+            需要计算嵌入并写入的片段节点列表
+        """
+        unique_nodes = list({node.node_id: node for node in nodes}.values())
+        if not unique_nodes:
+            return []
+        
+        existing_ids = set(
+            self.chroma_collection.get(ids=[node.node_id for node in unique_nodes], include=[])['ids']
+        )
+        if existing_ids:
+            logger.info(f"跳过 {len(existing_ids)} 个已索引的片段")
+        return [node for node in unique_nodes if node.node_id not in existing_ids]
+    
     def load_existing_index(self) -> Optional[VectorStoreIndex]:
         """
         加载已存在的向量索引
@@ -226,6 +575,7 @@ class LessonPlanKnowledgeBase:
                 vector_store=self.vector_store,
                 storage_context=self.storage_context
             )
+            self._retriever = None
             logger.info("成功加载已存在的向量索引")
             return self.index
             
@@ -233,13 +583,43 @@ class LessonPlanKnowledgeBase:
             logger.warning(f"加载已存在索引失败: {e}")
             return None
     
-    def search_similar_lessons(self, query: str, top_k: int = None) -> List[Dict[str, Any]]:
+    def ensure_loaded(self):
+        """确保向量索引已加载（可在服务启动时提前调用，避免首个检索请求承担加载耗时）"""
+        if not hasattr(self, 'index'):
+            # 尝试加载已存在的索引
+            if self.load_existing_index() is None:
+                # 如果没有索引，构建新的
+                self.build_index()
+    
+    def _get_retriever(self, top_k: int, subject: Optional[str] = None,
+                       grade: Optional[str] = None):
+        """获取检索器，仅在索引、top_k或过滤条件变化时重新创建"""
+        retriever_key = (top_k, subject, grade)
+        if self._retriever is None or self._retriever_key != retriever_key:
+            # 学科/年级过滤下推到Chroma的where条件，在向量检索前缩小候选集
+            filters = [
+                ExactMatchFilter(key=key, value=value)
+                for key, value in (("subject", subject), ("grade", grade))
+                if value is not None
+            ]
+            self._retriever = self.index.as_retriever(
+                similarity_top_k=top_k,
+                filters=MetadataFilters(filters=filters) if filters else None
+            )
+            self._retriever_key = retriever_key
+        return self._retriever
+    
+    def search_similar_lessons(self, query: str, top_k: int = None,
+                               subject: Optional[str] = None,
+                               grade: Optional[str] = None) -> List[Dict[str, Any]]:
         """
         检索相似教案
         
         Args:
             query: 查询文本
             top_k: 返回的最相似文档数量
+            subject: 只检索该学科的教案
+            grade: 只检索该年级的教案
             
         Returns:
             相似教案列表
@@ -247,25 +627,25 @@ class LessonPlanKnowledgeBase:
         if top_k is None:
             top_k = settings.similarity_top_k
         
-        if not hasattr(self, 'index'):
-            # 尝试加载已存在的索引
-            if self.load_existing_index() is None:
-                # 如果没有索引，构建新的
-                self.build_index()
+        self.ensure_loaded()
         
         try:
-            # 创建查询引擎
-            query_engine = self.index.as_query_engine(
-                similarity_top_k=top_k,
-                response_mode="no_text"  # 只返回节点，不生成回答
-            )
+            # 相似查询直接复用缓存结果，跳过向量检索
+            query_embedding = Settings.embed_model.get_query_embedding(query)
+            scope = (top_k, subject, grade)
+            cached = self._query_cache.lookup(query_embedding, scope=scope)
+            if cached is not None:
+                logger.info(f"语义缓存命中，返回 {len(cached)} 个相似教案")
+                return list(cached)
             
-            # 执行查询
-            response = query_engine.query(query)
+            # 直接检索节点（复用已计算的查询向量），不经过回答合成
+            nodes = self._get_retriever(top_k, subject, grade).retrieve(
+                QueryBundle(query_str=query, embedding=query_embedding)
+            )
             
             # 处理结果
             results = []
-            for node in response.source_nodes:
+            for node in nodes:
                 results.append({
                     "content": node.text,
                     "score": node.score,
@@ -275,6 +655,7 @@ class LessonPlanKnowledgeBase:
                     "grade": node.metadata.get("grade", "未知年级")
                 })
             
+            self._query_cache.insert(query_embedding, results, scope=scope)
             logger.info(f"检索到 {len(results)} 个相似教案")
             return results
             
@@ -282,17 +663,25 @@ class LessonPlanKnowledgeBase:
             logger.error(f"检索相似教案失败: {e}")
             return []
     
-    def add_lesson_plan(self, file_path: str, metadata: Dict[str, Any] = None) -> bool:
+    def add_lesson_plan(self, file_path: str, metadata: Dict[str, Any] = None,
+                        precomputed_embeddings: Optional[List[List[float]]] = None,
+                        chunks: Optional[List[str]] = None) -> bool:
         """
         添加新的教案到知识库
         
         Args:
             file_path: 教案文件路径
             metadata: 额外的元数据
+            precomputed_embeddings: 已计算好的片段向量，与chunks一一对应
+            chunks: 已分割好的片段文本；与precomputed_embeddings同时提供时
+                不再读取文件、分割和计算嵌入
             
         Returns:
             是否添加成功
         """
+        if precomputed_embeddings is not None and chunks is not None:
+            return self._add_precomputed_chunks(file_path, chunks, precomputed_embeddings, metadata)
+        
         try:
             # 加载单个文档
             documents = self.load_documents([file_path])
@@ -308,8 +697,11 @@ class LessonPlanKnowledgeBase:
             if not hasattr(self, 'index'):
                 self.index = self.build_index(documents)
             else:
-                # 将新文档添加到现有索引
-                self.index.insert(documents[0])
+                # 将新片段添加到现有索引，已索引过的内容不再重复嵌入
+                nodes = self._filter_new_nodes(self._split_into_nodes(documents))
+                if nodes:
+                    self.index.insert_nodes(nodes)
+                    self._query_cache.clear()
             
             logger.info(f"成功添加教案: {file_path}")
             return True
@@ -318,6 +710,65 @@ class LessonPlanKnowledgeBase:
             logger.error(f"添加教案失败: {e}")
             return False
     
+    def _add_precomputed_chunks(self, file_path: str, chunks: List[str],
+                                embeddings: List[List[float]],
+                                metadata: Dict[str, Any] = None) -> bool:
+        """
+        直接写入已分割、已嵌入的教案片段
+        
+        Args:
+            file_path: 教案文件路径
+            chunks: 片段文本列表
+            embeddings: 与chunks一一对应的向量列表
+            metadata: 额外的元数据
+            
+        Returns:
+            是否添加成功
+        """
+        if len(chunks) != len(embeddings):
+            logger.error(f"添加教案失败: 片段数({len(chunks)})与向量数({len(embeddings)})不一致")
+            return False
+        
+        try:
+            path = Path(file_path)
+            doc_id = _document_id(str(path))
+            subject, grade = _classify_filename(path.name)
+            node_metadata = {
+                "file_name": path.name,
+                "file_path": str(path),
+                "file_type": path.suffix,
+                "subject": subject,
+                "grade": grade,
+            }
+            if metadata:
+                node_metadata.update(metadata)
+            
+            # 节点已带向量，写入索引时不会再调用嵌入模型
+            nodes = self._filter_new_nodes([
+                TextNode(
+                    id_=_chunk_id(doc_id, chunk),
+                    text=chunk,
+                    embedding=list(embedding),
+                    metadata=dict(node_metadata)
+                )
+                for chunk, embedding in zip(chunks, embeddings)
+            ])
+            
+            if nodes:
+                if hasattr(self, 'index'):
+                    self.index.insert_nodes(nodes)
+                else:
+                    self.index = VectorStoreIndex(nodes, storage_context=self.storage_context)
+                    self._retriever = None
+                self._query_cache.clear()
+            
+            logger.info(f"成功添加教案: {file_path}（预计算向量，新增 {len(nodes)} 个片段）")
+            return True
+            
+        except Exception as e:
+            logger.error(f"添加教案失败: {e}")
+            return False
+    
     def get_knowledge_base_stats(self) -> Dict[str, Any]:
         """
         获取知识库统计信息
@@ -330,17 +781,14 @@ class LessonPlanKnowledgeBase:
             collection_count = self.chroma_collection.count()
             
             # 扫描文件系统中的文档
-            doc_files = []
-            for ext in ['*.docx', '*.pdf', '*.txt']:
-                doc_files.extend(self.knowledge_base_dir.glob(ext))
+            doc_files = self._list_supported_files()
             
             # 按学科分类统计
             subject_stats = {}
             grade_stats = {}
             
             for file_path in doc_files:
-                subject = self._extract_subject(file_path.name)
-                grade = self._extract_grade(file_path.name)
+                subject, grade = _classify_filename(file_path.name)
                 
                 subject_stats[subject] = subject_stats.get(subject, 0) + 1
                 grade_stats[grade] = grade_stats.get(grade, 0) + 1
@@ -2,13 +2,16 @@
 基于LangChain的文档处理模块
 增强文档加载、分割和处理能力
 """
+import re
 import logging
-from typing import List, Dict, Any, Optional, Union
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Union, Tuple
 from pathlib import Path
 import asyncio
 
 # LangChain imports
 from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
 from langchain_community.document_loaders import (
     DirectoryLoader,
     TextLoader,
@@ -29,11 +32,95 @@ from langchain.chains import RetrievalQA
 from langchain_openai import ChatOpenAI
 
 from config import settings
+from src.embedding_cache import EmbeddingCache
+from src.semantic_cache import SemanticCache
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 学科关键词表（按匹配优先级排列）
+_SUBJECT_KEYWORDS = {
+    '语文': ['语文', '中文', '汉语'],
+    '数学': ['数学', '算术'],
+    '英语': ['英语', '英文', 'English'],
+    '物理': ['物理'],
+    '化学': ['化学'],
+    '生物': ['生物'],
+    '历史': ['历史'],
+    '地理': ['地理'],
+    '政治': ['政治', '思想品德'],
+    '音乐': ['音乐'],
+    '美术': ['美术', '绘画'],
+    '体育': ['体育', '运动'],
+}
+
+_GRADES = [
+    '一年级', '二年级', '三年级', '四年级', '五年级', '六年级',
+    '七年级', '八年级', '九年级', '初一', '初二', '初三',
+    '高一', '高二', '高三', '高中'
+]
+
+# 关键词 -> (优先级, 规范名称)；模式使用前瞻断言，一次扫描即可找出包括重叠在内的全部关键词
+_SUBJECT_LOOKUP = {
+    keyword.lower(): (rank, subject)
+    for rank, (subject, keywords) in enumerate(_SUBJECT_KEYWORDS.items())
+    for keyword in keywords
+}
+_GRADE_LOOKUP = {grade: (rank, grade) for rank, grade in enumerate(_GRADES)}
+_SUBJECT_PATTERN = re.compile(
+    '(?=(%s))' % '|'.join(re.escape(keyword) for keyword in _SUBJECT_LOOKUP), re.IGNORECASE
+)
+_GRADE_PATTERN = re.compile('(?=(%s))' % '|'.join(map(re.escape, _GRADES)))
+
+
+def _match_keyword(pattern: re.Pattern, lookup: Dict[str, Tuple[int, str]],
+                   text: str, default: str) -> str:
+    """返回文本中优先级最高的关键词对应的规范名称，未命中时返回默认值"""
+    hits = [lookup[match.group(1).lower()] for match in pattern.finditer(text)]
+    return min(hits)[1] if hits else default
+
+
+@lru_cache(maxsize=4096)
+def _classify_filename(filename: str) -> Tuple[str, str, str]:
+    """从文件名提取 (学科, 年级, 主题)，结果按文件名缓存"""
+    subject = _match_keyword(_SUBJECT_PATTERN, _SUBJECT_LOOKUP, filename, "通用")
+    grade = _match_keyword(_GRADE_PATTERN, _GRADE_LOOKUP, filename, "未知年级")
+    
+    # 移除学科和年级信息后的剩余部分作为主题
+    topic = filename
+    for remove_item in [subject, grade]:
+        if remove_item != "通用" and remove_item != "未知年级":
+            topic = topic.replace(remove_item, "")
+    
+    # 清理多余的符号
+    topic = topic.strip("_-. ")
+    return subject, grade, topic if topic else "未知主题"
+
+
+class CachedEmbeddings(Embeddings):
+    """带缓存的嵌入模型包装：文档嵌入读写磁盘缓存，查询嵌入使用内存LRU缓存"""
+    
+    def __init__(self, underlying: Embeddings, cache: EmbeddingCache, model: str,
+                 query_cache_size: int = 1024):
+        self.underlying = underlying
+        self.cache = cache
+        self.model = model
+        # 缓存元组，避免调用方修改返回的列表污染缓存
+        self._embed_query_cached = lru_cache(maxsize=query_cache_size)(
+            lambda text: tuple(self.underlying.embed_query(text))
+        )
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.cache.get_or_compute(self.model, texts, self.underlying.embed_documents)
+    
+    def embed_query(self, text: str) -> List[float]:
+        embedding = list(self._embed_query_cached(text))
+        info = self._embed_query_cached.cache_info()
+        logger.debug(f"查询嵌入缓存命中率 {info.hits}/{info.hits + info.misses}")
+        return embedding
+
+
 class LangChainDocumentProcessor:
     """基于LangChain的文档处理器"""
     
@@ -43,10 +130,18 @@ class LangChainDocumentProcessor:
         self.chroma_persist_dir = Path(settings.chroma_persist_dir)
         
         # 初始化OpenAI组件
-        self.embeddings = OpenAIEmbeddings(
-            openai_api_key=settings.openai_api_key,
-            openai_api_base=settings.openai_api_base,
-            model=settings.embedding_model
+        self.embeddings = CachedEmbeddings(
+            OpenAIEmbeddings(
+                openai_api_key=settings.openai_api_key,
+                openai_api_base=settings.openai_api_base,
+                model=settings.embedding_model
+            ),
+            cache=EmbeddingCache(
+                self.chroma_persist_dir / "embedding_cache.sqlite3",
+                dtype=settings.embedding_cache_dtype
+            ),
+            model=settings.embedding_model,
+            query_cache_size=settings.query_embedding_cache_size
         )
         
         self.llm = ChatOpenAI(
@@ -67,6 +162,17 @@ class LangChainDocumentProcessor:
         # 向量存储
         self.vectorstore = None
         
+        # 限制并发问答查询数量（信号量绑定事件循环，按循环创建）
+        self._query_semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        # 检索结果语义缓存
+        self._query_cache = SemanticCache(
+            threshold=settings.semantic_cache_threshold,
+            max_size=settings.semantic_cache_size,
+            ttl_seconds=settings.semantic_cache_ttl
+        )
+        
     def load_documents_from_directory(self, directory: Optional[Path] = None) -> List[Document]:
         """
         从目录加载文档
@@ -105,8 +211,7 @@ class LangChainDocumentProcessor:
                     docs = directory_loader.load()
                     
                     # 添加元数据
-                    for doc in docs:
-                        self._enhance_document_metadata(doc)
+                    self._enhance_documents_metadata(docs)
                     
                     documents.extend(docs)
                     logger.info(f"加载了 {len(docs)} 个 {pattern} 格式的文档")
@@ -179,76 +284,56 @@ class LangChainDocumentProcessor:
     
     def _enhance_document_metadata(self, document: Document):
         """增强文档元数据"""
-        if 'source' in document.metadata:
-            file_path = Path(document.metadata['source'])
-            
-            # 基础元数据
-            document.metadata.update({
-                'file_name': file_path.name,
-                'file_extension': file_path.suffix,
-                'file_size': file_path.stat().st_size if file_path.exists() else 0,
-            })
+        self._enhance_documents_metadata([document])
+    
+    def _enhance_documents_metadata(self, documents: List[Document]):
+        """
+        批量增强文档元数据
+        
+        同一源文件的多个片段共享文件信息，每个源文件只stat一次。
+        
+        Args:
+            documents: 文档列表
+        """
+        source_metadata: Dict[str, Dict[str, Any]] = {}
+        
+        for document in documents:
+            source = document.metadata.get('source')
+            if source is None:
+                continue
             
-            # 从文件名推断学科和年级
-            filename = file_path.stem
-            document.metadata.update({
-                'subject': self._extract_subject_from_filename(filename),
-                'grade': self._extract_grade_from_filename(filename),
-                'topic': self._extract_topic_from_filename(filename)
-            })
+            file_metadata = source_metadata.get(source)
+            if file_metadata is None:
+                file_path = Path(source)
+                try:
+                    file_size = file_path.stat().st_size
+                except OSError:
+                    file_size = 0
+                
+                # 从文件名推断学科和年级
+                subject, grade, topic = _classify_filename(file_path.stem)
+                file_metadata = source_metadata[source] = {
+                    'file_name': file_path.name,
+                    'file_extension': file_path.suffix,
+                    'file_size': file_size,
+                    'subject': subject,
+                    'grade': grade,
+                    'topic': topic
+                }
+            
+            document.metadata.update(file_metadata)
     
     def _extract_subject_from_filename(self, filename: str) -> str:
         """从文件名提取学科"""
-        subjects = {
-            '语文': ['语文', '中文', '汉语'],
-            '数学': ['数学', '算术'],
-            '英语': ['英语', '英文', 'English'],
-            '物理': ['物理'],
-            '化学': ['化学'],
-            '生物': ['生物'],
-            '历史': ['历史'],
-            '地理': ['地理'],
-            '政治': ['政治', '思想品德'],
-            '音乐': ['音乐'],
-            '美术': ['美术', '绘画'],
-            '体育': ['体育', '运动'],
-        }
-        
-        filename_lower = filename.lower()
-        for subject, keywords in subjects.items():
-            if any(keyword.lower() in filename_lower for keyword in keywords):
-                return subject
-        
-        return "通用"
+        return _classify_filename(filename)[0]
     
     def _extract_grade_from_filename(self, filename: str) -> str:
         """从文件名提取年级"""
-        grades = [
-            '一年级', '二年级', '三年级', '四年级', '五年级', '六年级',
-            '七年级', '八年级', '九年级', '初一', '初二', '初三',
-            '高一', '高二', '高三', '高中'
-        ]
-        
-        for grade in grades:
-            if grade in filename:
-                return grade
-        
-        return "未知年级"
+        return _classify_filename(filename)[1]
     
     def _extract_topic_from_filename(self, filename: str) -> str:
         """从文件名提取主题"""
-        # 移除学科和年级信息后的剩余部分作为主题
-        subject = self._extract_subject_from_filename(filename)
-        grade = self._extract_grade_from_filename(filename)
-        
-        topic = filename
-        for remove_item in [subject, grade]:
-            if remove_item != "通用" and remove_item != "未知年级":
-                topic = topic.replace(remove_item, "")
-        
-        # 清理多余的符号
-        topic = topic.strip("_-. ")
-        return topic if topic else "未知主题"
+        return _classify_filename(filename)[2]
     
     def split_documents(self, documents: List[Document], 
                        splitter_type: str = "recursive") -> List[Document]:
@@ -285,10 +370,10 @@ class LangChainDocumentProcessor:
             # 执行分割
             split_docs = splitter.split_documents(documents)
             
-            # 为每个片段添加chunk编号
+            # 为每个片段添加chunk编号（总数在循环外只计算一次）
+            chunk_total = len(split_docs)
             for i, doc in enumerate(split_docs):
-                doc.metadata['chunk_id'] = i
-                doc.metadata['chunk_total'] = len(split_docs)
+                doc.metadata.update(chunk_id=i, chunk_total=chunk_total)
             
             logger.info(f"文档分割完成: {len(documents)} -> {len(split_docs)} 个片段")
             return split_docs
@@ -332,6 +417,7 @@ class LangChainDocumentProcessor:
                     documents=documents,
                     embedding=self.embeddings
                 )
+                self._use_hnsw_index(self.vectorstore)
                 
                 # 保存FAISS索引
                 faiss_path = self.chroma_persist_dir / "faiss_index"
@@ -339,12 +425,44 @@ class LangChainDocumentProcessor:
                 self.vectorstore.save_local(str(faiss_path))
                 logger.info(f"FAISS向量存储创建成功，包含 {len(documents)} 个文档")
             
+            self._query_cache.clear()
             return self.vectorstore
             
         except Exception as e:
             logger.error(f"创建向量存储失败: {e}")
             return None
     
+    def _use_hnsw_index(self, vectorstore: FAISS):
+        """
+        将FAISS默认的Flat索引替换为HNSW索引
+        
+        Flat索引每次查询都要与全部向量比较，HNSW的查询复杂度约为对数级。
+        向量数较少时保留Flat索引，结果精确且足够快。
+        
+        Args:
+            vectorstore: FAISS向量存储
+        """
+        import faiss
+        
+        flat_index = vectorstore.index
+        if flat_index.ntotal < settings.faiss_hnsw_min_size:
+            return
+        
+        hnsw_index = faiss.IndexHNSWFlat(flat_index.d, settings.faiss_hnsw_m)
+        hnsw_index.hnsw.efConstruction = settings.faiss_hnsw_ef_construction
+        hnsw_index.hnsw.efSearch = settings.faiss_hnsw_ef_search
+        # 按原顺序添加，保持与index_to_docstore_id的位置对应关系
+        hnsw_index.add(flat_index.reconstruct_n(0, flat_index.ntotal))
+        vectorstore.index = hnsw_index
+        logger.info(f"FAISS索引已切换为HNSW (M={settings.faiss_hnsw_m})")
+    
+    def _set_hnsw_ef_search(self, vectorstore: FAISS):
+        """为加载的HNSW索引应用当前的efSearch配置"""
+        import faiss
+        
+        if isinstance(vectorstore.index, faiss.IndexHNSW):
+            vectorstore.index.hnsw.efSearch = settings.faiss_hnsw_ef_search
+    
     def load_existing_vectorstore(self, store_type: str = "chroma") -> Optional[Union[Chroma, FAISS]]:
         """
         加载已存在的向量存储
@@ -370,8 +488,10 @@ class LangChainDocumentProcessor:
                         str(faiss_path),
                         self.embeddings
                     )
+                    self._set_hnsw_ef_search(self.vectorstore)
                     logger.info("成功加载已存在的FAISS向量存储")
             
+            self._query_cache.clear()
             return self.vectorstore
             
         except Exception as e:
@@ -386,7 +506,8 @@ class LangChainDocumentProcessor:
         Args:
             query: 查询文本
             k: 返回结果数量
-            filter_dict: 过滤条件
+            filter_dict: 元数据过滤条件，如 {"subject": "数学", "grade": "五年级"}；
+                会下推到向量库，在相似度计算前缩小候选集
             
         Returns:
             相似文档列表
@@ -396,15 +517,24 @@ class LangChainDocumentProcessor:
             return []
         
         try:
+            # 相似查询直接复用缓存结果，跳过向量检索
+            query_embedding = self.embeddings.embed_query(query)
+            scope = (k, filter_dict)
+            cached = self._query_cache.lookup(query_embedding, scope=scope)
+            if cached is not None:
+                logger.info(f"语义缓存命中，返回 {len(cached)} 个结果")
+                return list(cached)
+            
             if filter_dict:
                 # 带过滤条件的搜索
-                docs = self.vectorstore.similarity_search(
-                    query, k=k, filter=filter_dict
+                docs = self.vectorstore.similarity_search_by_vector(
+                    query_embedding, k=k, filter=self._build_vectorstore_filter(filter_dict)
                 )
             else:
                 # 普通相似度搜索
-                docs = self.vectorstore.similarity_search(query, k=k)
+                docs = self.vectorstore.similarity_search_by_vector(query_embedding, k=k)
             
+            self._query_cache.insert(query_embedding, docs, scope=scope)
             logger.info(f"相似度搜索完成，返回 {len(docs)} 个结果")
             return docs
             
@@ -412,6 +542,13 @@ class LangChainDocumentProcessor:
             logger.error(f"相似度搜索失败: {e}")
             return []
     
+    def _build_vectorstore_filter(self, filter_dict: Dict) -> Dict:
+        """将简单的键值过滤条件转换为当前向量存储支持的格式"""
+        # Chroma的where条件中多个字段需要显式使用$and组合
+        if isinstance(self.vectorstore, Chroma) and len(filter_dict) > 1:
+            return {"$and": [{key: value} for key, value in filter_dict.items()]}
+        return filter_dict
+    
     def similarity_search_with_score(self, query: str, k: int = 5) -> List[tuple]:
         """
         带分数的相似度搜索
@@ -462,7 +599,7 @@ class LangChainDocumentProcessor:
                 chain_type=chain_type,
                 retriever=retriever,
                 return_source_documents=True,
-                verbose=True
+                verbose=settings.verbose_chains
             )
             
             logger.info(f"检索问答链创建成功，类型: {chain_type}")
@@ -472,6 +609,14 @@ class LangChainDocumentProcessor:
             logger.error(f"创建问答链失败: {e}")
             return None
     
+    def _get_query_semaphore(self) -> asyncio.Semaphore:
+        """获取当前事件循环的查询并发信号量，事件循环已更换（如多次asyncio.run）时重新创建"""
+        loop = asyncio.get_running_loop()
+        if self._query_semaphore is None or self._semaphore_loop is not loop:
+            self._query_semaphore = asyncio.Semaphore(settings.max_concurrent_queries)
+            self._semaphore_loop = loop
+        return self._query_semaphore
+    
     async def aprocess_query(self, query: str, qa_chain: RetrievalQA) -> Dict[str, Any]:
         """
         异步处理查询
@@ -484,12 +629,9 @@ class LangChainDocumentProcessor:
             查询结果
         """
         try:
-            # 在线程池中运行同步的问答链
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                None, 
-                lambda: qa_chain({"query": query})
-            )
+            # 使用原生异步调用，等待模型响应期间不占用线程
+            async with self._get_query_semaphore():
+                result = await qa_chain.ainvoke({"query": query})
             
             return {
                 "answer": result["result"],
@@ -2,14 +2,25 @@
 基于LangChain工具链的增强教案生成模块
 结合LangChain的Agents、Tools和Chains来增强教案生成能力
 """
+import re
+import time
+import json
+import hashlib
+import queue
 import logging
 import asyncio
-from typing import Dict, List, Any, Optional, Union
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List, Any, Optional, Set, Union
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass, field, fields
+
+import httpx
 
 # LangChain imports
-from langchain.agents import AgentType, initialize_agent, Tool
+from langchain.agents import AgentType, initialize_agent
+from langchain.tools import StructuredTool
 from langchain.agents.agent_toolkits import create_retriever_tool
 from langchain.chains import (
     LLMChain,
@@ -18,18 +29,19 @@ from langchain.chains import (
     ConversationalRetrievalChain
 )
 from langchain.prompts import (
-    PromptTemplate,
     ChatPromptTemplate,
     SystemMessagePromptTemplate,
     HumanMessagePromptTemplate
 )
-from langchain.schema import Document
+from langchain.schema import Document, HumanMessage, SystemMessage
 from langchain_openai import ChatOpenAI
-from langchain.callbacks import StreamingStdOutCallbackHandler
+from langchain.callbacks import AsyncIteratorCallbackHandler, StreamingStdOutCallbackHandler
+from pydantic import BaseModel, Field
 
 from config import settings
 from src.langchain_document_processor import langchain_processor
 from src.memory_manager import memory_manager
+from src.semantic_cache import SemanticCache
 from src.student_data import student_data_manager
 from src.teaching_practices import get_teaching_practices, TeachingPracticeQuery
 
@@ -37,6 +49,58 @@ from src.teaching_practices import get_teaching_practices, TeachingPracticeQuery
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 单次生成时各输出部分的分隔标记 -> 结果字段
+_SECTION_KEYS = {
+    'STRUCTURE': 'lesson_structure',
+    'CONTENT': 'lesson_content',
+    'OPTIMIZED': 'optimized_lesson',
+}
+_SECTION_PATTERN = re.compile(r'^\s*===(STRUCTURE|CONTENT|OPTIMIZED)===\s*$', re.MULTILINE)
+
+# 写入提示词的用户偏好/教学建议字段（其余如更新时间等字段对生成无帮助）
+_PREFERENCE_KEYS = ('preferred_methods', 'preferred_duration', 'teaching_style', 'difficulty_preference')
+_RECOMMENDATION_KEYS = ('preferred_teaching_methods', 'suggested_methods', 'suggested_duration', 'subject_expertise')
+_MAX_LISTED_ITEMS = 3
+
+_ID_FMT = '%Y%m%d_%H%M%S'
+
+def _make_lesson_id(prefix: str, now: datetime) -> str:
+    """生成教案ID，附加纳秒计数后缀保证同一秒内并发生成的ID不重复"""
+    return f"{prefix}_{now.strftime(_ID_FMT)}_{time.monotonic_ns() % 1_000_000_000:09d}"
+
+class _SafeDict(dict):
+    """format_map使用的字典，缺失的变量渲染为空字符串"""
+    
+    def __missing__(self, key: str) -> str:
+        return ''
+
+def _compact_json(data: Dict[str, Any], keys: tuple) -> str:
+    """只保留指定字段、列表截取前几项，输出紧凑且稳定的JSON"""
+    subset = {}
+    for key in keys:
+        value = data.get(key)
+        if value in (None, '', [], {}):
+            continue
+        subset[key] = value[:_MAX_LISTED_ITEMS] if isinstance(value, list) else value
+    return json.dumps(subset, ensure_ascii=False, separators=(',', ':'))
+
+class StudentAnalysisInput(BaseModel):
+    """学情分析工具参数"""
+    class_id: str = Field(description="班级ID")
+    subject: str = Field(description="学科")
+
+class TeachingSuggestionsInput(BaseModel):
+    """教学建议工具参数"""
+    subject: str = Field(description="学科")
+    grade: str = Field(description="年级")
+    topic: str = Field(description="主题")
+
+class LessonHistoryInput(BaseModel):
+    """历史教案工具参数"""
+    user_id: str = Field(description="用户ID")
+    subject: str = Field(default="", description="学科")
+    topic: str = Field(default="", description="主题")
+
 @dataclass
 class EnhancedLessonPlanRequest:
     """增强的教案生成请求"""
@@ -56,20 +120,150 @@ class EnhancedLessonPlanRequest:
         if self.learning_objectives is None:
             self.learning_objectives = []
 
+@dataclass(slots=True)
+class LessonContext:
+    """教案生成的上下文信息（默认值即数据不可用时的兜底文本）"""
+    reference_materials: str = "暂无参考材料"
+    student_analysis: str = "学情数据暂不可用"
+    teaching_suggestions: str = "建议采用互动式教学，结合多媒体辅助，注重实践操作"
+    user_preferences: str = "无特定偏好"
+    teaching_patterns: str = "无历史模式"
+    # 实际返回了真实、非空数据的来源（模拟数据、空结果不计入）
+    sources: Set[str] = field(default_factory=set)
+    
+    def context_score(self) -> int:
+        """实际获取到真实数据的上下文项数"""
+        return len(self.sources)
+    
+    def prompt_inputs(self) -> Dict[str, str]:
+        """作为链条输入变量的上下文文本"""
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.name != 'sources'}
+
+@dataclass(slots=True)
+class LessonPlan:
+    """生成的教案（对外接口返回时转换为字典）"""
+    id: str
+    timestamp: str
+    basic_info: Dict[str, Any]
+    structure: str
+    content: str
+    optimized_content: str
+    agent_analysis: str
+    generation_method: str
+    confidence_score: float
+
+class _LoopBoundAsyncClient(httpx.AsyncClient):
+    """
+    按事件循环分别建立连接池的AsyncClient
+    
+    生成器是进程内单例，而Web页面每次生成都在新的asyncio.run事件循环中执行；
+    长连接不能跨事件循环复用，因此每个事件循环使用各自的底层客户端发送请求，
+    所属事件循环已关闭的客户端在下次发送请求时关闭并移除
+    """
+    
+    def __init__(self, **kwargs):
+        # 自身只负责构造请求，不建立连接池；连接池由各事件循环的底层客户端持有
+        super().__init__(
+            transport=httpx.AsyncBaseTransport(),
+            trust_env=False,
+            **{key: kwargs[key] for key in ('timeout',) if key in kwargs}
+        )
+        self._client_kwargs = kwargs
+        self._loop_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._loop_clients_lock = threading.Lock()
+    
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        loop = asyncio.get_running_loop()
+        with self._loop_clients_lock:
+            stale = [self._loop_clients.pop(old_loop)
+                     for old_loop in list(self._loop_clients) if old_loop.is_closed()]
+            client = self._loop_clients.get(loop)
+            if client is None:
+                client = self._loop_clients[loop] = httpx.AsyncClient(**self._client_kwargs)
+        
+        for old_client in stale:
+            await self._discard(old_client)
+        return await client.send(request, **kwargs)
+    
+    @staticmethod
+    async def _discard(client: httpx.AsyncClient):
+        """关闭底层客户端；事件循环已关闭时连接无法正常关闭，释放引用后由套接字析构关闭"""
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.debug(f"关闭旧事件循环的HTTP客户端失败: {e}")
+    
+    async def aclose(self):
+        with self._loop_clients_lock:
+            clients = list(self._loop_clients.values())
+            self._loop_clients.clear()
+        for client in clients:
+            await self._discard(client)
+        await super().aclose()
+
 class LangChainLessonGenerator:
     """基于LangChain的增强教案生成器"""
     
     def __init__(self):
         """初始化生成器"""
+        # 所有链条共享同一组HTTP连接池，并发调用时复用长连接
+        limits = httpx.Limits(
+            max_connections=settings.llm_max_connections,
+            max_keepalive_connections=settings.llm_max_keepalive_connections
+        )
+        timeout = httpx.Timeout(
+            connect=settings.llm_connect_timeout,
+            read=settings.llm_read_timeout,
+            write=10.0,
+            pool=5.0
+        )
+        self._http_client = httpx.Client(limits=limits, timeout=timeout)
+        self._http_async_client = _LoopBoundAsyncClient(limits=limits, timeout=timeout)
+        
         self.llm = ChatOpenAI(
             openai_api_key=settings.openai_api_key,
             openai_api_base=settings.openai_api_base,
             model_name=settings.llm_model,
             temperature=0.7,
             streaming=True,
-            callbacks=[StreamingStdOutCallbackHandler()]
+            callbacks=[StreamingStdOutCallbackHandler()] if settings.verbose_chains else None,
+            max_retries=settings.llm_max_retries,
+            http_client=self._http_client,
+            http_async_client=self._http_async_client,
+            # 相同的提示词前缀路由到同一缓存，提高服务端前缀缓存命中率
+            extra_body={"prompt_cache_key": settings.prompt_cache_key} if settings.prompt_cache_key else None
+        )
+        
+        # 共享的有界线程池，用于运行同步的链条和Agent
+        self._executor = ThreadPoolExecutor(max_workers=settings.max_workers)
+        
+        # 参考材料缓存: (学科, 年级, 主题) -> (写入时间, 参考材料文本)
+        self._reference_cache: Dict[tuple, tuple] = {}
+        
+        # 后台记忆写入：常驻线程依次处理，不依赖调用方的事件循环（Web页面每次生成都是新的asyncio.run）
+        self._memory_queue: queue.Queue = queue.Queue(maxsize=1024)
+        threading.Thread(target=self._drain_memory_queue, daemon=True).start()
+        
+        # 正在生成中的请求: 请求键 -> 结果Future，用于合并并发的重复请求
+        self._inflight: Dict[bytes, asyncio.Future] = {}
+        
+        # 限制同时进行的教案生成调用，批量生成时避免触发接口限流（信号量绑定事件循环，按循环创建）
+        self._llm_semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        # 教案语义缓存：相近的生成请求直接复用已生成的教案
+        self._lesson_cache = SemanticCache(
+            threshold=settings.lesson_cache_threshold,
+            max_size=settings.lesson_cache_size,
+            ttl_seconds=settings.lesson_cache_ttl
         )
         
+        # 工具中的异步调用统一提交到常驻后台事件循环，避免每次调用都新建事件循环
+        self._tool_loop = asyncio.new_event_loop()
+        threading.Thread(target=self._tool_loop.run_forever, daemon=True).start()
+        
         # 初始化工具链
         self._initialize_tools()
         self._initialize_chains()
@@ -91,17 +285,14 @@ class LangChainLessonGenerator:
             self.tools.append(retriever_tool)
         
         # 2. 学情分析工具
-        async def analyze_student_data(input_str: str) -> str:
+        async def analyze_student_data(class_id: str, subject: str) -> str:
             """分析学生学情数据"""
             try:
-                # 解析输入参数
-                params = eval(input_str)  # 在生产环境中应使用更安全的解析方法
-                class_id = params.get('class_id', '')
-                subject = params.get('subject', '')
-                
                 # 获取学情数据
-                class_performance = await student_data_manager.get_class_performance(class_id, subject)
-                knowledge_gaps = await student_data_manager.get_knowledge_gaps(class_id, subject)
+                class_performance, knowledge_gaps = await asyncio.gather(
+                    student_data_manager.get_class_performance(class_id, subject),
+                    student_data_manager.get_knowledge_gaps(class_id, subject)
+                )
                 
                 # 格式化结果
                 analysis = f"班级表现: 平均分{class_performance.get('average_score', 0)}, "
@@ -112,22 +303,19 @@ class LangChainLessonGenerator:
             except Exception as e:
                 return f"学情分析失败: {str(e)}"
         
-        student_analysis_tool = Tool(
+        student_analysis_tool = StructuredTool.from_function(
+            func=lambda class_id, subject: self._run_tool_coroutine(analyze_student_data(class_id, subject)),
+            coroutine=analyze_student_data,
             name="student_analysis",
-            description="分析班级学生的学习情况。输入格式: {'class_id': '班级ID', 'subject': '学科'}",
-            func=lambda x: asyncio.run(analyze_student_data(x))
+            description="分析班级学生的学习情况",
+            args_schema=StudentAnalysisInput
         )
         self.tools.append(student_analysis_tool)
         
         # 3. 教学实践建议工具
-        async def get_teaching_suggestions(input_str: str) -> str:
+        async def get_teaching_suggestions(subject: str, grade: str, topic: str) -> str:
             """获取教学实践建议"""
             try:
-                params = eval(input_str)
-                subject = params.get('subject', '')
-                grade = params.get('grade', '')
-                topic = params.get('topic', '')
-                
                 # 这里应该调用teaching_practices模块
                 suggestions = f"针对{grade}{subject}-{topic}的教学建议:\n"
                 suggestions += "1. 采用互动式教学方法\n"
@@ -138,20 +326,22 @@ class LangChainLessonGenerator:
             except Exception as e:
                 return f"获取教学建议失败: {str(e)}"
         
-        teaching_suggestions_tool = Tool(
+        teaching_suggestions_tool = StructuredTool.from_function(
+            func=lambda subject, grade, topic: self._run_tool_coroutine(
+                get_teaching_suggestions(subject, grade, topic)
+            ),
+            coroutine=get_teaching_suggestions,
             name="teaching_suggestions",
-            description="获取最新的教学实践建议。输入格式: {'subject': '学科', 'grade': '年级', 'topic': '主题'}",
-            func=lambda x: asyncio.run(get_teaching_suggestions(x))
+            description="获取最新的教学实践建议",
+            args_schema=TeachingSuggestionsInput
         )
         self.tools.append(teaching_suggestions_tool)
         
         # 4. 历史教案检索工具
-        def get_lesson_history(input_str: str) -> str:
+        def get_lesson_history(user_id: str, subject: str = "", topic: str = "") -> str:
             """获取历史教案"""
             try:
-                params = eval(input_str)
-                user_id = params.get('user_id', '')
-                current_request = params
+                current_request = {'user_id': user_id, 'subject': subject, 'topic': topic}
                 
                 similar_plans = memory_manager.find_similar_lesson_plans(user_id, current_request, limit=3)
                 
@@ -168,26 +358,25 @@ class LangChainLessonGenerator:
             except Exception as e:
                 return f"检索历史教案失败: {str(e)}"
         
-        history_tool = Tool(
+        history_tool = StructuredTool.from_function(
+            func=get_lesson_history,
             name="lesson_history",
-            description="检索用户的历史教案。输入格式: {'user_id': '用户ID', 'subject': '学科', 'topic': '主题'}",
-            func=get_lesson_history
+            description="检索用户的历史教案",
+            args_schema=LessonHistoryInput
         )
         self.tools.append(history_tool)
     
+    def _run_tool_coroutine(self, coro, timeout: float = 30):
+        """在后台事件循环中运行工具协程并等待结果（可在任意线程中调用）"""
+        return asyncio.run_coroutine_threadsafe(coro, self._tool_loop).result(timeout=timeout)
+    
     def _initialize_chains(self):
         """初始化链条"""
+        # 各提示词拆分为固定的系统指令和可变的用户输入两部分；
+        # 指令放在消息开头且逐字不变，服务端可对相同前缀复用缓存
         
         # 1. 教案结构生成链
-        structure_template = """
-基于以下信息，生成教案的基本结构框架：
-
-学科: {subject}
-年级: {grade}
-课题: {topic}
-课时: {duration}分钟
-学习目标: {learning_objectives}
-特殊要求: {special_requirements}
+        structure_system = """你是一名经验丰富的教师，负责根据课程信息生成教案的基本结构框架。
 
 请生成包含以下部分的教案结构：
 1. 教学目标（知识、能力、情感态度）
@@ -197,15 +386,21 @@ class LangChainLessonGenerator:
 5. 教学过程（详细步骤）
 6. 板书设计
 7. 课后作业
-8. 教学反思
+8. 教学反思"""
 
-结构框架:
-"""
-        
-        self.structure_prompt = PromptTemplate(
-            input_variables=["subject", "grade", "topic", "duration", "learning_objectives", "special_requirements"],
-            template=structure_template
-        )
+        structure_human = """学科: {subject}
+年级: {grade}
+课题: {topic}
+课时: {duration}分钟
+学习目标: {learning_objectives}
+特殊要求: {special_requirements}
+
+结构框架:"""
+
+        self.structure_prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(structure_system),
+            HumanMessagePromptTemplate.from_template(structure_human)
+        ])
         
         self.structure_chain = LLMChain(
             llm=self.llm,
@@ -214,10 +409,16 @@ class LangChainLessonGenerator:
         )
         
         # 2. 内容填充链
-        content_template = """
-基于教案结构框架和参考资料，生成详细的教案内容：
+        content_system = """你是一名经验丰富的教师，负责基于教案结构框架和参考资料生成详细的教案内容。
+
+请填充详细的教案内容，确保：
+1. 内容符合学生认知水平
+2. 教学方法多样化
+3. 重点突出，难点突破
+4. 具有可操作性
+5. 体现个性化教学"""
 
-教案结构框架:
+        content_human = """教案结构框架:
 {lesson_structure}
 
 参考教案资料:
@@ -229,20 +430,12 @@ class LangChainLessonGenerator:
 教学实践建议:
 {teaching_suggestions}
 
-请填充详细的教案内容，确保：
-1. 内容符合学生认知水平
-2. 教学方法多样化
-3. 重点突出，难点突破
-4. 具有可操作性
-5. 体现个性化教学
+详细教案内容:"""
 
-详细教案内容:
-"""
-        
-        self.content_prompt = PromptTemplate(
-            input_variables=["lesson_structure", "reference_materials", "student_analysis", "teaching_suggestions"],
-            template=content_template
-        )
+        self.content_prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(content_system),
+            HumanMessagePromptTemplate.from_template(content_human)
+        ])
         
         self.content_chain = LLMChain(
             llm=self.llm,
@@ -251,10 +444,16 @@ class LangChainLessonGenerator:
         )
         
         # 3. 个性化优化链
-        optimization_template = """
-基于用户历史偏好和教学模式，优化教案内容：
+        optimization_system = """你是一名经验丰富的教师，负责基于用户历史偏好和教学模式优化教案内容。
 
-原始教案内容:
+请根据用户偏好和成功模式，优化教案的：
+1. 教学方法选择
+2. 活动设计
+3. 时间分配
+4. 评估方式
+5. 差异化安排"""
+
+        optimization_human = """原始教案内容:
 {lesson_content}
 
 用户教学偏好:
@@ -263,20 +462,12 @@ class LangChainLessonGenerator:
 历史成功模式:
 {teaching_patterns}
 
-请根据用户偏好和成功模式，优化教案的：
-1. 教学方法选择
-2. 活动设计
-3. 时间分配
-4. 评估方式
-5. 差异化安排
+优化后的教案:"""
 
-优化后的教案:
-"""
-        
-        self.optimization_prompt = PromptTemplate(
-            input_variables=["lesson_content", "user_preferences", "teaching_patterns"],
-            template=optimization_template
-        )
+        self.optimization_prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(optimization_system),
+            HumanMessagePromptTemplate.from_template(optimization_human)
+        ])
         
         self.optimization_chain = LLMChain(
             llm=self.llm,
@@ -284,14 +475,66 @@ class LangChainLessonGenerator:
             output_key="optimized_lesson"
         )
         
-        # 4. 完整的序列链
+        # 4. 单次生成链：一次调用同时输出结构、内容和优化结果
+        single_pass_system = """你是一名经验丰富的教师，负责根据课程信息、参考资料、学情和用户偏好生成一份完整的教案。
+
+请依次输出以下三个部分，每个部分以单独一行的分隔标记开头：
+
+===STRUCTURE===
+教案结构框架：教学目标（知识、能力、情感态度）、教学重点和难点、教学方法和策略、教学准备、教学过程（详细步骤）、板书设计、课后作业、教学反思
+
+===CONTENT===
+按结构框架填充的详细教案内容，确保内容符合学生认知水平、教学方法多样化、重点突出难点突破、具有可操作性、体现个性化教学
+
+===OPTIMIZED===
+根据用户偏好和成功模式，在教学方法选择、活动设计、时间分配、评估方式、差异化安排上优化后的教案"""
+
+        single_pass_human = """学科: {subject}
+年级: {grade}
+课题: {topic}
+课时: {duration}分钟
+学习目标: {learning_objectives}
+特殊要求: {special_requirements}
+
+参考教案资料:
+{reference_materials}
+
+学情分析:
+{student_analysis}
+
+教学实践建议:
+{teaching_suggestions}
+
+用户教学偏好:
+{user_preferences}
+
+历史成功模式:
+{teaching_patterns}"""
+
+        self.single_pass_prompt = ChatPromptTemplate.from_messages([
+            SystemMessagePromptTemplate.from_template(single_pass_system),
+            HumanMessagePromptTemplate.from_template(single_pass_human)
+        ])
+        
+        self.single_pass_chain = LLMChain(
+            llm=self.llm,
+            prompt=self.single_pass_prompt,
+            output_key="lesson_plan_text"
+        )
+        
+        # 非流式生成直接渲染消息并调用模型，跳过链条每次调用的校验和回调开销；
+        # 系统消息不含变量，只需构造一次
+        self._single_pass_system_message = SystemMessage(content=single_pass_system)
+        self._single_pass_human_template = single_pass_human
+        
+        # 5. 完整的序列链（三段式，settings.use_multistage_chain 时使用）
         self.complete_chain = SequentialChain(
             chains=[self.structure_chain, self.content_chain, self.optimization_chain],
             input_variables=["subject", "grade", "topic", "duration", "learning_objectives", 
                            "special_requirements", "reference_materials", "student_analysis", 
                            "teaching_suggestions", "user_preferences", "teaching_patterns"],
             output_variables=["lesson_structure", "lesson_content", "optimized_lesson"],
-            verbose=True
+            verbose=settings.verbose_chains
         )
     
     def _initialize_agents(self):
@@ -300,10 +543,11 @@ class LangChainLessonGenerator:
             self.agent = initialize_agent(
                 tools=self.tools,
                 llm=self.llm,
-                agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-                verbose=True,
-                max_iterations=5,
-                early_stopping_method="generate"
+                agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
+                verbose=settings.verbose_chains,
+                max_iterations=settings.agent_max_iters,
+                # 达到轮数上限时直接停止，不再额外调用一次LLM生成结论
+                early_stopping_method="force"
             )
         else:
             self.agent = None
@@ -321,61 +565,272 @@ class LangChainLessonGenerator:
         try:
             logger.info(f"开始生成增强教案: {request.subject} - {request.topic}")
             
-            # 1. 收集上下文信息
-            context = await self._gather_context(request)
-            
-            # 2. 使用Agent进行智能分析（如果可用）
-            if self.agent:
-                agent_analysis = await self._run_agent_analysis(request, context)
-                context.update(agent_analysis)
-            
-            # 3. 生成教案结构和内容
-            lesson_result = await self._generate_lesson_with_chains(request, context)
+            # 0. 查询教案语义缓存
+            cache_text = self._lesson_cache_text(request)
+            cache_scope = self._lesson_cache_scope(request)
+            request_embedding, cached_lesson = await self._lookup_lesson_cache(cache_text, cache_scope)
+            if cached_lesson is not None:
+                return {**cached_lesson, 'generation_method': 'semantic_cache_hit'}
             
-            # 4. 后处理和记忆更新
-            final_lesson = self._post_process_lesson(lesson_result, request)
-            
-            # 5. 更新记忆（如果启用）
-            if request.use_memory:
-                self._update_memory(request, final_lesson)
-            
-            logger.info("增强教案生成完成")
-            return final_lesson
+            # 相同请求正在生成时，直接等待其结果，不重复调用模型
+            inflight_key = hashlib.blake2b(
+                repr((cache_text, cache_scope)).encode('utf-8'), digest_size=16
+            ).digest()
+            pending = self._inflight.get(inflight_key)
+            if pending is not None:
+                logger.info("相同教案请求正在生成，等待其结果")
+                return dict(await asyncio.shield(pending))
             
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[inflight_key] = future
+            try:
+                final_lesson = await self._generate_and_cache(request, request_embedding, cache_scope)
+                future.set_result(final_lesson)
+                return final_lesson
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                # 没有其他等待者时避免"异常未被获取"的警告
+                future.exception()
+                raise
+            finally:
+                self._inflight.pop(inflight_key, None)
+        
         except Exception as e:
             logger.error(f"生成增强教案失败: {e}")
             # 返回基础教案作为fallback
             return await self._generate_fallback_lesson(request)
     
-    async def _gather_context(self, request: EnhancedLessonPlanRequest) -> Dict[str, Any]:
-        """收集上下文信息"""
-        context = {}
+    async def _lookup_lesson_cache(self, cache_text: str, cache_scope: tuple) -> tuple:
+        """
+        查询教案语义缓存
         
+        Returns:
+            (请求向量, 缓存的教案)，未命中时教案为None，嵌入失败时向量也为None
+        """
         try:
-            # 获取参考材料
-            if langchain_processor.vectorstore:
-                query = f"{request.subject} {request.topic} {request.grade} 教案"
-                reference_docs = langchain_processor.similarity_search(query, k=3)
-                context['reference_materials'] = "\\n".join([doc.page_content[:500] for doc in reference_docs])
-            else:
-                context['reference_materials'] = "暂无参考材料"
+            request_embedding = await asyncio.to_thread(
+                langchain_processor.embeddings.embed_query, cache_text
+            )
+        except Exception as e:
+            logger.warning(f"教案缓存查询失败: {e}")
+            return None, None
+        
+        cached_lesson = self._lesson_cache.lookup(request_embedding, scope=cache_scope)
+        if cached_lesson is not None:
+            logger.info("命中教案语义缓存")
+        return request_embedding, cached_lesson
+    
+    async def _generate_and_cache(self, request: EnhancedLessonPlanRequest, request_embedding: Optional[List[float]],
+                                  cache_scope: tuple) -> Dict[str, Any]:
+        """执行完整的教案生成流程，成功后写入语义缓存"""
+        # 1. 收集上下文信息
+        context = await self._gather_context(request)
+        
+        # 2. 使用Agent进行智能分析（如果可用）
+        # Agent分析不作为链条输入，与教案生成并发执行
+        # 已检索到足够上下文时跳过Agent，省去多轮LLM调用
+        agent_task = None
+        skip_agent = context.context_score() >= settings.agent_skip_context_score
+        if self.agent and not skip_agent:
+            agent_task = asyncio.create_task(self._run_agent_analysis(request, context))
+        
+        # 3. 生成教案结构和内容
+        lesson_result = await self._generate_lesson_with_chains(request, context)
+        if agent_task is not None:
+            lesson_result.update(await agent_task)
+        elif skip_agent:
+            lesson_result['agent_analysis'] = "上下文信息充足，跳过Agent分析"
+        
+        # 4. 后处理和记忆更新
+        final_lesson = asdict(self._post_process_lesson(lesson_result, request))
+        
+        # 5. 更新记忆（如果启用）
+        if request.use_memory:
+            self._update_memory(request, final_lesson)
+        
+        # 6. 写入缓存（生成失败的结果不缓存）
+        if request_embedding is not None and not lesson_result.get('failed'):
+            self._lesson_cache.insert(request_embedding, final_lesson, scope=cache_scope)
+        
+        logger.info("增强教案生成完成")
+        return final_lesson
+    
+    async def generate_enhanced_lesson_plans_batch(self, requests: List[EnhancedLessonPlanRequest]) -> List[Dict[str, Any]]:
+        """
+        批量生成增强教案
+        
+        Args:
+            requests: 教案生成请求列表
             
-            # 获取学情分析
-            try:
-                class_performance = await student_data_manager.get_class_performance(request.class_id, request.subject)
-                knowledge_gaps = await student_data_manager.get_knowledge_gaps(request.class_id, request.subject)
-                
-                analysis = f"班级平均分: {class_performance.get('average_score', 0)}\\n"
-                analysis += f"及格率: {class_performance.get('pass_rate', 0):.1%}\\n"
-                analysis += f"薄弱知识点: {', '.join([gap['knowledge_point'] for gap in knowledge_gaps[:3]])}"
-                context['student_analysis'] = analysis
-            except:
-                context['student_analysis'] = "学情数据暂不可用"
+        Returns:
+            与requests一一对应的教案数据列表
+        """
+        # 各请求并发执行，LLM调用数量由信号量限制；单个请求失败时返回其基础教案
+        return list(await asyncio.gather(
+            *(self.generate_enhanced_lesson_plan(request) for request in requests)
+        ))
+    
+    async def generate_enhanced_lesson_plan_stream(self, request: EnhancedLessonPlanRequest) -> AsyncIterator[str]:
+        """
+        流式生成教案，模型输出的token到达即返回
+        
+        Args:
+            request: 教案生成请求
             
-            # 获取教学建议（简化版）
-            context['teaching_suggestions'] = "建议采用互动式教学，结合多媒体辅助，注重实践操作"
+        Yields:
+            教案文本片段（含===STRUCTURE===等分隔标记）
+        """
+        # 与非流式生成共用教案语义缓存，命中时一次返回完整文本
+        cache_scope = self._lesson_cache_scope(request)
+        request_embedding, cached_lesson = await self._lookup_lesson_cache(
+            self._lesson_cache_text(request), cache_scope
+        )
+        if cached_lesson is not None:
+            yield (f"===STRUCTURE===\n{cached_lesson['structure']}\n"
+                   f"===CONTENT===\n{cached_lesson['content']}\n"
+                   f"===OPTIMIZED===\n{cached_lesson['optimized_content']}")
+            return
+        
+        context = await self._gather_context(request)
+        chain_inputs = self._build_chain_inputs(request, context)
+        
+        # 每个请求使用独立的回调，避免并发请求的输出互相混杂
+        handler = AsyncIteratorCallbackHandler()
+        tokens = handler.aiter()
+        next_token: Optional[asyncio.Future] = None
+        pieces: List[str] = []
+        
+        async with self._get_llm_semaphore():
+            generation = asyncio.create_task(
+                self.single_pass_chain.acall(chain_inputs, callbacks=[handler])
+            )
+            try:
+                while True:
+                    if next_token is None:
+                        next_token = asyncio.ensure_future(tokens.__anext__())
+                    if not generation.done():
+                        # 同时等待下一个token和链条本身：链条在模型开始输出前出错时，
+                        # 回调收不到结束信号，只等待token会一直挂起
+                        await asyncio.wait({next_token, generation}, return_when=asyncio.FIRST_COMPLETED)
+                        if generation.done():
+                            generation.result()
+                            # 链条已完成，所有token均已入队，通知迭代器在取完后结束
+                            handler.done.set()
+                        if not next_token.done():
+                            continue
+                    try:
+                        token = await next_token
+                    except StopAsyncIteration:
+                        break
+                    next_token = None
+                    pieces.append(token)
+                    yield token
+                await generation
+            finally:
+                if next_token is not None and not next_token.done():
+                    next_token.cancel()
+                if not generation.done():
+                    generation.cancel()
+        
+        # 完整结果写入语义缓存，之后相同的请求（流式或非流式）直接复用
+        if request_embedding is not None:
+            lesson_result = self._parse_single_pass_output("".join(pieces))
+            lesson_result['agent_analysis'] = "流式生成，未进行Agent分析"
+            final_lesson = asdict(self._post_process_lesson(lesson_result, request))
+            self._lesson_cache.insert(request_embedding, final_lesson, scope=cache_scope)
+    
+    def _get_llm_semaphore(self) -> asyncio.Semaphore:
+        """获取当前事件循环的LLM并发信号量，事件循环已更换（如多次asyncio.run）时重新创建"""
+        loop = asyncio.get_running_loop()
+        if self._llm_semaphore is None or self._semaphore_loop is not loop:
+            self._llm_semaphore = asyncio.Semaphore(settings.llm_max_concurrency)
+            self._semaphore_loop = loop
+        return self._llm_semaphore
+    
+    async def close(self):
+        """写完排队中的记忆后，释放HTTP连接池、线程池和后台事件循环"""
+        await asyncio.to_thread(self._memory_queue.join)
+        
+        await self._http_async_client.aclose()
+        self._http_client.close()
+        self._executor.shutdown(wait=False)
+        self._tool_loop.call_soon_threadsafe(self._tool_loop.stop)
+    
+    def _lesson_cache_text(self, request: EnhancedLessonPlanRequest) -> str:
+        """构造用于语义缓存的请求文本"""
+        return "|".join([
+            request.subject,
+            request.grade,
+            request.topic,
+            str(request.duration),
+            request.difficulty_level,
+            request.teaching_style,
+            "；".join(request.learning_objectives),
+            request.special_requirements
+        ])
+    
+    @staticmethod
+    def _lesson_cache_scope(request: EnhancedLessonPlanRequest) -> tuple:
+        """
+        缓存的精确匹配范围：请求的每个字段都必须相同才复用缓存
+        
+        只改动课题中一两个字或课时长度的请求，向量仍高于相似度阈值，
+        这些字段只靠向量区分会返回别的教案；启用记忆时偏好按用户区分
+        """
+        return (
+            request.class_id,
+            request.user_id if request.use_memory else None,
+            request.subject,
+            request.grade,
+            request.topic,
+            request.duration,
+            tuple(request.learning_objectives),
+            request.special_requirements,
+            request.difficulty_level,
+            request.teaching_style
+        )
+    
+    async def _gather_context(self, request: EnhancedLessonPlanRequest) -> LessonContext:
+        """收集上下文信息（相互独立的数据源并发获取，单项失败只影响该项）"""
+        context = LessonContext()
+        
+        # 参考材料检索是同步调用，放到线程中与学情查询并发执行
+        reference_materials, class_performance, knowledge_gaps = await asyncio.gather(
+            asyncio.to_thread(self._search_reference_materials, request),
+            student_data_manager.get_class_performance(request.class_id, request.subject, use_mock=False),
+            student_data_manager.get_knowledge_gaps(request.class_id, request.subject, use_mock=False),
+            return_exceptions=True
+        )
+        
+        # 获取参考材料（没有检索到文档时保留兜底文本）
+        if isinstance(reference_materials, Exception):
+            logger.error(f"检索参考材料失败: {reference_materials}")
+        elif reference_materials:
+            context.reference_materials = reference_materials
+            context.sources.add('reference_materials')
+        
+        # 获取学情分析
+        try:
+            if isinstance(class_performance, Exception):
+                raise class_performance
+            if isinstance(knowledge_gaps, Exception):
+                raise knowledge_gaps
+            if class_performance is None or knowledge_gaps is None:
+                raise ValueError("MCP服务不可用")
             
-            # 获取用户偏好和模式
+            analysis = f"班级平均分: {class_performance.get('average_score', 0)}\\n"
+            analysis += f"及格率: {class_performance.get('pass_rate', 0):.1%}\\n"
+            analysis += f"薄弱知识点: {', '.join([gap['knowledge_point'] for gap in knowledge_gaps[:3]])}"
+            context.student_analysis = analysis
+            context.sources.add('student_analysis')
+        except Exception as e:
+            logger.warning(f"学情数据不可用: {e}")
+        
+        # 获取用户偏好和模式（内存读取，无需并发）
+        try:
             if request.use_memory:
                 user_prefs = memory_manager.get_user_preferences(request.user_id)
                 teaching_recommendations = memory_manager.get_teaching_recommendations(request.user_id, {
@@ -384,25 +839,54 @@ class LangChainLessonGenerator:
                     'topic': request.topic
                 })
                 
-                context['user_preferences'] = str(user_prefs) if user_prefs else "无特定偏好"
-                context['teaching_patterns'] = str(teaching_recommendations) if teaching_recommendations else "无历史模式"
-            else:
-                context['user_preferences'] = "无特定偏好"
-                context['teaching_patterns'] = "无历史模式"
-            
-            return context
-            
+                # 没有可用字段时保留默认的兜底文本
+                user_prefs = _compact_json(user_prefs or {}, _PREFERENCE_KEYS)
+                if user_prefs != '{}':
+                    context.user_preferences = user_prefs
+                    context.sources.add('user_preferences')
+                teaching_recommendations = teaching_recommendations or {}
+                teaching_patterns = _compact_json(teaching_recommendations, _RECOMMENDATION_KEYS)
+                if teaching_patterns != '{}':
+                    context.teaching_patterns = teaching_patterns
+                    # 学科使用次数对老用户总是存在，只有方法/时长建议才算作真实的教学模式
+                    if any(teaching_recommendations.get(key) for key in _RECOMMENDATION_KEYS
+                           if key != 'subject_expertise'):
+                        context.sources.add('teaching_patterns')
         except Exception as e:
-            logger.error(f"收集上下文信息失败: {e}")
-            return {
-                'reference_materials': "暂无参考材料",
-                'student_analysis': "学情数据暂不可用",
-                'teaching_suggestions': "建议采用常规教学方法",
-                'user_preferences': "无特定偏好",
-                'teaching_patterns': "无历史模式"
-            }
+            logger.error(f"读取用户记忆失败: {e}")
+        
+        return context
     
-    async def _run_agent_analysis(self, request: EnhancedLessonPlanRequest, context: Dict[str, Any]) -> Dict[str, Any]:
+    def _search_reference_materials(self, request: EnhancedLessonPlanRequest) -> str:
+        """检索参考材料并拼接为文本（没有可用文档时返回空字符串）"""
+        if not langchain_processor.vectorstore:
+            return ""
+        
+        cache_key = (request.subject, request.grade, request.topic)
+        now = time.monotonic()
+        cached = self._reference_cache.get(cache_key)
+        if cached is not None and now - cached[0] <= settings.reference_cache_ttl:
+            logger.debug(f"参考材料缓存命中: {cache_key}")
+            return cached[1]
+        
+        query = f"{request.subject} {request.topic} {request.grade} 教案"
+        # 优先只检索同学科的参考材料
+        reference_docs = langchain_processor.similarity_search(
+            query, k=3, filter_dict={"subject": request.subject}
+        )
+        if not reference_docs:
+            reference_docs = langchain_processor.similarity_search(query, k=3)
+        reference_materials = "\\n".join([doc.page_content[:500] for doc in reference_docs])
+        
+        # 顺带清理过期条目，防止缓存无限增长
+        self._reference_cache = {
+            key: entry for key, entry in self._reference_cache.items()
+            if now - entry[0] <= settings.reference_cache_ttl
+        }
+        self._reference_cache[cache_key] = (now, reference_materials)
+        return reference_materials
+    
+    async def _run_agent_analysis(self, request: EnhancedLessonPlanRequest, context: LessonContext) -> Dict[str, Any]:
         """运行Agent分析"""
         try:
             # 构建Agent查询
@@ -419,87 +903,114 @@ class LangChainLessonGenerator:
             4. 检索相似的历史教案
             """
             
-            # 在线程池中运行同步的Agent
-            loop = asyncio.get_event_loop()
-            agent_result = await loop.run_in_executor(
-                None, 
-                lambda: self.agent.run(agent_query)
-            )
-            
-            return {'agent_analysis': agent_result}
+            # 异步运行Agent，工具调用直接在当前事件循环中执行
+            agent_result = await self.agent.ainvoke({"input": agent_query})
             
+            return {'agent_analysis': agent_result['output']}
+        
         except Exception as e:
             logger.error(f"Agent分析失败: {e}")
             return {'agent_analysis': "Agent分析不可用"}
     
-    async def _generate_lesson_with_chains(self, request: EnhancedLessonPlanRequest, context: Dict[str, Any]) -> Dict[str, Any]:
+    def _build_chain_inputs(self, request: EnhancedLessonPlanRequest, context: LessonContext) -> Dict[str, str]:
+        """构造链条的输入变量"""
+        return {
+            'subject': request.subject,
+            'grade': request.grade,
+            'topic': request.topic,
+            'duration': str(request.duration),
+            'learning_objectives': ', '.join(request.learning_objectives),
+            'special_requirements': request.special_requirements,
+            **context.prompt_inputs()
+        }
+    
+    async def _generate_lesson_with_chains(self, request: EnhancedLessonPlanRequest, context: LessonContext) -> Dict[str, Any]:
         """使用链条生成教案"""
         try:
             # 准备输入数据
-            chain_inputs = {
-                'subject': request.subject,
-                'grade': request.grade,
-                'topic': request.topic,
-                'duration': str(request.duration),
-                'learning_objectives': ', '.join(request.learning_objectives),
-                'special_requirements': request.special_requirements,
-                'reference_materials': context.get('reference_materials', ''),
-                'student_analysis': context.get('student_analysis', ''),
-                'teaching_suggestions': context.get('teaching_suggestions', ''),
-                'user_preferences': context.get('user_preferences', ''),
-                'teaching_patterns': context.get('teaching_patterns', '')
-            }
-            
-            # 在线程池中运行同步的链条
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                None,
-                lambda: self.complete_chain(chain_inputs)
-            )
-            
-            return result
+            chain_inputs = self._build_chain_inputs(request, context)
             
+            async with self._get_llm_semaphore():
+                if settings.use_multistage_chain:
+                    # 在共享线程池中运行同步的链条
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(
+                        self._executor,
+                        lambda: self.complete_chain(chain_inputs)
+                    )
+                
+                response = await self.llm.ainvoke([
+                    self._single_pass_system_message,
+                    HumanMessage(content=self._single_pass_human_template.format_map(_SafeDict(chain_inputs)))
+                ])
+            return self._parse_single_pass_output(response.content)
+        
         except Exception as e:
             logger.error(f"链条生成教案失败: {e}")
             return {
                 'lesson_structure': "基础教案结构",
                 'lesson_content': "基础教案内容",
-                'optimized_lesson': "教案生成失败，请重试"
+                'optimized_lesson': "教案生成失败，请重试",
+                'failed': True
             }
     
-    def _post_process_lesson(self, lesson_result: Dict[str, Any], request: EnhancedLessonPlanRequest) -> Dict[str, Any]:
+    def _parse_single_pass_output(self, text: str) -> Dict[str, Any]:
+        """按分隔标记将单次生成的输出拆分为结构、内容和优化结果"""
+        parts = _SECTION_PATTERN.split(text)
+        result = {
+            _SECTION_KEYS[marker]: body.strip()
+            for marker, body in zip(parts[1::2], parts[2::2])
+        }
+        
+        if not result:
+            # 模型未按格式输出时，整段文本作为教案内容
+            logger.warning("生成结果缺少分隔标记，按整体内容处理")
+            result = {'lesson_content': text.strip(), 'optimized_lesson': text.strip()}
+        
+        return result
+    
+    def _post_process_lesson(self, lesson_result: Dict[str, Any], request: EnhancedLessonPlanRequest) -> LessonPlan:
         """后处理教案"""
-        try:
-            # 构建最终的教案数据结构
-            final_lesson = {
-                'id': f"lesson_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
-                'timestamp': datetime.now().isoformat(),
-                'basic_info': {
-                    'subject': request.subject,
-                    'grade': request.grade,
-                    'topic': request.topic,
-                    'duration': request.duration,
-                    'learning_objectives': request.learning_objectives,
-                    'special_requirements': request.special_requirements,
-                    'difficulty_level': request.difficulty_level,
-                    'teaching_style': request.teaching_style
-                },
-                'structure': lesson_result.get('lesson_structure', ''),
-                'content': lesson_result.get('lesson_content', ''),
-                'optimized_content': lesson_result.get('optimized_lesson', ''),
-                'agent_analysis': lesson_result.get('agent_analysis', ''),
-                'generation_method': 'langchain_enhanced',
-                'confidence_score': self._calculate_confidence_score(lesson_result)
-            }
-            
-            return final_lesson
-            
-        except Exception as e:
-            logger.error(f"后处理教案失败: {e}")
-            return {'error': str(e)}
+        now = datetime.now()
+        return LessonPlan(
+            id=_make_lesson_id("lesson", now),
+            timestamp=now.isoformat(),
+            basic_info={
+                'subject': request.subject,
+                'grade': request.grade,
+                'topic': request.topic,
+                'duration': request.duration,
+                'learning_objectives': request.learning_objectives,
+                'special_requirements': request.special_requirements,
+                'difficulty_level': request.difficulty_level,
+                'teaching_style': request.teaching_style
+            },
+            structure=lesson_result.get('lesson_structure', ''),
+            content=lesson_result.get('lesson_content', ''),
+            optimized_content=lesson_result.get('optimized_lesson', ''),
+            agent_analysis=lesson_result.get('agent_analysis', ''),
+            generation_method='langchain_enhanced',
+            confidence_score=self._calculate_confidence_score(lesson_result)
+        )
     
     def _update_memory(self, request: EnhancedLessonPlanRequest, lesson_data: Dict[str, Any]):
-        """更新记忆"""
+        """更新记忆（仅入队，由后台线程写入，不阻塞教案返回）"""
+        try:
+            self._memory_queue.put_nowait((request, lesson_data))
+        except queue.Full:
+            logger.warning(f"记忆写入队列已满，丢弃用户 {request.user_id} 的本次记忆更新")
+    
+    def _drain_memory_queue(self):
+        """后台线程：依次处理记忆写入队列"""
+        while True:
+            request, lesson_data = self._memory_queue.get()
+            try:
+                self._write_memory(request, lesson_data)
+            finally:
+                self._memory_queue.task_done()
+    
+    def _write_memory(self, request: EnhancedLessonPlanRequest, lesson_data: Dict[str, Any]):
+        """写入记忆"""
         try:
             # 添加到教案历史
             memory_manager.add_lesson_plan_to_history(request.user_id, {
@@ -521,7 +1032,7 @@ class LangChainLessonGenerator:
             })
             
             logger.info(f"为用户 {request.user_id} 更新了记忆")
-            
+        
         except Exception as e:
             logger.error(f"更新记忆失败: {e}")
     
@@ -541,9 +1052,10 @@ class LangChainLessonGenerator:
     
     async def _generate_fallback_lesson(self, request: EnhancedLessonPlanRequest) -> Dict[str, Any]:
         """生成fallback教案"""
+        now = datetime.now()
         return {
-            'id': f"fallback_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
-            'timestamp': datetime.now().isoformat(),
+            'id': _make_lesson_id("fallback", now),
+            'timestamp': now.isoformat(),
             'basic_info': {
                 'subject': request.subject,
                 'grade': request.grade,
@@ -556,8 +1068,18 @@ class LangChainLessonGenerator:
             'error': "使用fallback方式生成"
         }
 
-# 创建全局实例
-langchain_lesson_generator = LangChainLessonGenerator()
+# 全局实例在首次使用时创建，导入模块时不连接模型服务、不构建链条
+_generator: Optional[LangChainLessonGenerator] = None
+_generator_lock = threading.Lock()
+
+def get_generator() -> LangChainLessonGenerator:
+    """获取全局教案生成器（首次调用时创建）"""
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                _generator = LangChainLessonGenerator()
+    return _generator
 
 # 便利函数
 async def generate_enhanced_lesson_plan(
@@ -590,4 +1112,4 @@ async def generate_enhanced_lesson_plan(
         use_memory=use_memory
     )
     
-    return await langchain_lesson_generator.generate_enhanced_lesson_plan(request)
\ No newline at end of file
+    return await get_generator().generate_enhanced_lesson_plan(request)
\ No newline at end of file
@@ -2,18 +2,31 @@
 智能教案生成核心模块
 整合知识库检索、学情分析和教学实践方法，生成个性化教案
 """
+import re
 import logging
 import asyncio
-from typing import Dict, List, Any, Optional
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Dict, List, Any, Optional, Tuple
 from datetime import datetime
 from dataclasses import dataclass
+from pathlib import Path
 import json
 
 from llama_index.core import Settings
 from llama_index.llms.openai import OpenAI
+from openai import AsyncOpenAI
+from pydantic import BaseModel, Field
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from config import settings
+from src.completion_cache import CompletionCache
 from src.knowledge_base import knowledge_base
+from src.semantic_cache import SemanticCache
 from src.student_data import student_data_manager
 from src.teaching_practices import get_teaching_practices, TeachingPracticeQuery, SubjectType, GradeLevel
 
@@ -21,6 +34,12 @@ from src.teaching_practices import get_teaching_practices, TeachingPracticeQuery
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _json_default(value: Any) -> Any:
+    """标准库json不支持的类型：时间转为ISO字符串，其余转为字符串"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
 @dataclass
 class LessonPlanRequest:
     """教案生成请求"""
@@ -45,6 +64,279 @@ class LessonPlanResponse:
     teaching_practices: Dict[str, Any]
     generated_at: datetime
     confidence_score: float
+    
+    def to_json(self) -> bytes:
+        """序列化为UTF-8编码的JSON（安装了orjson时使用orjson，时间字段输出为ISO格式）"""
+        data = {
+            "lesson_plan": self.lesson_plan,
+            "reference_materials": self.reference_materials,
+            "student_analysis": self.student_analysis,
+            "teaching_practices": self.teaching_practices,
+            "generated_at": self.generated_at,
+            "confidence_score": self.confidence_score
+        }
+        if orjson is not None:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS, default=str)
+        return json.dumps(data, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+# 学科/年级字符串到教学实践查询枚举的映射
+_SUBJECT_MAP: Dict[str, SubjectType] = {
+    "语文": SubjectType.CHINESE,
+    "数学": SubjectType.MATH,
+    "英语": SubjectType.ENGLISH,
+    "物理": SubjectType.PHYSICS,
+    "化学": SubjectType.CHEMISTRY,
+    "生物": SubjectType.BIOLOGY,
+    "历史": SubjectType.HISTORY,
+    "地理": SubjectType.GEOGRAPHY,
+    "政治": SubjectType.POLITICS
+}
+
+_GRADE_MAP: Dict[str, GradeLevel] = {
+    "一年级": GradeLevel.GRADE_1,
+    "二年级": GradeLevel.GRADE_2,
+    "三年级": GradeLevel.GRADE_3,
+    "四年级": GradeLevel.GRADE_4,
+    "五年级": GradeLevel.GRADE_5,
+    "六年级": GradeLevel.GRADE_6,
+    "七年级": GradeLevel.GRADE_7,
+    "八年级": GradeLevel.GRADE_8,
+    "九年级": GradeLevel.GRADE_9,
+    "高一": GradeLevel.HIGH_SCHOOL_1,
+    "高二": GradeLevel.HIGH_SCHOOL_2,
+    "高三": GradeLevel.HIGH_SCHOOL_3
+}
+
+# 教案生成提示词模板（公共部分）
+_PROMPT_HEADER = """
+作为一名资深教育专家，请根据以下信息生成一份详细的教案：
+
+基本信息：
+- 学科: {subject}
+- 年级: {grade}
+- 课题: {topic}
+- 课时: {duration}分钟
+- 学习目标: {learning_objectives}
+- 特殊要求: {special_requirements}
+
+{reference_summary}
+
+{student_summary}
+
+{practices_summary}
+"""
+
+_PROMPT_TMPL = _PROMPT_HEADER + """
+请按照以下结构生成教案，确保内容具体、可操作性强：
+
+1. 教学目标（知识目标、能力目标、情感态度目标）
+2. 教学重点和难点
+3. 教学方法和策略
+4. 教学准备（教师和学生）
+5. 教学过程（导入、新课讲授、练习巩固、小结、作业）
+6. 板书设计
+7. 差异化教学安排
+8. 教学反思要点
+
+请确保教案符合学生认知水平，教学方法多样化，注重学生参与和互动。
+
+教案内容：
+"""
+
+# 结构化输出时的提示词模板：字段结构由response_format中的JSON Schema约束，无需逐项描述
+_STRUCTURED_PROMPT_TMPL = _PROMPT_HEADER + """
+请以JSON格式输出教案的各个部分，内容具体、可操作性强，符合学生认知水平，注重学生参与和互动。
+"""
+
+# 置信度评分中计入完整性的学情分析项和教学实践项
+_ANALYSIS_KEYS = ('class_performance', 'knowledge_gaps', 'class_needs')
+_PRACTICE_KEYS = ('teaching_strategies', 'classroom_activities', 'assessment_methods')
+
+# 生成文本中各部分标题所在行（允许前面带序号、Markdown标记；标题后须为标点或行尾，避免误匹配正文）
+_SECTION_RE = re.compile(
+    r"^[\s#*\d.、一二三四五六七八九十（）()]*(教学目标|教学重点|教学难点|教学方法|教学准备|教学过程|板书设计|差异化教学|教学反思)"
+    r"(?=[和与及、]|[ \t]*(?:[:：*#（(]|$))",
+    re.MULTILINE
+)
+
+# 提示词要求的教案各部分标题（按输出顺序），流式生成时据此判断某一部分已完成
+_SECTION_HEADINGS = ("教学目标", "教学重点", "教学方法", "教学准备", "教学过程", "板书设计", "差异化教学", "教学反思")
+_HEADING_INDEX = {heading: i for i, heading in enumerate(_SECTION_HEADINGS)}
+
+class TeachingObjectives(BaseModel):
+    """教学目标"""
+    知识目标: List[str] = Field(default_factory=list)
+    能力目标: List[str] = Field(default_factory=list)
+    情感态度目标: List[str] = Field(default_factory=list)
+
+class TeachingPreparation(BaseModel):
+    """教学准备"""
+    教师准备: List[str] = Field(default_factory=list)
+    学生准备: List[str] = Field(default_factory=list)
+
+class TeachingStep(BaseModel):
+    """教学过程中的一个环节"""
+    时间: str = ""
+    内容: str = ""
+    设计意图: str = ""
+
+class TeachingProcess(BaseModel):
+    """教学过程"""
+    导入环节: TeachingStep = Field(default_factory=TeachingStep)
+    新课讲授: TeachingStep = Field(default_factory=TeachingStep)
+    练习巩固: TeachingStep = Field(default_factory=TeachingStep)
+    课堂小结: TeachingStep = Field(default_factory=TeachingStep)
+    作业布置: TeachingStep = Field(default_factory=TeachingStep)
+
+class DifferentiatedTeaching(BaseModel):
+    """差异化教学"""
+    优秀学生: str = ""
+    中等学生: str = ""
+    学困学生: str = ""
+
+class LessonPlanSchema(BaseModel):
+    """模型结构化输出的教案（基本信息由请求填充，不要求模型生成）"""
+    教学目标: TeachingObjectives = Field(default_factory=TeachingObjectives)
+    教学重点: List[str] = Field(default_factory=list)
+    教学难点: List[str] = Field(default_factory=list)
+    教学方法: List[str] = Field(default_factory=list)
+    教学准备: TeachingPreparation = Field(default_factory=TeachingPreparation)
+    教学过程: TeachingProcess = Field(default_factory=TeachingProcess)
+    板书设计: str = ""
+    教学反思: str = ""
+    差异化教学: DifferentiatedTeaching = Field(default_factory=DifferentiatedTeaching)
+
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "lesson_plan", "schema": LessonPlanSchema.model_json_schema()}
+}
+
+def _merge_into(target: Dict[str, Any], source: Dict[str, Any]):
+    """将source中的字段逐层覆盖到target（保留target中source未给出的默认值）"""
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_into(target[key], value)
+        else:
+            target[key] = value
+
+def _new_lesson_plan_skeleton() -> Dict[str, Any]:
+    """新建空白教案结构（每次返回全新的嵌套字典，并发请求之间互不共享）"""
+    return {
+        "基本信息": {
+            "课程名称": "",
+            "学科": "",
+            "年级": "",
+            "课时": "",
+            "授课教师": "",
+            "授课时间": ""
+        },
+        "教学目标": {
+            "知识目标": [],
+            "能力目标": [],
+            "情感态度目标": []
+        },
+        "教学重点": [],
+        "教学难点": [],
+        "教学方法": [],
+        "教学准备": {
+            "教师准备": [],
+            "学生准备": []
+        },
+        "教学过程": {
+            "导入环节": {
+                "时间": "5分钟",
+                "内容": "",
+                "设计意图": ""
+            },
+            "新课讲授": {
+                "时间": "25分钟",
+                "内容": "",
+                "设计意图": ""
+            },
+            "练习巩固": {
+                "时间": "10分钟",
+                "内容": "",
+                "设计意图": ""
+            },
+            "课堂小结": {
+                "时间": "3分钟",
+                "内容": "",
+                "设计意图": ""
+            },
+            "作业布置": {
+                "时间": "2分钟",
+                "内容": "",
+                "设计意图": ""
+            }
+        },
+        "板书设计": "",
+        "教学反思": "",
+        "差异化教学": {
+            "优秀学生": "",
+            "中等学生": "",
+            "学困学生": ""
+        }
+    }
+
+def _semantic_scope(request: LessonPlanRequest) -> tuple:
+    """
+    教案提示词语义缓存的复用范围
+    
+    课时、教学目标或特殊要求只改动提示词中的少量文字，整段提示词的向量仍会高度相似，
+    因此这些字段必须完全相同才允许复用，修改后重新生成不会拿到旧教案
+    """
+    return (
+        request.class_id,
+        request.subject,
+        request.grade,
+        request.topic,
+        request.duration,
+        tuple(request.learning_objectives),
+        request.special_requirements
+    )
+
+class CachedLLM:
+    """带两级缓存的LLM包装：提示词精确匹配（磁盘）+ 提示词向量语义匹配（内存）"""
+    
+    def __init__(self, llm: OpenAI, cache: CompletionCache, semantic_cache: SemanticCache):
+        self.llm = llm
+        self.cache = cache
+        self.semantic_cache = semantic_cache
+    
+    async def acomplete(self, prompt: str, scope: Any = None) -> str:
+        """
+        生成文本，命中缓存时不调用模型
+        
+        Args:
+            prompt: 提示词
+            scope: 语义匹配的附加条件，只在相同scope内复用相似提示词的结果
+            
+        Returns:
+            生成的文本
+        """
+        model = self.llm.model
+        text = await asyncio.to_thread(self.cache.get, model, prompt)
+        if text is not None:
+            logger.info("生成结果精确缓存命中")
+            return text
+        
+        embedding = None
+        try:
+            embedding = await Settings.embed_model.aget_query_embedding(prompt)
+            text = self.semantic_cache.lookup(embedding, scope=scope)
+            if text is not None:
+                logger.info("生成结果语义缓存命中")
+                return text
+        except Exception as e:
+            logger.warning(f"提示词语义缓存不可用: {e}")
+        
+        response = await self.llm.acomplete(prompt)
+        text = response.text
+        
+        await asyncio.to_thread(self.cache.put, model, prompt, text)
+        if embedding is not None:
+            self.semantic_cache.insert(embedding, text, scope=scope)
+        return text
 
 class IntelligentLessonGenerator:
     """智能教案生成器"""
@@ -55,66 +347,59 @@ class IntelligentLessonGenerator:
             model=settings.llm_model,
             api_key=settings.openai_api_key,
             api_base=settings.openai_api_base,
-            temperature=0.7  # 适中的创造性
+            temperature=0.7,  # 适中的创造性
+            max_tokens=settings.lesson_max_tokens,
+            additional_kwargs={"response_format": _RESPONSE_FORMAT} if settings.use_structured_output else {}
         )
         
-        # 教案模板
-        self.lesson_plan_template = {
-            "基本信息": {
-                "课程名称": "",
-                "学科": "",
-                "年级": "",
-                "课时": "",
-                "授课教师": "",
-                "授课时间": ""
-            },
-            "教学目标": {
-                "知识目标": [],
-                "能力目标": [],
-                "情感态度目标": []
-            },
-            "教学重点": [],
-            "教学难点": [],
-            "教学方法": [],
-            "教学准备": {
-                "教师准备": [],
-                "学生准备": []
-            },
-            "教学过程": {
-                "导入环节": {
-                    "时间": "5分钟",
-                    "内容": "",
-                    "设计意图": ""
-                },
-                "新课讲授": {
-                    "时间": "25分钟",
-                    "内容": "",
-                    "设计意图": ""
-                },
-                "练习巩固": {
-                    "时间": "10分钟",
-                    "内容": "",
-                    "设计意图": ""
-                },
-                "课堂小结": {
-                    "时间": "3分钟",
-                    "内容": "",
-                    "设计意图": ""
-                },
-                "作业布置": {
-                    "时间": "2分钟",
-                    "内容": "",
-                    "设计意图": ""
-                }
-            },
-            "板书设计": "",
-            "教学反思": "",
-            "差异化教学": {
-                "优秀学生": "",
-                "中等学生": "",
-                "学困学生": ""
-            }
-        }
+        # 参考材料缓存：(学科, 年级, 课题) -> (写入时间, 检索结果)，不同班级的同一课题共用检索结果
+        self._reference_cache: Dict[tuple, tuple] = {}
+        
+        # 只限制LLM调用的并发数，数据获取仍可并行进行（信号量绑定事件循环，按循环创建）
+        self._llm_semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        # 相同或几乎相同的提示词直接复用已生成的教案文本
+        self.cached_llm = CachedLLM(
+            self.llm,
+            cache=CompletionCache(
+                Path(settings.chroma_persist_dir) / "completion_cache.sqlite3",
+                max_entries=settings.completion_cache_size
+            ),
+            semantic_cache=SemanticCache(
+                threshold=settings.completion_semantic_threshold,
+                max_size=settings.semantic_cache_size,
+                ttl_seconds=settings.semantic_cache_ttl
+            )
+        )
+    
+    def _get_llm_semaphore(self) -> asyncio.Semaphore:
+        """获取当前事件循环的LLM并发信号量，事件循环已更换（如多次asyncio.run）时重新创建"""
+        loop = asyncio.get_running_loop()
+        if self._llm_semaphore is None or self._semaphore_loop is not loop:
+            self._llm_semaphore = asyncio.Semaphore(settings.max_concurrent_generations)
+            self._semaphore_loop = loop
+        return self._llm_semaphore
+    
+    def warmup(self):
+        """
+        预热模型连接和知识库索引，在服务启动时调用，
+        使首个教案请求不再承担建立连接、加载索引等一次性开销
+        
+        只使用同步接口：异步客户端的连接池绑定在事件循环上，
+        在临时事件循环中预热的连接无法被之后的请求复用
+        """
+        try:
+            self.llm.complete("ping", max_tokens=1)
+        except Exception as e:
+            logger.warning(f"预热模型连接失败: {e}")
+        
+        try:
+            knowledge_base.ensure_loaded()
+        except Exception as e:
+            logger.warning(f"预加载知识库索引失败: {e}")
+        
+        logger.info("教案生成器预热完成")
     
     async def generate_lesson_plan(self, request: LessonPlanRequest) -> LessonPlanResponse:
         """
@@ -128,57 +413,153 @@ class IntelligentLessonGenerator:
         """
         try:
             logger.info(f"开始生成教案: {request.subject} - {request.topic}")
+            # 授课时间与生成时间使用同一时刻
+            now = datetime.now()
             
             # 1. 并行获取所有必要数据
-            tasks = [
-                self._get_reference_materials(request),
-                self._get_student_analysis(request),
-                self._get_teaching_practices(request)
-            ]
+            reference_materials, student_analysis, teaching_practices = await self._collect_inputs(request)
             
-            reference_materials, student_analysis, teaching_practices = await asyncio.gather(*tasks)
+            # 没有参考教案、学情和教学方法时提示词几乎没有信息量，直接返回基础模板
+            if (not reference_materials
+                    and not student_analysis.get('class_performance')
+                    and not teaching_practices.get('teaching_strategies')):
+                logger.warning(f"缺少参考材料、学情和教学方法，跳过模型调用: {request.topic}")
+                return self._build_response(
+                    self._create_basic_lesson_plan(request, now=now),
+                    reference_materials, student_analysis, teaching_practices,
+                    confidence_score=0.1, now=now
+                )
             
             # 2. 生成教案内容
             lesson_plan = await self._generate_lesson_content(
-                request, reference_materials, student_analysis, teaching_practices
+                request, reference_materials, student_analysis, teaching_practices, now=now
             )
             
-            # 3. 计算置信度分数
-            confidence_score = self._calculate_confidence_score(
-                reference_materials, student_analysis, teaching_practices
+            # 3. 计算置信度分数并组装响应
+            return self._build_response(
+                lesson_plan, reference_materials, student_analysis, teaching_practices, now=now
             )
-            
-            response = LessonPlanResponse(
-                lesson_plan=lesson_plan,
-                reference_materials=reference_materials,
-                student_analysis=student_analysis,
-                teaching_practices=teaching_practices,
-                generated_at=datetime.now(),
-                confidence_score=confidence_score
-            )
-            
-            logger.info(f"教案生成完成，置信度: {confidence_score:.2f}")
-            return response
-            
+        
         except Exception as e:
             logger.error(f"生成教案失败: {e}")
             raise
     
+    async def generate_lesson_plan_stream(self, request: LessonPlanRequest) -> AsyncIterator[LessonPlanResponse]:
+        """
+        流式生成教案，每完成一个部分返回一次当前的教案
+        
+        Args:
+            request: 教案生成请求
+            
+        Yields:
+            逐步完善的教案响应，最后一次为完整教案
+        """
+        logger.info(f"开始流式生成教案: {request.subject} - {request.topic}")
+        now = datetime.now()
+        inputs = await self._collect_inputs(request)
+        prompt = self._build_generation_prompt(request, *inputs)
+        
+        cached_text = await asyncio.to_thread(self.cached_llm.cache.get, self.llm.model, prompt)
+        if cached_text is not None:
+            yield self._build_response(self._parse_lesson_plan(cached_text, request, now=now), *inputs, now=now)
+            return
+        
+        text = ""
+        next_heading = 1
+        # 只在完整的行中按行首匹配标题，正文中的"教学方法多样化"等不会误判为新的部分
+        scanned = 0
+        # 流式生成同样占用一个LLM并发名额，直到整段输出接收完毕
+        async with self._get_llm_semaphore():
+            async for chunk in await self.llm.astream_complete(prompt):
+                text = chunk.text
+                line_end = text.rfind("\n") + 1
+                
+                # 出现后续部分的标题，说明之前的部分已经生成完毕
+                completed = False
+                for match in _SECTION_RE.finditer(text, scanned, line_end):
+                    index = _HEADING_INDEX.get(match.group(1), -1)
+                    if index >= next_heading:
+                        next_heading = index + 1
+                        completed = True
+                scanned = max(scanned, line_end)
+                # 结构化输出在生成完成前不是合法JSON，只返回最终结果
+                if completed and not settings.use_structured_output:
+                    yield self._build_response(
+                        self._parse_lesson_plan(text, request, now=now), *inputs, now=now, final=False
+                    )
+        
+        await asyncio.to_thread(self.cached_llm.cache.put, self.llm.model, prompt, text)
+        yield self._build_response(self._parse_lesson_plan(text, request, now=now), *inputs, now=now)
+    
+    async def _collect_inputs(self, request: LessonPlanRequest) -> tuple:
+        """并行获取参考材料、学情分析和教学实践方法"""
+        return await asyncio.gather(
+            self._get_reference_materials(request),
+            self._get_student_analysis(request),
+            self._get_teaching_practices(request)
+        )
+    
+    def _build_response(self, lesson_plan: Dict[str, Any],
+                        reference_materials: List[Dict[str, Any]],
+                        student_analysis: Dict[str, Any],
+                        teaching_practices: Dict[str, Any],
+                        confidence_score: Optional[float] = None,
+                        now: Optional[datetime] = None,
+                        final: bool = True) -> LessonPlanResponse:
+        """计算置信度分数（未指定时）并组装教案响应，流式生成的中间结果传入final=False"""
+        if confidence_score is None:
+            confidence_score = self._calculate_confidence_score(
+                reference_materials, student_analysis, teaching_practices
+            )
+        
+        response = LessonPlanResponse(
+            lesson_plan=lesson_plan,
+            reference_materials=reference_materials,
+            student_analysis=student_analysis,
+            teaching_practices=teaching_practices,
+            generated_at=now or datetime.now(),
+            confidence_score=confidence_score
+        )
+        
+        if final:
+            logger.info(f"教案生成完成，置信度: {confidence_score:.2f}")
+        return response
+    
     async def _get_reference_materials(self, request: LessonPlanRequest) -> List[Dict[str, Any]]:
         """获取参考教案材料"""
+        cache_key = (request.subject, request.grade, request.topic)
+        now = time.monotonic()
+        cached = self._reference_cache.get(cache_key)
+        if cached is not None and now - cached[0] <= settings.reference_cache_ttl:
+            logger.debug(f"参考材料缓存命中: {cache_key}")
+            return list(cached[1])
+        
         try:
             # 构建查询文本
             query_text = f"{request.subject} {request.topic} {request.grade} 教案"
             
-            # 从知识库检索相似教案
+            # 从知识库检索相似教案，优先只检索同学科的教案
             similar_lessons = knowledge_base.search_similar_lessons(
                 query=query_text,
-                top_k=settings.max_lesson_plans
+                top_k=settings.max_lesson_plans,
+                subject=request.subject
             )
+            if not similar_lessons:
+                similar_lessons = knowledge_base.search_similar_lessons(
+                    query=query_text,
+                    top_k=settings.max_lesson_plans
+                )
             
             logger.info(f"检索到 {len(similar_lessons)} 个参考教案")
-            return similar_lessons
             
+            # 顺带清理过期条目，防止缓存无限增长
+            self._reference_cache = {
+                key: entry for key, entry in self._reference_cache.items()
+                if now - entry[0] <= settings.reference_cache_ttl
+            }
+            self._reference_cache[cache_key] = (now, similar_lessons)
+            return similar_lessons
+        
         except Exception as e:
             logger.error(f"获取参考材料失败: {e}")
             return []
@@ -186,17 +567,13 @@ class IntelligentLessonGenerator:
     async def _get_student_analysis(self, request: LessonPlanRequest) -> Dict[str, Any]:
         """获取学生学情分析"""
         try:
-            # 获取班级表现数据
-            class_performance = await student_data_manager.get_class_performance(
-                class_id=request.class_id,
-                subject=request.subject
-            )
-            
-            # 获取知识薄弱点
-            knowledge_gaps = await student_data_manager.get_knowledge_gaps(
+            # 并发获取班级表现数据和知识薄弱点
+            class_data = await student_data_manager.fetch_all_for_class(
                 class_id=request.class_id,
                 subject=request.subject
             )
+            class_performance = class_data["class_performance"]
+            knowledge_gaps = class_data["knowledge_gaps"]
             
             # 分析教学需求
             class_needs = student_data_manager.analyze_class_needs(
@@ -208,7 +585,7 @@ class IntelligentLessonGenerator:
                 "knowledge_gaps": knowledge_gaps,
                 "class_needs": class_needs
             }
-            
+        
         except Exception as e:
             logger.error(f"获取学生分析失败: {e}")
             return {}
@@ -232,48 +609,26 @@ class IntelligentLessonGenerator:
                 "assessment_methods": practices.assessment_methods,
                 "classroom_management": practices.classroom_management
             }
-            
+        
         except Exception as e:
             logger.error(f"获取教学实践失败: {e}")
             return {}
     
-    def _map_subject_to_enum(self, subject: str) -> SubjectType:
+    @staticmethod
+    def _map_subject_to_enum(subject: str) -> SubjectType:
         """将学科字符串映射到枚举"""
-        subject_map = {
-            "语文": SubjectType.CHINESE,
-            "数学": SubjectType.MATH,
-            "英语": SubjectType.ENGLISH,
-            "物理": SubjectType.PHYSICS,
-            "化学": SubjectType.CHEMISTRY,
-            "生物": SubjectType.BIOLOGY,
-            "历史": SubjectType.HISTORY,
-            "地理": SubjectType.GEOGRAPHY,
-            "政治": SubjectType.POLITICS
-        }
-        return subject_map.get(subject, SubjectType.GENERAL)
+        return _SUBJECT_MAP.get(subject, SubjectType.GENERAL)
     
-    def _map_grade_to_enum(self, grade: str) -> GradeLevel:
+    @staticmethod
+    def _map_grade_to_enum(grade: str) -> GradeLevel:
         """将年级字符串映射到枚举"""
-        grade_map = {
-            "一年级": GradeLevel.GRADE_1,
-            "二年级": GradeLevel.GRADE_2,
-            "三年级": GradeLevel.GRADE_3,
-            "四年级": GradeLevel.GRADE_4,
-            "五年级": GradeLevel.GRADE_5,
-            "六年级": GradeLevel.GRADE_6,
-            "七年级": GradeLevel.GRADE_7,
-            "八年级": GradeLevel.GRADE_8,
-            "九年级": GradeLevel.GRADE_9,
-            "高一": GradeLevel.HIGH_SCHOOL_1,
-            "高二": GradeLevel.HIGH_SCHOOL_2,
-            "高三": GradeLevel.HIGH_SCHOOL_3
-        }
-        return grade_map.get(grade, GradeLevel.GRADE_5)
+        return _GRADE_MAP.get(grade, GradeLevel.GRADE_5)
     
     async def _generate_lesson_content(self, request: LessonPlanRequest,
                                      reference_materials: List[Dict[str, Any]],
                                      student_analysis: Dict[str, Any],
-                                     teaching_practices: Dict[str, Any]) -> Dict[str, Any]:
+                                     teaching_practices: Dict[str, Any],
+                                     now: Optional[datetime] = None) -> Dict[str, Any]:
         """生成教案内容"""
         try:
             # 构建提示词
@@ -282,17 +637,22 @@ class IntelligentLessonGenerator:
             )
             
             # 调用LLM生成教案
-            response = await self.llm.acomplete(prompt)
+            generated_text = await self._complete_prompt(prompt, request)
             
             # 解析生成的教案
-            lesson_plan = self._parse_lesson_plan(response.text, request)
+            lesson_plan = self._parse_lesson_plan(generated_text, request, now=now)
             
             return lesson_plan
-            
+        
         except Exception as e:
             logger.error(f"生成教案内容失败: {e}")
             # 返回基础模板
-            return self._create_basic_lesson_plan(request)
+            return self._create_basic_lesson_plan(request, now=now)
+    
+    async def _complete_prompt(self, prompt: str, request: LessonPlanRequest) -> str:
+        """在并发限制内调用LLM（语义缓存仅在请求字段完全相同的范围内复用）"""
+        async with self._get_llm_semaphore():
+            return await self.cached_llm.acomplete(prompt, scope=_semantic_scope(request))
     
     def _build_generation_prompt(self, request: LessonPlanRequest,
                                reference_materials: List[Dict[str, Any]],
@@ -303,104 +663,92 @@ class IntelligentLessonGenerator:
         # 提取参考材料要点
         reference_summary = ""
         if reference_materials:
-            reference_summary = "参考优秀教案要点:\n"
-            for i, material in enumerate(reference_materials[:3], 1):
-                reference_summary += f"{i}. {material.get('content', '')[:200]}...\n"
+            reference_summary = "参考优秀教案要点:\n" + "".join(
+                f"{i}. {material.get('content', '')[:200]}...\n"
+                for i, material in enumerate(reference_materials[:3], 1)
+            )
         
         # 提取学情分析要点
         student_summary = ""
         if student_analysis.get('class_needs'):
             needs = student_analysis['class_needs']
-            student_summary = f"班级学情分析:\n"
-            student_summary += f"- 平均成绩: {student_analysis.get('class_performance', {}).get('average_score', '未知')}\n"
-            student_summary += f"- 重点关注: {', '.join([t['topic'] for t in needs.get('priority_topics', [])])}\n"
-            student_summary += f"- 教学策略: {', '.join(needs.get('teaching_strategies', []))}\n"
+            student_summary = "".join([
+                "班级学情分析:\n",
+                f"- 平均成绩: {student_analysis.get('class_performance', {}).get('average_score', '未知')}\n",
+                f"- 重点关注: {', '.join([t['topic'] for t in needs.get('priority_topics', [])])}\n",
+                f"- 教学策略: {', '.join(needs.get('teaching_strategies', []))}\n"
+            ])
         
         # 提取教学实践方法
         practices_summary = ""
         if teaching_practices.get('teaching_strategies'):
-            practices_summary = "推荐教学方法:\n"
-            for strategy in teaching_practices['teaching_strategies'][:2]:
-                practices_summary += f"- {strategy.get('name', '')}: {strategy.get('description', '')}\n"
-        
-        prompt = f"""
-作为一名资深教育专家，请根据以下信息生成一份详细的教案：
-
-基本信息：
-- 学科: {request.subject}
-- 年级: {request.grade}
-- 课题: {request.topic}
-- 课时: {request.duration}分钟
-- 学习目标: {', '.join(request.learning_objectives)}
-- 特殊要求: {request.special_requirements}
-
-{reference_summary}
-
-{student_summary}
-
-{practices_summary}
-
-请按照以下结构生成教案，确保内容具体、可操作性强：
-
-1. 教学目标（知识目标、能力目标、情感态度目标）
-2. 教学重点和难点
-3. 教学方法和策略
-4. 教学准备（教师和学生）
-5. 教学过程（导入、新课讲授、练习巩固、小结、作业）
-6. 板书设计
-7. 差异化教学安排
-8. 教学反思要点
-
-请确保教案符合学生认知水平，教学方法多样化，注重学生参与和互动。
-
-教案内容：
-"""
+            practices_summary = "推荐教学方法:\n" + "".join(
+                f"- {strategy.get('name', '')}: {strategy.get('description', '')}\n"
+                for strategy in teaching_practices['teaching_strategies'][:2]
+            )
         
-        return prompt
+        template = _STRUCTURED_PROMPT_TMPL if settings.use_structured_output else _PROMPT_TMPL
+        return template.format_map({
+            'subject': request.subject,
+            'grade': request.grade,
+            'topic': request.topic,
+            'duration': request.duration,
+            'learning_objectives': ', '.join(request.learning_objectives),
+            'special_requirements': request.special_requirements,
+            'reference_summary': reference_summary,
+            'student_summary': student_summary,
+            'practices_summary': practices_summary
+        })
     
-    def _parse_lesson_plan(self, generated_text: str, request: LessonPlanRequest) -> Dict[str, Any]:
+    def _parse_lesson_plan(self, generated_text: str, request: LessonPlanRequest,
+                           now: Optional[datetime] = None) -> Dict[str, Any]:
         """解析生成的教案文本"""
-        lesson_plan = self.lesson_plan_template.copy()
+        lesson_plan = _new_lesson_plan_skeleton()
         
         # 填充基本信息
         lesson_plan["基本信息"]["课程名称"] = request.topic
         lesson_plan["基本信息"]["学科"] = request.subject
         lesson_plan["基本信息"]["年级"] = request.grade
         lesson_plan["基本信息"]["课时"] = f"{request.duration}分钟"
-        lesson_plan["基本信息"]["授课时间"] = datetime.now().strftime("%Y-%m-%d")
+        lesson_plan["基本信息"]["授课时间"] = (now or datetime.now()).strftime("%Y-%m-%d")
         
-        # 简单的文本解析（实际应用中可以使用更复杂的NLP方法）
-        sections = generated_text.split('\n\n')
-        current_section = ""
+        lesson_plan["生成内容"] = generated_text
         
-        for section in sections:
-            section = section.strip()
-            if not section:
-                continue
-                
-            # 识别不同部分并填充到模板中
-            if "教学目标" in section:
-                lesson_plan["生成内容"] = generated_text
-            elif "教学重点" in section:
-                pass  # 可以进一步解析
-            # ... 其他部分的解析
+        # 结构化输出直接按Schema解析
+        if generated_text.lstrip().startswith("{"):
+            try:
+                structured = LessonPlanSchema.model_validate_json(generated_text)
+                _merge_into(lesson_plan, structured.model_dump(exclude_unset=True))
+                return lesson_plan
+            except ValueError as e:
+                logger.warning(f"结构化教案解析失败，按文本解析: {e}")
+        
+        # 一次扫描定位各部分标题，按标题之间的文本切分
+        sections = {}
+        matches = list(_SECTION_RE.finditer(generated_text))
+        for match, next_match in zip(matches, matches[1:] + [None]):
+            end = next_match.start() if next_match else len(generated_text)
+            sections.setdefault(match.group(1), generated_text[match.end():end].strip(" \n:：*#"))
         
-        # 如果解析失败，直接存储生成的文本
-        if "生成内容" not in lesson_plan:
-            lesson_plan["生成内容"] = generated_text
+        # 纯文本部分直接填入模板，其余部分保留分节原文
+        for key in ("板书设计", "教学反思"):
+            if sections.get(key):
+                lesson_plan[key] = sections[key]
+        lesson_plan["分节内容"] = sections
         
         return lesson_plan
     
-    def _create_basic_lesson_plan(self, request: LessonPlanRequest) -> Dict[str, Any]:
+    def _create_basic_lesson_plan(self, request: LessonPlanRequest,
+                                  now: Optional[datetime] = None) -> Dict[str, Any]:
         """创建基础教案模板"""
-        lesson_plan = self.lesson_plan_template.copy()
+        lesson_plan = _new_lesson_plan_skeleton()
         
         # 填充基本信息
         lesson_plan["基本信息"]["课程名称"] = request.topic
         lesson_plan["基本信息"]["学科"] = request.subject
         lesson_plan["基本信息"]["年级"] = request.grade
         lesson_plan["基本信息"]["课时"] = f"{request.duration}分钟"
-        lesson_plan["基本信息"]["授课时间"] = datetime.now().strftime("%Y-%m-%d")
+        lesson_plan["基本信息"]["授课时间"] = (now or datetime.now()).strftime("%Y-%m-%d")
         
         # 设置默认目标
         lesson_plan["教学目标"]["知识目标"] = request.learning_objectives or [f"掌握{request.topic}的基本概念"]
@@ -421,31 +769,206 @@ class IntelligentLessonGenerator:
             material_score = min(avg_score, 1.0) * 0.4
             score += material_score
         
-        # 学情分析完整性评分 (30%)
-        if student_analysis:
-            analysis_completeness = 0
-            if student_analysis.get('class_performance'):
-                analysis_completeness += 0.1
-            if student_analysis.get('knowledge_gaps'):
-                analysis_completeness += 0.1
-            if student_analysis.get('class_needs'):
-                analysis_completeness += 0.1
-            score += analysis_completeness
-        
-        # 教学实践方法丰富度评分 (30%)
-        if teaching_practices:
-            practices_richness = 0
-            for practice_type in ['teaching_strategies', 'classroom_activities', 'assessment_methods']:
-                if teaching_practices.get(practice_type):
-                    practices_richness += 0.1
-            score += practices_richness
+        # 学情分析完整性评分 (30%) 与教学实践方法丰富度评分 (30%)：每个非空项0.1分
+        filled_items = sum(1 for key in _ANALYSIS_KEYS if student_analysis.get(key))
+        filled_items += sum(1 for key in _PRACTICE_KEYS if teaching_practices.get(key))
+        score += 0.1 * filled_items
         
         return min(score, 1.0)
     
-    async def batch_generate_lesson_plans(self, requests: List[LessonPlanRequest]) -> List[LessonPlanResponse]:
-        """批量生成教案"""
-        tasks = [self.generate_lesson_plan(request) for request in requests]
-        return await asyncio.gather(*tasks, return_exceptions=True)
+    async def batch_generate_lesson_plans(self, requests: List[LessonPlanRequest]) -> AsyncIterator[Tuple[LessonPlanRequest, LessonPlanResponse]]:
+        """
+        批量生成教案，按完成顺序逐个返回（提示词完全相同的请求只调用一次模型）
+        
+        Args:
+            requests: 教案生成请求列表
+            
+        Yields:
+            (请求, 教案响应)，生成失败的请求返回基础模板教案
+        """
+        if settings.use_batch_api and len(requests) >= settings.batch_api_min_requests:
+            try:
+                responses = await self._batch_generate_with_batch_api(requests)
+            except Exception as e:
+                logger.error(f"Batch API批量生成失败，改为流水线生成: {e}")
+            else:
+                for request, response in zip(requests, responses):
+                    yield request, response
+                return
+        
+        async for i, response in self._batch_generate_pipelined(requests):
+            yield requests[i], response
+    
+    async def _batch_generate_pipelined(self, requests: List[LessonPlanRequest]) -> AsyncIterator[Tuple[int, LessonPlanResponse]]:
+        """
+        以 数据获取 → LLM生成 → 解析 三段流水线批量生成教案，
+        前面的请求在等待模型生成时，后面的请求已在获取数据；
+        每解析完一个教案立即返回 (请求下标, 教案响应)
+        """
+        loop = asyncio.get_running_loop()
+        fetch_queue: asyncio.Queue = asyncio.Queue()
+        llm_queue: asyncio.Queue = asyncio.Queue(maxsize=settings.pipeline_queue_size)
+        parse_queue: asyncio.Queue = asyncio.Queue(maxsize=settings.pipeline_queue_size)
+        for i in range(len(requests)):
+            fetch_queue.put_nowait(i)
+        
+        inputs: List[Optional[tuple]] = [None] * len(requests)
+        results: asyncio.Queue = asyncio.Queue()
+        # 提示词 -> 生成结果Future，相同提示词只调用一次模型
+        completions: Dict[str, asyncio.Future] = {}
+        
+        async def fetcher():
+            while not fetch_queue.empty():
+                i = fetch_queue.get_nowait()
+                inputs[i] = await self._collect_inputs(requests[i])
+                await llm_queue.put(i)
+        
+        async def llm_worker():
+            while (i := await llm_queue.get()) is not None:
+                try:
+                    prompt = self._build_generation_prompt(requests[i], *inputs[i])
+                except Exception as e:
+                    failed = loop.create_future()
+                    failed.set_exception(e)
+                    await parse_queue.put((i, failed))
+                    continue
+                
+                completion = completions.get(prompt)
+                if completion is not None:
+                    # 重复的提示词不等待生成结果，交给解析阶段等待
+                    await parse_queue.put((i, completion))
+                    continue
+                
+                completion = completions[prompt] = loop.create_future()
+                try:
+                    completion.set_result(await self._complete_prompt(prompt, requests[i]))
+                except Exception as e:
+                    completion.set_exception(e)
+                await parse_queue.put((i, completion))
+        
+        async def parser():
+            while (item := await parse_queue.get()) is not None:
+                i, completion = item
+                request = requests[i]
+                try:
+                    lesson_plan = self._parse_lesson_plan(await completion, request)
+                except Exception as e:
+                    logger.warning(f"教案生成失败，使用基础模板: {request.topic} ({e})")
+                    lesson_plan = self._create_basic_lesson_plan(request)
+                results.put_nowait((i, self._build_response(lesson_plan, *inputs[i])))
+        
+        width = max(1, settings.pipeline_width)
+        fetchers = [asyncio.create_task(fetcher()) for _ in range(width)]
+        llm_workers = [asyncio.create_task(llm_worker()) for _ in range(width)]
+        parsers = [asyncio.create_task(parser()) for _ in range(width)]
+        
+        async def run_stages():
+            try:
+                # 上一阶段全部结束后，向下一阶段的每个worker发送结束标记
+                await asyncio.gather(*fetchers)
+                for _ in llm_workers:
+                    await llm_queue.put(None)
+                await asyncio.gather(*llm_workers)
+                for _ in parsers:
+                    await parse_queue.put(None)
+                await asyncio.gather(*parsers)
+            finally:
+                results.put_nowait(None)
+        
+        stages = asyncio.create_task(run_stages())
+        try:
+            while (item := await results.get()) is not None:
+                yield item
+            await stages
+            logger.info(f"批量生成 {len(requests)} 个教案，实际调用模型 {len(completions)} 次")
+        finally:
+            # 调用方提前停止迭代或出错时，取消仍在运行的各阶段任务
+            for task in (stages, *fetchers, *llm_workers, *parsers):
+                task.cancel()
+    
+    async def _batch_generate_with_batch_api(self, requests: List[LessonPlanRequest]) -> List[LessonPlanResponse]:
+        """收集全部请求的提示词，去重后作为一个Batch作业提交，再逐个解析"""
+        inputs = await asyncio.gather(*(self._collect_inputs(request) for request in requests))
+        
+        # 按提示词分组，如同一课题在学情数据相同的多个班级
+        prompt_indices = defaultdict(list)
+        for i, (request, request_inputs) in enumerate(zip(requests, inputs)):
+            prompt_indices[self._build_generation_prompt(request, *request_inputs)].append(i)
+        unique_prompts = list(prompt_indices)
+        
+        texts = await self._submit_batch(unique_prompts)
+        
+        responses: List[Optional[LessonPlanResponse]] = [None] * len(requests)
+        for prompt, text in zip(unique_prompts, texts):
+            for i in prompt_indices[prompt]:
+                request = requests[i]
+                if text is None:
+                    logger.warning(f"Batch作业中教案生成失败，使用基础模板: {request.topic}")
+                    lesson_plan = self._create_basic_lesson_plan(request)
+                else:
+                    lesson_plan = self._parse_lesson_plan(text, request)
+                responses[i] = self._build_response(lesson_plan, *inputs[i])
+        return responses
+    
+    async def _submit_batch(self, prompts: List[str]) -> List[Optional[str]]:
+        """
+        通过OpenAI Batch API提交一组提示词并等待结果
+        
+        Args:
+            prompts: 提示词列表
+            
+        Returns:
+            与prompts一一对应的生成文本，失败的位置为None
+        """
+        lines = [
+            json.dumps({
+                "custom_id": f"request-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": settings.llm_model,
+                    "messages": [{"role": "user", "content": prompt}],
+                    "temperature": 0.7,
+                    "max_tokens": settings.lesson_max_tokens,
+                    **({"response_format": _RESPONSE_FORMAT} if settings.use_structured_output else {})
+                }
+            }, ensure_ascii=False)
+            for i, prompt in enumerate(prompts)
+        ]
+        
+        async with AsyncOpenAI(api_key=settings.openai_api_key, base_url=settings.openai_api_base) as client:
+            input_file = await client.files.create(
+                file=("lesson_batch.jsonl", "\n".join(lines).encode('utf-8')),
+                purpose="batch"
+            )
+            batch = await client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            logger.info(f"已提交Batch作业 {batch.id}，共 {len(prompts)} 个教案")
+            
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                await asyncio.sleep(settings.batch_api_poll_interval)
+                batch = await client.batches.retrieve(batch.id)
+            
+            if batch.status != "completed":
+                raise RuntimeError(f"Batch作业 {batch.id} 状态为 {batch.status}")
+            
+            texts: List[Optional[str]] = [None] * len(prompts)
+            if not batch.output_file_id:
+                return texts
+            
+            output = await client.files.content(batch.output_file_id)
+            for line in output.text.splitlines():
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if response.get("status_code") != 200:
+                    continue
+                index = int(item["custom_id"].rsplit("-", 1)[1])
+                texts[index] = response["body"]["choices"][0]["message"]["content"]
+            
+            return texts
 
 # 创建全局教案生成器实例
 lesson_generator = IntelligentLessonGenerator()
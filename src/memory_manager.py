@@ -2,14 +2,24 @@
 基于LangChain的记忆管理模块
 提供对话历史、教案生成历史和个性化偏好管理
 """
+import atexit
+import heapq
 import logging
 import json
-import pickle
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
 from typing import Dict, List, Any, Optional, Union
 from pathlib import Path
 from datetime import datetime, timedelta
+from functools import cached_property, lru_cache
 import hashlib
 
+import numpy as np
+
 # LangChain imports
 from langchain.memory import (
     ConversationBufferMemory,
@@ -25,12 +35,58 @@ from langchain.memory.chat_message_histories import (
 from langchain.schema import BaseMessage, HumanMessage, AIMessage, SystemMessage
 from langchain_openai import ChatOpenAI
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 from config import settings
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志级别和输出由应用入口配置，导入本模块不修改全局日志设置
 logger = logging.getLogger(__name__)
 
+# 每个用户保留的教案历史条数和成功教学模式条数（超出时自动淘汰最旧的）
+_MAX_LESSON_HISTORY = 100
+_MAX_SUCCESSFUL_PATTERNS = 50
+
+def _json_default(obj: Any) -> Any:
+    """序列化有界队列等JSON不支持的容器"""
+    if isinstance(obj, deque):
+        return list(obj)
+    raise TypeError(f"无法序列化的类型: {type(obj).__name__}")
+
+def _dumps(obj: Any) -> str:
+    """紧凑序列化为JSON字符串（安装了orjson时使用orjson）"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_json_default)
+
+def _intern(value: Any) -> Any:
+    """驻留学科、年级、教学方法等反复出现的短字符串，相同内容共用一个对象"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+def _intern_lesson_fields(lesson_data: Dict[str, Any]):
+    """驻留教案数据中的学科和年级"""
+    for key in ('subject', 'grade'):
+        if key in lesson_data:
+            lesson_data[key] = _intern(lesson_data[key])
+
+@lru_cache(maxsize=4096)
+def _topic_keywords(topic: str) -> frozenset:
+    """主题关键词集合（按主题文本缓存，相似度查询时不再重复切分）"""
+    return frozenset(topic.split())
+
+def _loads(text: Union[str, bytes]) -> Any:
+    """解析JSON（安装了orjson时使用orjson）"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
 class EducationMemoryManager:
     """教育系统记忆管理器"""
     
@@ -39,22 +95,55 @@ class EducationMemoryManager:
         self.memory_dir = Path(settings.student_data_dir) / "memory"
         self.memory_dir.mkdir(parents=True, exist_ok=True)
         
-        # LLM for memory operations
-        self.llm = ChatOpenAI(
-            openai_api_key=settings.openai_api_key,
-            openai_api_base=settings.openai_api_base,
-            model_name=settings.llm_model,
-            temperature=0.3
-        )
-        
         # 不同类型的记忆存储
         self.conversation_memories = {}  # 对话记忆
         self.lesson_plan_history = {}    # 教案生成历史
         self.user_preferences = {}       # 用户偏好
         self.teaching_patterns = {}      # 教学模式记忆
+        self._all_user_ids = set()       # 以上任一类记忆中出现过的用户
+        
+        # 各用户教案历史JSONL文件中的行数，超过保留条数的两倍时压缩文件
+        self._history_file_lines: Dict[str, int] = {}
+        
+        # 教案历史倒排索引：用户 -> (特征类型, 值) -> 条目序号列表（按需构建）
+        # 序号按加入顺序递增，被截断的旧条目序号小于 已加入总数 - 当前历史长度，查询时跳过
+        self._plan_index: Dict[str, Dict[tuple, List[int]]] = {}
+        self._plan_seq: Dict[str, int] = {}
+        
+        # 教学建议缓存：(用户, 学科, 年级) -> (生成时的模式版本号, 建议)
+        # 用户的教学模式每次更新时版本号加一，旧版本的缓存自然失效
+        self._rec_cache: Dict[tuple, tuple] = {}
+        self._rec_cache_gen: Dict[str, int] = {}
+        
+        # 各用户按使用次数从高到低排列的教学方法（同次数时先出现的在前，按需构建），
+        # 次数变化时只把该方法向前移动到正确位置，推荐时无需整体排序
+        self._method_ranking: Dict[str, List[str]] = {}
+        self._method_order: Dict[str, Dict[str, int]] = {}
+        
+        # 偏好和教学模式的写入合并：距上次写入超过间隔时立即写，否则在间隔结束时统一写一次
+        self._lock = threading.RLock()
+        self._dirty = {"prefs": set(), "patterns": set()}
+        self._last_flush = {"prefs": 0.0, "patterns": 0.0}
+        self._flush_timers: Dict[str, threading.Timer] = {}
+        
+        # 后台写盘线程：调用方只序列化数据快照并入队，文件写入不占用请求耗时
+        self._write_queue: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._writer_loop, name="memory-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
         
         self._load_persistent_memories()
     
+    @cached_property
+    def llm(self) -> ChatOpenAI:
+        """摘要/实体类记忆使用的LLM（首次用到时才创建，默认的窗口记忆不需要）"""
+        return ChatOpenAI(
+            openai_api_key=settings.openai_api_key,
+            openai_api_base=settings.openai_api_base,
+            model_name=settings.llm_model,
+            temperature=0.3
+        )
+    
     def create_conversation_memory(self, user_id: str, 
                                  memory_type: str = "buffer_window",
                                  **kwargs) -> Union[ConversationBufferMemory, 
@@ -120,11 +209,12 @@ class EducationMemoryManager:
                 )
             
             self.conversation_memories[user_id] = memory
-            logger.info(f"为用户 {user_id} 创建了 {memory_type} 类型的对话记忆")
+            self._all_user_ids.add(user_id)
+            logger.info("为用户 %s 创建了 %s 类型的对话记忆", user_id, memory_type)
             return memory
             
         except Exception as e:
-            logger.error(f"创建对话记忆失败: {e}")
+            logger.error("创建对话记忆失败: %s", e)
             # 返回简单的buffer记忆作为fallback
             return ConversationBufferMemory(return_messages=True)
     
@@ -144,32 +234,43 @@ class EducationMemoryManager:
             lesson_plan_data: 教案数据
         """
         try:
-            if user_id not in self.lesson_plan_history:
-                self.lesson_plan_history[user_id] = []
+            _intern_lesson_fields(lesson_plan_data)
             
-            # 添加时间戳和唯一ID
+            # 添加时间戳和唯一ID（两者共用同一个当前时间）
+            now = datetime.now()
             lesson_entry = {
-                "id": self._generate_lesson_id(lesson_plan_data),
-                "timestamp": datetime.now().isoformat(),
+                "id": self._generate_lesson_id(lesson_plan_data, now),
+                "timestamp": now.isoformat(),
                 "data": lesson_plan_data,
                 "usage_count": 1,
                 "rating": None,
                 "feedback": None
             }
             
-            self.lesson_plan_history[user_id].append(lesson_entry)
-            
-            # 保持历史记录在合理范围内（最多100个）
-            if len(self.lesson_plan_history[user_id]) > 100:
-                self.lesson_plan_history[user_id] = self.lesson_plan_history[user_id][-100:]
-            
-            # 持久化保存
-            self._save_lesson_plan_history(user_id)
+            # 追加、索引更新和压缩快照都在锁内进行，与定时写盘、记忆清理互斥
+            with self._lock:
+                if user_id not in self.lesson_plan_history:
+                    self.lesson_plan_history[user_id] = deque(maxlen=_MAX_LESSON_HISTORY)
+                    self._all_user_ids.add(user_id)
+                
+                # 有界队列：超过100个时自动淘汰最旧的记录
+                self.lesson_plan_history[user_id].append(lesson_entry)
+                
+                if user_id in self._plan_index:
+                    self._index_lesson_plan(user_id, lesson_entry)
+                    # 失效序号积累过多时丢弃索引，下次查询时重建
+                    if self._plan_seq[user_id] >= 2 * _MAX_LESSON_HISTORY:
+                        self._drop_plan_index(user_id)
+                
+                # 持久化保存（只追加新条目，文件过长时再压缩）
+                self._append_lesson_plan_jsonl(user_id, lesson_entry)
+                if self._history_file_lines.get(user_id, 0) > 2 * _MAX_LESSON_HISTORY:
+                    self._compact_lesson_plan_history(user_id)
             
-            logger.info(f"为用户 {user_id} 添加了教案历史记录")
+            logger.info("为用户 %s 添加了教案历史记录", user_id)
             
         except Exception as e:
-            logger.error(f"添加教案历史失败: {e}")
+            logger.error("添加教案历史失败: %s", e)
     
     def get_lesson_plan_history(self, user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
         """
@@ -185,14 +286,8 @@ class EducationMemoryManager:
         if user_id not in self.lesson_plan_history:
             return []
         
-        # 按时间倒序返回
-        history = sorted(
-            self.lesson_plan_history[user_id],
-            key=lambda x: x['timestamp'],
-            reverse=True
-        )
-        
-        return history[:limit]
+        # 按时间倒序返回（只取前limit条，无需整体排序）
+        return heapq.nlargest(limit, self.lesson_plan_history[user_id], key=lambda x: x['timestamp'])
     
     def find_similar_lesson_plans(self, user_id: str, current_request: Dict[str, Any], 
                                 limit: int = 5) -> List[Dict[str, Any]]:
@@ -210,42 +305,40 @@ class EducationMemoryManager:
         if user_id not in self.lesson_plan_history:
             return []
         
-        similar_plans = []
         current_subject = current_request.get('subject', '')
         current_grade = current_request.get('grade', '')
         current_topic = current_request.get('topic', '')
+        current_keywords = _topic_keywords(current_topic) if current_topic else frozenset()
         
-        for plan_entry in self.lesson_plan_history[user_id]:
-            plan_data = plan_entry['data']
-            
-            # 计算相似度分数
-            similarity_score = 0
-            
-            # 学科匹配
-            if plan_data.get('subject') == current_subject:
-                similarity_score += 0.4
-            
-            # 年级匹配
-            if plan_data.get('grade') == current_grade:
-                similarity_score += 0.3
-            
-            # 主题相似性（简单的关键词匹配）
-            if current_topic and plan_data.get('topic'):
-                topic_keywords = set(current_topic.split())
-                plan_keywords = set(plan_data.get('topic', '').split())
-                if topic_keywords & plan_keywords:
-                    similarity_score += 0.3
-            
-            # 只返回有一定相似度的教案
-            if similarity_score >= 0.3:
-                plan_entry_with_score = plan_entry.copy()
-                plan_entry_with_score['similarity_score'] = similarity_score
-                similar_plans.append(plan_entry_with_score)
+        # 直接由倒排索引的各个桶得到匹配的条目位置，按数组批量计算相似度，不再逐条比较字符串
+        history = self.lesson_plan_history[user_id]
+        index = self._get_plan_index(user_id)
+        first_seq = self._plan_seq[user_id] - len(history)
+        scores = np.zeros(len(history))
+        
+        # 学科匹配
+        scores[self._plan_positions(index, ("subject", current_subject), first_seq)] += 0.4
+        
+        # 年级匹配
+        scores[self._plan_positions(index, ("grade", current_grade), first_seq)] += 0.3
+        
+        # 主题相似性（任一关键词相同）
+        topic_matched = np.zeros(len(history), dtype=bool)
+        for keyword in current_keywords:
+            topic_matched[self._plan_positions(index, ("topic", keyword), first_seq)] = True
+        scores[topic_matched] += 0.3
         
-        # 按相似度排序
-        similar_plans.sort(key=lambda x: x['similarity_score'], reverse=True)
+        # 只返回有一定相似度的教案，按相似度取前limit个（同分时较早的在前）
+        matched = np.flatnonzero(scores >= 0.3)
+        top = matched[np.argsort(-scores[matched], kind='stable')[:limit]]
         
-        return similar_plans[:limit]
+        similar_plans = []
+        for position in top:
+            plan_entry_with_score = history[int(position)].copy()
+            plan_entry_with_score['similarity_score'] = float(scores[position])
+            similar_plans.append(plan_entry_with_score)
+        
+        return similar_plans
     
     def update_user_preferences(self, user_id: str, preferences: Dict[str, Any]):
         """
@@ -256,20 +349,22 @@ class EducationMemoryManager:
             preferences: 偏好设置
         """
         try:
-            if user_id not in self.user_preferences:
-                self.user_preferences[user_id] = {}
-            
-            # 合并偏好设置
-            self.user_preferences[user_id].update(preferences)
-            self.user_preferences[user_id]['updated_at'] = datetime.now().isoformat()
+            with self._lock:
+                if user_id not in self.user_preferences:
+                    self.user_preferences[user_id] = {}
+                    self._all_user_ids.add(user_id)
+                
+                # 合并偏好设置
+                self.user_preferences[user_id].update(preferences)
+                self.user_preferences[user_id]['updated_at'] = datetime.now().isoformat()
             
             # 持久化保存
-            self._save_user_preferences(user_id)
+            self._mark_dirty("prefs", user_id)
             
-            logger.info(f"更新了用户 {user_id} 的偏好设置")
+            logger.info("更新了用户 %s 的偏好设置", user_id)
             
         except Exception as e:
-            logger.error(f"更新用户偏好失败: {e}")
+            logger.error("更新用户偏好失败: %s", e)
     
     def get_user_preferences(self, user_id: str) -> Dict[str, Any]:
         """获取用户偏好设置"""
@@ -286,59 +381,61 @@ class EducationMemoryManager:
             feedback: 用户反馈
         """
         try:
-            if user_id not in self.teaching_patterns:
-                self.teaching_patterns[user_id] = {
-                    'preferred_methods': {},
-                    'successful_patterns': [],
-                    'subject_preferences': {},
-                    'time_patterns': {}
-                }
-            
-            patterns = self.teaching_patterns[user_id]
-            
-            # 学习偏好的教学方法
-            teaching_methods = lesson_data.get('teaching_methods', [])
-            for method in teaching_methods:
-                if method not in patterns['preferred_methods']:
-                    patterns['preferred_methods'][method] = 0
-                patterns['preferred_methods'][method] += 1
-            
-            # 记录成功的模式（基于反馈）
-            if feedback and feedback.get('rating', 0) >= 4:
-                success_pattern = {
-                    'subject': lesson_data.get('subject'),
-                    'grade': lesson_data.get('grade'),
-                    'methods': teaching_methods,
-                    'duration': lesson_data.get('duration'),
-                    'rating': feedback.get('rating'),
-                    'timestamp': datetime.now().isoformat()
-                }
-                patterns['successful_patterns'].append(success_pattern)
+            with self._lock:
+                if user_id not in self.teaching_patterns:
+                    self._all_user_ids.add(user_id)
+                    self.teaching_patterns[user_id] = {
+                        'preferred_methods': {},
+                        'successful_patterns': deque(maxlen=_MAX_SUCCESSFUL_PATTERNS),
+                        'subject_preferences': {},
+                        'time_patterns': {}
+                    }
+                
+                patterns = self.teaching_patterns[user_id]
+                
+                # 学习偏好的教学方法
+                teaching_methods = [_intern(method) for method in lesson_data.get('teaching_methods', [])]
+                for method in teaching_methods:
+                    if method not in patterns['preferred_methods']:
+                        patterns['preferred_methods'][method] = 0
+                    patterns['preferred_methods'][method] += 1
+                    if user_id in self._method_ranking:
+                        self._promote_method(user_id, method)
                 
-                # 保持成功模式在合理数量内
-                if len(patterns['successful_patterns']) > 50:
-                    patterns['successful_patterns'] = patterns['successful_patterns'][-50:]
-            
-            # 学习学科偏好
-            subject = lesson_data.get('subject')
-            if subject:
-                if subject not in patterns['subject_preferences']:
-                    patterns['subject_preferences'][subject] = {'count': 0, 'avg_rating': 0}
+                # 记录成功的模式（基于反馈）
+                if feedback and feedback.get('rating', 0) >= 4:
+                    success_pattern = {
+                        'subject': _intern(lesson_data.get('subject')),
+                        'grade': _intern(lesson_data.get('grade')),
+                        'methods': teaching_methods,
+                        'duration': lesson_data.get('duration'),
+                        'rating': feedback.get('rating'),
+                        'timestamp': datetime.now().isoformat()
+                    }
+                    # 有界队列：保持成功模式在合理数量内
+                    patterns['successful_patterns'].append(success_pattern)
                 
-                patterns['subject_preferences'][subject]['count'] += 1
-                if feedback and 'rating' in feedback:
-                    current_avg = patterns['subject_preferences'][subject]['avg_rating']
-                    count = patterns['subject_preferences'][subject]['count']
-                    new_avg = (current_avg * (count - 1) + feedback['rating']) / count
-                    patterns['subject_preferences'][subject]['avg_rating'] = new_avg
+                # 学习学科偏好
+                subject = _intern(lesson_data.get('subject'))
+                if subject:
+                    # 只累加次数和评分总和，平均分在读取时计算，避免反复乘除累积误差
+                    subject_pref = patterns['subject_preferences'].setdefault(
+                        subject, {'count': 0, 'rating_sum': 0, 'rating_count': 0}
+                    )
+                    subject_pref['count'] += 1
+                    if feedback and 'rating' in feedback:
+                        subject_pref['rating_sum'] += feedback['rating']
+                        subject_pref['rating_count'] += 1
+                
+                self._rec_cache_gen[user_id] = self._rec_cache_gen.get(user_id, 0) + 1
             
             # 持久化保存
-            self._save_teaching_patterns(user_id)
+            self._mark_dirty("patterns", user_id)
             
-            logger.info(f"为用户 {user_id} 学习了教学模式")
+            logger.info("为用户 %s 学习了教学模式", user_id)
             
         except Exception as e:
-            logger.error(f"学习教学模式失败: {e}")
+            logger.error("学习教学模式失败: %s", e)
     
     def get_teaching_recommendations(self, user_id: str, 
                                    current_request: Dict[str, Any]) -> Dict[str, Any]:
@@ -355,26 +452,24 @@ class EducationMemoryManager:
         if user_id not in self.teaching_patterns:
             return {}
         
+        subject = current_request.get('subject')
+        grade = current_request.get('grade')
+        cache_key = (user_id, subject, grade)
+        generation = self._rec_cache_gen.get(user_id, 0)
+        cached = self._rec_cache.get(cache_key)
+        if cached is not None and cached[0] == generation:
+            return dict(cached[1])
+        
         patterns = self.teaching_patterns[user_id]
         recommendations = {}
         
         try:
             # 推荐教学方法
-            preferred_methods = patterns.get('preferred_methods', {})
-            if preferred_methods:
-                sorted_methods = sorted(
-                    preferred_methods.items(),
-                    key=lambda x: x[1],
-                    reverse=True
-                )
-                recommendations['preferred_teaching_methods'] = [
-                    method for method, count in sorted_methods[:5]
-                ]
+            if patterns.get('preferred_methods'):
+                recommendations['preferred_teaching_methods'] = self._get_method_ranking(user_id)[:5]
             
             # 基于成功模式的建议
             successful_patterns = patterns.get('successful_patterns', [])
-            subject = current_request.get('subject')
-            grade = current_request.get('grade')
             
             relevant_patterns = [
                 p for p in successful_patterns
@@ -390,12 +485,18 @@ class EducationMemoryManager:
             # 学科特定建议
             subject_prefs = patterns.get('subject_preferences', {})
             if subject in subject_prefs:
-                recommendations['subject_expertise'] = subject_prefs[subject]
+                subject_pref = subject_prefs[subject]
+                rating_count = subject_pref.get('rating_count', 0)
+                recommendations['subject_expertise'] = {
+                    'count': subject_pref['count'],
+                    'avg_rating': subject_pref['rating_sum'] / rating_count if rating_count else 0
+                }
             
-            return recommendations
+            self._rec_cache[cache_key] = (generation, recommendations)
+            return dict(recommendations)
             
         except Exception as e:
-            logger.error(f"获取教学建议失败: {e}")
+            logger.error("获取教学建议失败: %s", e)
             return {}
     
     def cleanup_old_memories(self, days_to_keep: int = 30):
@@ -407,100 +508,319 @@ class EducationMemoryManager:
         """
         try:
             cutoff_date = datetime.now() - timedelta(days=days_to_keep)
-            
-            # 清理教案历史
-            for user_id in self.lesson_plan_history:
-                original_count = len(self.lesson_plan_history[user_id])
-                self.lesson_plan_history[user_id] = [
-                    entry for entry in self.lesson_plan_history[user_id]
-                    if datetime.fromisoformat(entry['timestamp']) > cutoff_date
-                ]
-                cleaned_count = original_count - len(self.lesson_plan_history[user_id])
-                if cleaned_count > 0:
-                    logger.info(f"为用户 {user_id} 清理了 {cleaned_count} 条教案历史")
-            
-            # 清理对话历史文件
-            for history_file in self.memory_dir.glob("chat_history_*.json"):
-                try:
-                    if history_file.stat().st_mtime < cutoff_date.timestamp():
-                        history_file.unlink()
-                        logger.info(f"删除了过期的对话历史文件: {history_file.name}")
-                except Exception:
-                    continue
-            
-            logger.info(f"记忆清理完成，保留了最近 {days_to_keep} 天的数据")
+            cutoff_iso = cutoff_date.isoformat()
+            
+            # 清理教案历史：条目按时间顺序追加，只需从队首移除过期条目
+            # （ISO格式时间戳的字典序即时间先后，无需逐条解析）
+            with self._lock:
+                for user_id, history in self.lesson_plan_history.items():
+                    cleaned_count = 0
+                    while history and history[0]['timestamp'] <= cutoff_iso:
+                        history.popleft()
+                        cleaned_count += 1
+                    if cleaned_count > 0:
+                        self._compact_lesson_plan_history(user_id)
+                        logger.info("为用户 %s 清理了 %s 条教案历史", user_id, cleaned_count)
+            
+            # 清理对话历史文件（scandir的目录项自带文件信息，无需为每个文件单独构造Path）
+            cutoff_ts = cutoff_date.timestamp()
+            with os.scandir(self.memory_dir) as entries:
+                for entry in entries:
+                    if not (entry.name.startswith("chat_history_") and entry.name.endswith(".json")):
+                        continue
+                    try:
+                        if entry.stat().st_mtime < cutoff_ts:
+                            os.unlink(entry.path)
+                            logger.info("删除了过期的对话历史文件: %s", entry.name)
+                    except Exception:
+                        continue
+            
+            # 丢弃教学建议缓存，之后按需重新计算
+            self._rec_cache.clear()
+            
+            self.flush()
+            logger.info("记忆清理完成，保留了最近 %s 天的数据", days_to_keep)
             
         except Exception as e:
-            logger.error(f"清理记忆数据失败: {e}")
+            logger.error("清理记忆数据失败: %s", e)
     
-    def _generate_lesson_id(self, lesson_data: Dict[str, Any]) -> str:
-        """生成教案唯一ID"""
-        content = f"{lesson_data.get('subject', '')}{lesson_data.get('grade', '')}{lesson_data.get('topic', '')}{datetime.now().date()}"
-        return hashlib.md5(content.encode()).hexdigest()[:12]
+    def _generate_lesson_id(self, lesson_data: Dict[str, Any], now: Optional[datetime] = None) -> str:
+        """生成教案唯一ID（各字段分别编码后直接送入哈希，不再拼接中间字符串）"""
+        digest = hashlib.blake2b(digest_size=6)
+        for key in ('subject', 'grade', 'topic'):
+            digest.update(str(lesson_data.get(key, '')).encode('utf-8'))
+        digest.update((now or datetime.now()).date().isoformat().encode('ascii'))
+        return digest.hexdigest()
     
     def _load_persistent_memories(self):
         """加载持久化的记忆数据"""
         try:
-            # 加载教案历史
-            history_file = self.memory_dir / "lesson_plan_history.json"
-            if history_file.exists():
+            # 加载教案历史（每个用户一个JSONL文件）
+            for history_file in self.memory_dir.glob("lesson_plan_history_*.jsonl"):
+                user_id = history_file.stem[len("lesson_plan_history_"):]
+                entries = []
+                corrupted = False
                 with open(history_file, 'r', encoding='utf-8') as f:
-                    self.lesson_plan_history = json.load(f)
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        try:
+                            entry = _loads(line)
+                        except json.JSONDecodeError:
+                            # 写入中断留下的不完整行
+                            corrupted = True
+                            continue
+                        _intern_lesson_fields(entry.get('data', {}))
+                        entries.append(entry)
+                self.lesson_plan_history[user_id] = deque(entries, maxlen=_MAX_LESSON_HISTORY)
+                self._history_file_lines[user_id] = len(entries)
+                if corrupted:
+                    logger.warning("跳过损坏的教案历史记录并重写文件: %s", history_file.name)
+                    self._compact_lesson_plan_history(user_id)
+            
+            # 兼容旧版的单文件JSON格式，迁移为JSONL
+            legacy_file = self.memory_dir / "lesson_plan_history.json"
+            if legacy_file.exists():
+                for user_id, entries in self._iter_legacy_lesson_history(legacy_file):
+                    if user_id not in self.lesson_plan_history:
+                        for entry in entries:
+                            _intern_lesson_fields(entry.get('data', {}))
+                        self.lesson_plan_history[user_id] = deque(entries, maxlen=_MAX_LESSON_HISTORY)
+                        self._compact_lesson_plan_history(user_id)
             
             # 加载用户偏好
             prefs_file = self.memory_dir / "user_preferences.json"
             if prefs_file.exists():
                 with open(prefs_file, 'r', encoding='utf-8') as f:
-                    self.user_preferences = json.load(f)
+                    self.user_preferences = _loads(f.read())
             
             # 加载教学模式
             patterns_file = self.memory_dir / "teaching_patterns.json"
             if patterns_file.exists():
                 with open(patterns_file, 'r', encoding='utf-8') as f:
-                    self.teaching_patterns = json.load(f)
-            
+                    self.teaching_patterns = _loads(f.read())
+                for patterns in self.teaching_patterns.values():
+                    patterns['preferred_methods'] = {
+                        _intern(method): count for method, count in patterns.get('preferred_methods', {}).items()
+                    }
+                    patterns['subject_preferences'] = {
+                        _intern(subject): pref for subject, pref in patterns.get('subject_preferences', {}).items()
+                    }
+                    for pattern in patterns.get('successful_patterns', []):
+                        _intern_lesson_fields(pattern)
+                        pattern['methods'] = [_intern(method) for method in pattern.get('methods', [])]
+                    patterns['successful_patterns'] = deque(
+                        patterns.get('successful_patterns', []), maxlen=_MAX_SUCCESSFUL_PATTERNS
+                    )
+                    # 旧格式只保存了平均分，按全部次数折算为评分总和
+                    for subject_pref in patterns.get('subject_preferences', {}).values():
+                        if 'avg_rating' in subject_pref:
+                            avg_rating = subject_pref.pop('avg_rating')
+                            subject_pref['rating_count'] = subject_pref['count'] if avg_rating else 0
+                            subject_pref['rating_sum'] = round(avg_rating * subject_pref['rating_count'])
+            
+            self._all_user_ids.update(self.lesson_plan_history, self.user_preferences, self.teaching_patterns)
             logger.info("持久化记忆数据加载完成")
             
         except Exception as e:
-            logger.error(f"加载持久化记忆失败: {e}")
+            logger.error("加载持久化记忆失败: %s", e)
+    
+    @staticmethod
+    def _iter_legacy_lesson_history(legacy_file: Path):
+        """
+        逐个用户读取旧版单文件教案历史
+        
+        安装了ijson时流式解析，内存中只保留当前用户的条目，不再整体载入整个文件
+        """
+        if ijson is None:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                yield from _loads(f.read()).items()
+            return
+        with open(legacy_file, 'rb') as f:
+            # use_float避免数值被解析为Decimal，与json模块的结果保持一致
+            yield from ijson.kvitems(f, '', use_float=True)
+    
+    @staticmethod
+    def _plan_features(plan_data: Dict[str, Any]) -> set:
+        """教案的索引特征：学科、年级和主题关键词"""
+        features = {("subject", plan_data.get('subject')), ("grade", plan_data.get('grade'))}
+        features.update(("topic", keyword) for keyword in _topic_keywords(plan_data.get('topic') or ''))
+        return features
+    
+    def _index_lesson_plan(self, user_id: str, entry: Dict[str, Any]):
+        """将一条教案历史加入倒排索引"""
+        index = self._plan_index.setdefault(user_id, {})
+        seq = self._plan_seq.get(user_id, 0)
+        for feature in self._plan_features(entry['data']):
+            index.setdefault(feature, []).append(seq)
+        self._plan_seq[user_id] = seq + 1
+    
+    def _get_plan_index(self, user_id: str) -> Dict[tuple, List[int]]:
+        """获取用户的倒排索引，不存在时由当前历史重建"""
+        if user_id not in self._plan_index:
+            self._plan_index[user_id] = {}
+            self._plan_seq[user_id] = 0
+            for entry in self.lesson_plan_history.get(user_id, []):
+                self._index_lesson_plan(user_id, entry)
+        return self._plan_index[user_id]
+    
+    @staticmethod
+    def _plan_positions(index: Dict[tuple, List[int]], feature: tuple, first_seq: int) -> np.ndarray:
+        """某个特征的桶中仍在历史里的条目位置"""
+        seqs = np.asarray(index.get(feature, ()), dtype=np.int64)
+        return seqs[seqs >= first_seq] - first_seq
+    
+    def _drop_plan_index(self, user_id: str):
+        """丢弃用户的倒排索引（历史被非追加方式修改后调用）"""
+        self._plan_index.pop(user_id, None)
+        self._plan_seq.pop(user_id, None)
+    
+    def _get_method_ranking(self, user_id: str) -> List[str]:
+        """获取用户按使用次数排列的教学方法，不存在时由教学模式重建"""
+        if user_id not in self._method_ranking:
+            preferred_methods = self.teaching_patterns[user_id].get('preferred_methods', {})
+            self._method_order[user_id] = {method: i for i, method in enumerate(preferred_methods)}
+            self._method_ranking[user_id] = sorted(
+                preferred_methods, key=lambda method: preferred_methods[method], reverse=True
+            )
+        return self._method_ranking[user_id]
+    
+    def _promote_method(self, user_id: str, method: str):
+        """教学方法次数加一后，将其前移到排名中的正确位置"""
+        ranking = self._method_ranking[user_id]
+        order = self._method_order[user_id]
+        counts = self.teaching_patterns[user_id]['preferred_methods']
+        if method not in order:
+            order[method] = len(order)
+            ranking.append(method)
+        position = len(ranking) - 1 if ranking[-1] == method else ranking.index(method)
+        count = counts[method]
+        while position > 0:
+            previous = ranking[position - 1]
+            if counts[previous] > count or (counts[previous] == count and order[previous] < order[method]):
+                break
+            ranking[position] = previous
+            position -= 1
+        ranking[position] = method
+    
+    def _lesson_history_file(self, user_id: str) -> Path:
+        """用户教案历史的JSONL文件路径"""
+        return self.memory_dir / f"lesson_plan_history_{user_id}.jsonl"
+    
+    def _writer_loop(self):
+        """后台线程：按入队顺序执行文件写入"""
+        while True:
+            path, text, append, error_message = self._write_queue.get()
+            try:
+                if append:
+                    with open(path, 'a', encoding='utf-8') as f:
+                        f.write(text)
+                else:
+                    # 先写临时文件再替换，写入中断时不会留下半个文件
+                    tmp_file = path.with_name(path.name + ".tmp")
+                    with open(tmp_file, 'w', encoding='utf-8') as f:
+                        f.write(text)
+                    tmp_file.replace(path)
+            except Exception as e:
+                logger.error("%s: %s", error_message, e)
+            finally:
+                self._write_queue.task_done()
+    
+    def _enqueue_write(self, path: Path, text: str, append: bool, error_message: str):
+        """将文件写入交给后台线程"""
+        self._write_queue.put((path, text, append, error_message))
+    
+    def _append_lesson_plan_jsonl(self, user_id: str, entry: Dict[str, Any]):
+        """追加一条教案历史（写入量与历史总长度无关）"""
+        try:
+            self._enqueue_write(self._lesson_history_file(user_id), _dumps(entry) + "\n",
+                                append=True, error_message="保存教案历史失败")
+            self._history_file_lines[user_id] = self._history_file_lines.get(user_id, 0) + 1
+        except Exception as e:
+            logger.error("保存教案历史失败: %s", e)
     
-    def _save_lesson_plan_history(self, user_id: str):
-        """保存教案历史"""
+    def _compact_lesson_plan_history(self, user_id: str):
+        """用内存中保留的教案历史重写JSONL文件，丢弃已被截断或清理的条目"""
         try:
-            history_file = self.memory_dir / "lesson_plan_history.json"
-            with open(history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.lesson_plan_history, f, ensure_ascii=False, indent=2)
+            # 在锁内生成快照，避免序列化过程中其他线程追加或清理条目
+            with self._lock:
+                entries = self.lesson_plan_history.get(user_id, [])
+                text = "".join(_dumps(entry) + "\n" for entry in entries)
+                self._enqueue_write(self._lesson_history_file(user_id), text,
+                                    append=False, error_message="压缩教案历史失败")
+                self._history_file_lines[user_id] = len(entries)
         except Exception as e:
-            logger.error(f"保存教案历史失败: {e}")
+            logger.error("压缩教案历史失败: %s", e)
+    
+    def _mark_dirty(self, kind: str, user_id: str):
+        """
+        标记需要写盘的数据（RStudio式的写入合并）
+        
+        距上次写入已超过间隔时立即写入，否则只在间隔结束时写一次，
+        把一段时间内的多次修改合并为一次整文件写入
+        
+        Args:
+            kind: "prefs"（用户偏好）或 "patterns"（教学模式）
+            user_id: 用户ID
+        """
+        with self._lock:
+            self._dirty[kind].add(user_id)
+            wait = settings.memory_flush_interval - (time.monotonic() - self._last_flush[kind])
+            if wait <= 0:
+                self._flush_kind(kind)
+            elif kind not in self._flush_timers:
+                timer = threading.Timer(wait, self._flush_kind, args=(kind,))
+                timer.daemon = True
+                self._flush_timers[kind] = timer
+                timer.start()
     
-    def _save_user_preferences(self, user_id: str):
-        """保存用户偏好"""
+    def _flush_kind(self, kind: str):
+        """写入一类有改动的数据"""
+        with self._lock:
+            self._flush_timers.pop(kind, None)
+            if not self._dirty[kind]:
+                return
+            self._dirty[kind].clear()
+            self._last_flush[kind] = time.monotonic()
+            if kind == "prefs":
+                self._save_user_preferences()
+            else:
+                self._save_teaching_patterns()
+    
+    def flush(self):
+        """立即写入所有尚未写盘的数据，并等待后台写入完成（进程退出时自动调用）"""
+        with self._lock:
+            for timer in self._flush_timers.values():
+                timer.cancel()
+            for kind in self._dirty:
+                self._flush_kind(kind)
+        self._write_queue.join()
+    
+    def _save_user_preferences(self, user_id: str = None):
+        """保存用户偏好（在锁内生成快照，由后台线程写入）"""
         try:
-            prefs_file = self.memory_dir / "user_preferences.json"
-            with open(prefs_file, 'w', encoding='utf-8') as f:
-                json.dump(self.user_preferences, f, ensure_ascii=False, indent=2)
+            with self._lock:
+                text = _dumps(self.user_preferences)
+            self._enqueue_write(self.memory_dir / "user_preferences.json", text,
+                                append=False, error_message="保存用户偏好失败")
         except Exception as e:
-            logger.error(f"保存用户偏好失败: {e}")
+            logger.error("保存用户偏好失败: %s", e)
     
-    def _save_teaching_patterns(self, user_id: str):
-        """保存教学模式"""
+    def _save_teaching_patterns(self, user_id: str = None):
+        """保存教学模式（在锁内生成快照，由后台线程写入）"""
         try:
-            patterns_file = self.memory_dir / "teaching_patterns.json"
-            with open(patterns_file, 'w', encoding='utf-8') as f:
-                json.dump(self.teaching_patterns, f, ensure_ascii=False, indent=2)
+            with self._lock:
+                text = _dumps(self.teaching_patterns)
+            self._enqueue_write(self.memory_dir / "teaching_patterns.json", text,
+                                append=False, error_message="保存教学模式失败")
         except Exception as e:
-            logger.error(f"保存教学模式失败: {e}")
+            logger.error("保存教学模式失败: %s", e)
     
     def get_memory_stats(self) -> Dict[str, Any]:
         """获取记忆统计信息"""
         try:
             stats = {
-                "total_users": len(set(
-                    list(self.conversation_memories.keys()) +
-                    list(self.lesson_plan_history.keys()) +
-                    list(self.user_preferences.keys()) +
-                    list(self.teaching_patterns.keys())
-                )),
+                "total_users": len(self._all_user_ids),
                 "conversation_memories": len(self.conversation_memories),
                 "lesson_plan_histories": len(self.lesson_plan_history),
                 "user_preferences": len(self.user_preferences),
@@ -514,7 +834,7 @@ class EducationMemoryManager:
             return stats
             
         except Exception as e:
-            logger.error(f"获取记忆统计失败: {e}")
+            logger.error("获取记忆统计失败: %s", e)
             return {}
 
 # 创建全局实例
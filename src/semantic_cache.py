@@ -0,0 +1,114 @@
+"""
+语义缓存模块
+按查询向量的余弦相似度复用已有结果，避免重复的检索与模型调用
+"""
+import threading
+import time
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+
+
+class SemanticCache:
+    """基于向量相似度的结果缓存（LRU淘汰 + TTL过期）"""
+    
+    def __init__(self, threshold: float = 0.92, max_size: int = 1024,
+                 ttl_seconds: float = 600):
+        """
+        初始化语义缓存
+        
+        Args:
+            threshold: 命中所需的最小余弦相似度
+            max_size: 最多缓存的条目数
+            ttl_seconds: 条目有效期（秒）
+        """
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        
+        # 向量按行存放在同一个矩阵中，一次矩阵-向量乘法即可完成全部比较
+        self._matrix: Optional[np.ndarray] = None
+        self._created_at = np.zeros(max_size, dtype=np.float64)
+        self._last_used = np.zeros(max_size, dtype=np.float64)
+        self._scopes: List[Any] = [None] * max_size
+        self._values: List[Any] = [None] * max_size
+        self._size = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        """L2归一化，使点积即为余弦相似度"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def lookup(self, embedding: Sequence[float], scope: Any = None) -> Optional[Any]:
+        """
+        查找与给定向量足够相似的缓存结果
+        
+        Args:
+            embedding: 查询向量
+            scope: 附加的精确匹配条件（如top_k、过滤条件），不同scope的条目互不命中
+            
+        Returns:
+            命中的缓存结果，未命中返回None
+        """
+        query = self._normalize(embedding)
+        
+        with self._lock:
+            if self._size == 0 or self._matrix.shape[1] != query.shape[0]:
+                return None
+            
+            now = time.monotonic()
+            scores = self._matrix[:self._size] @ query
+            expired = now - self._created_at[:self._size] > self.ttl_seconds
+            scores[expired] = -np.inf
+            for i in np.flatnonzero(scores >= self.threshold):
+                if self._scopes[i] != scope:
+                    scores[i] = -np.inf
+            
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            
+            self._last_used[best] = now
+            return self._values[best]
+    
+    def insert(self, embedding: Sequence[float], value: Any, scope: Any = None):
+        """
+        写入缓存，容量已满时淘汰最久未使用的条目
+        
+        Args:
+            embedding: 查询向量
+            value: 要缓存的结果
+            scope: 附加的精确匹配条件
+        """
+        vector = self._normalize(embedding)
+        
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+                self._matrix = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+                self._size = 0
+            
+            if self._size < self.max_size:
+                slot = self._size
+                self._size += 1
+            else:
+                slot = int(np.argmin(self._last_used))
+            
+            now = time.monotonic()
+            self._matrix[slot] = vector
+            self._created_at[slot] = now
+            self._last_used[slot] = now
+            self._scopes[slot] = scope
+            self._values[slot] = value
+    
+    def clear(self):
+        """清空缓存（底层数据变化后调用）"""
+        with self._lock:
+            self._size = 0
+            self._scopes = [None] * self.max_size
+            self._values = [None] * self.max_size
+    
+    def __len__(self) -> int:
+        return self._size
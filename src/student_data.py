@@ -4,32 +4,361 @@
 """
 import logging
 import asyncio
-from typing import Dict, List, Any, Optional
-from datetime import datetime, timedelta
+import copy
+import itertools
+import sys
+import time
+from functools import lru_cache
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
 import httpx
-import aiohttp
-import pandas as pd
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 from config import settings
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志级别和输出由应用入口配置，导入本模块不修改全局日志设置
 logger = logging.getLogger(__name__)
 
+# 批量查询学生学习状态时每个请求包含的学生数，避免超长URL和单次长耗时请求
+_STATUS_CHUNK_SIZE = 50
+
+# 知识薄弱点达到该数量时用NumPy批量比较掌握率（数量少时数组构建开销反而更大）
+_VECTORIZE_MIN_GAPS = 16
+
+# 掌握率低于该值的知识点需要优先教学，低于紧急阈值时为高紧急度
+_PRIORITY_MASTERY = 0.5
+_URGENT_MASTERY = 0.4
+
+# 查询参数中的本地时间格式（整秒时与datetime.isoformat()的输出一致）
+_ISO_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+if njit is not None:
+    @njit(cache=True)
+    def _mastery_levels_kernel(rates, urgent_threshold, priority_threshold):
+        """一次遍历得到每个知识点的优先级：2=高紧急度，1=优先教学，0=无需优先"""
+        levels = np.empty(rates.size, dtype=np.int8)
+        for i in range(rates.size):
+            if rates[i] < urgent_threshold:
+                levels[i] = 2
+            elif rates[i] < priority_threshold:
+                levels[i] = 1
+            else:
+                levels[i] = 0
+        return levels
+
+def _mastery_levels(rates: np.ndarray) -> np.ndarray:
+    """
+    知识点优先级数组（2=高紧急度，1=优先教学，0=无需优先）
+    
+    安装了numba时使用编译后的单次遍历（首次调用时编译并缓存到磁盘），否则用两次NumPy比较
+    """
+    if njit is not None:
+        return _mastery_levels_kernel(rates, _URGENT_MASTERY, _PRIORITY_MASTERY)
+    return (rates < _PRIORITY_MASTERY).astype(np.int8) + (rates < _URGENT_MASTERY)
+
+def _trends_to_columns(trends: Any) -> Dict[str, list]:
+    """
+    将成绩趋势转为按列存储（{"week": [...], "score": [...]}）
+    
+    按列的数据可直接用np.asarray批量计算或绘图，且仍可直接序列化为JSON
+    """
+    if isinstance(trends, dict):
+        return trends
+    return {
+        "week": [point.get("week") for point in trends],
+        "score": [point.get("score") for point in trends]
+    }
+
+def _response_json(response: httpx.Response) -> Any:
+    """解析响应中的JSON（安装了orjson时直接解析响应字节）"""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+# 模拟数据中按学科区分的薄弱/擅长领域：学科 -> (薄弱领域, 擅长领域)
+_MOCK_SUBJECT_AREAS = {
+    "数学": (("几何证明", "应用题"), ("计算", "代数")),
+}
+_MOCK_DEFAULT_AREAS = (("阅读理解", "作文"), ("基础知识", "文言文"))
+
+def _intern(value: Any) -> Any:
+    """驻留水平、学习风格、动机等取值有限的标签，相同内容的标签共用一个对象"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+# 模拟学生依次轮换的学习风格、水平、注意力时长（分钟）和学习动机
+# （标签与接口返回的数据驻留为同一批对象）
+_MOCK_LEARNING_STYLES = tuple(map(_intern, ("视觉型", "听觉型", "动手型", "阅读型")))
+_MOCK_LEVELS = tuple(map(_intern, ("优秀", "良好", "中等", "待提高")))
+_MOCK_ATTENTION_SPANS = (15, 25, 35)
+_MOCK_MOTIVATIONS = tuple(map(_intern, ("高", "中等", "较低")))
+
+# 模拟数据是参数的纯函数，按参数缓存生成结果，重复调用时不再重新构建
+# （列表字段使用元组，调用方拿到的是外层容器的拷贝）
+
+@lru_cache(maxsize=256)
+def _mock_class_performance(class_id: str, subject: str) -> Dict[str, Any]:
+    """模拟班级表现数据"""
+    return {
+        "class_id": class_id,
+        "subject": subject,
+        "average_score": 76.5,
+        "pass_rate": 0.85,
+        "excellence_rate": 0.32,
+        "difficulty_distribution": {
+            "基础题": 0.78,
+            "中等题": 0.65,
+            "难题": 0.42
+        },
+        "common_mistakes": (
+            "计算错误较多",
+            "理解题意不准确",
+            "解题步骤不完整"
+        ),
+        "improvement_trends": {
+            "week": (1, 2, 3),
+            "score": (72.0, 74.5, 76.5)
+        }
+    }
+
+@lru_cache(maxsize=256)
+def _mock_student_status(student_ids: tuple, subject: str) -> tuple:
+    """模拟学生状态数据"""
+    weak_areas, strong_areas = _MOCK_SUBJECT_AREAS.get(subject, _MOCK_DEFAULT_AREAS)
+    rotations = zip(
+        itertools.cycle(_MOCK_LEVELS),
+        itertools.cycle(_MOCK_LEARNING_STYLES),
+        itertools.cycle(_MOCK_ATTENTION_SPANS),
+        itertools.cycle(_MOCK_MOTIVATIONS)
+    )
+    
+    return tuple(
+        {
+            "student_id": student_id,
+            "name": f"学生{i}",
+            "current_level": level,
+            "learning_style": learning_style,
+            "weak_areas": weak_areas,
+            "strong_areas": strong_areas,
+            "attention_span": attention_span,
+            "motivation_level": motivation
+        }
+        for i, (student_id, (level, learning_style, attention_span, motivation))
+        in enumerate(zip(student_ids, rotations), start=1)
+    )
+
+@lru_cache(maxsize=256)
+def _mock_knowledge_gaps(subject: str) -> tuple:
+    """模拟知识薄弱点数据"""
+    if subject == "数学":
+        return (
+            {
+                "knowledge_point": "二次函数",
+                "mastery_rate": 0.45,
+                "difficulty_level": "较难",
+                "prerequisite_skills": ("一次函数", "代数运算"),
+                "common_errors": ("顶点坐标计算错误", "图像性质理解不清"),
+                "recommended_practice": ("多做图像题", "加强基础运算")
+            },
+            {
+                "knowledge_point": "几何证明",
+                "mastery_rate": 0.38,
+                "difficulty_level": "难",
+                "prerequisite_skills": ("几何基本概念", "逻辑推理"),
+                "common_errors": ("证明步骤不严谨", "定理应用错误"),
+                "recommended_practice": ("模仿例题", "逐步分析")
+            }
+        )
+    else:
+        return (
+            {
+                "knowledge_point": "阅读理解",
+                "mastery_rate": 0.52,
+                "difficulty_level": "中等",
+                "prerequisite_skills": ("词汇量", "语法基础"),
+                "common_errors": ("理解偏差", "答题不完整"),
+                "recommended_practice": ("多读多练", "归纳总结")
+            },
+        )
+
 class StudentDataManager:
-    """学生数据管理类"""
+    """
+    学生数据管理类
     
-    def __init__(self):
-        """初始化学生数据管理器"""
+    pool_size 控制到MCP服务的HTTP连接池大小（同时也是保持的长连接数）：
+    MCP服务规模较小时调小，避免连接反复建立和大量TIME_WAIT；
+    批量查询等突发并发较高时调大，避免请求排队等待空闲连接
+    """
+    
+    def __init__(self, pool_size: Optional[int] = None):
+        """
+        初始化学生数据管理器
+        
+        Args:
+            pool_size: HTTP连接池大小，默认使用配置中的 mcp_pool_size
+        """
+        self.pool_size = pool_size or settings.mcp_pool_size
         self.mcp_database_url = settings.mcp_database_url
         self.mcp_api_key = settings.mcp_api_key
         self.headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.mcp_api_key}" if self.mcp_api_key else ""
         }
+        
+        # 各接口的完整URL只解析一次（未配置MCP服务时不会发出请求）
+        if self.mcp_database_url:
+            base_url = self.mcp_database_url.rstrip("/")
+            self._class_performance_url = httpx.URL(f"{base_url}/api/class-performance")
+            self._student_status_url = httpx.URL(f"{base_url}/api/student-status")
+            self._knowledge_gaps_url = httpx.URL(f"{base_url}/api/knowledge-gaps")
+        
+        # 所有MCP请求共享一个HTTP客户端，复用长连接（首次请求时创建）
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None  # 限制并发请求数不超过连接池大小
+        
+        # 班级表现和知识薄弱点的TTL缓存：key -> (获取时间, 处理后的数据)
+        self._cache: Dict[tuple, tuple] = {}
+        
+        # 正在进行中的MCP请求：key -> 请求任务，相同请求并发到达时共用同一个任务
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._inflight_loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        # 班级表现查询的起止时间字符串：(当前分钟, 天数) -> (开始时间, 结束时间)
+        self._date_cache: Dict[tuple, tuple] = {}
+    
+    async def _get_client(self) -> httpx.AsyncClient:
+        """
+        获取共享的HTTP客户端，客户端已关闭或事件循环已更换（如多次asyncio.run）时重新创建，
+        并关闭被替换的旧客户端，避免每换一次事件循环就遗留一个连接池
+        """
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._client_loop is not loop:
+            stale = self._client
+            self._client = httpx.AsyncClient(
+                headers=self.headers,
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size
+                ),
+                timeout=10.0
+            )
+            self._client_loop = loop
+            self._semaphore = asyncio.Semaphore(self.pool_size)
+            if stale is not None and not stale.is_closed:
+                try:
+                    await stale.aclose()
+                except Exception as e:
+                    # 所属事件循环已关闭时连接无法正常关闭，释放引用后由套接字析构关闭
+                    logger.debug("关闭旧事件循环的HTTP客户端失败: %s", e)
+        return self._client
+    
+    async def close(self):
+        """关闭共享的HTTP客户端，释放连接池"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        self._client_loop = None
+    
+    async def _cached(self, key: tuple, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        TTL缓存：有效期内直接返回上次成功获取的数据
+        
+        Args:
+            key: 缓存键
+            fetch: 未命中时调用的协程函数，返回None表示获取失败（不缓存）
+            
+        Returns:
+            数据的浅拷贝，调用方修改不会影响缓存
+        """
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] <= settings.mcp_cache_ttl:
+            return copy.copy(cached[1])
+        
+        async def fetch_and_store():
+            value = await fetch()
+            if value is not None:
+                now = time.monotonic()
+                self._cache = {
+                    cache_key: entry for cache_key, entry in self._cache.items()
+                    if now - entry[0] <= settings.mcp_cache_ttl
+                }
+                self._cache[key] = (now, value)
+            return value
+        
+        value = await self._single_flight(key, fetch_and_store)
+        return copy.copy(value) if value is not None else None
+    
+    async def _single_flight(self, key: tuple, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        合并相同的并发请求：同一key已有请求在进行中时等待其结果，不再重复请求
+        
+        Args:
+            key: 请求标识
+            fetch: 没有进行中的请求时调用的协程函数
+            
+        Returns:
+            fetch的结果（并发调用方共享同一个结果对象）
+        """
+        loop = asyncio.get_running_loop()
+        if self._inflight_loop is not loop:
+            self._inflight = {}
+            self._inflight_loop = loop
+        
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            
+            def forget(done_task, key=key):
+                if self._inflight.get(key) is done_task:
+                    del self._inflight[key]
+            task.add_done_callback(forget)
+        
+        # shield：某个调用方被取消时不影响其他仍在等待的调用方
+        return await asyncio.shield(task)
+    
+    def _date_range(self, time_range: int) -> tuple:
+        """最近time_range天的起止时间（结束时间取整到分钟，同一分钟内的查询复用同一组字符串）"""
+        minute = int(time.time() // 60)
+        key = (minute, time_range)
+        dates = self._date_cache.get(key)
+        if dates is None:
+            if len(self._date_cache) >= 32:
+                self._date_cache.clear()
+            end = minute * 60
+            dates = (
+                time.strftime(_ISO_FORMAT, time.localtime(end - time_range * 86400)),
+                time.strftime(_ISO_FORMAT, time.localtime(end))
+            )
+            self._date_cache[key] = dates
+        return dates
+    
+    async def _fetch(self, url: httpx.URL, params: Dict[str, Any],
+                     process: Callable[[Any], Any]) -> Any:
+        """请求MCP接口并处理返回数据，服务返回错误时返回None"""
+        client = await self._get_client()
+        response = await client.get(url, params=params)
+        if response.status_code != 200:
+            return None
+        return process(_response_json(response))
     
     async def get_class_performance(self, class_id: str, subject: str, 
-                                  time_range: int = 30) -> Dict[str, Any]:
+                                  time_range: int = 30,
+                                  use_mock: bool = True) -> Optional[Dict[str, Any]]:
         """
         获取班级学科表现数据
         
@@ -37,40 +366,37 @@ class StudentDataManager:
             class_id: 班级ID
             subject: 学科名称
             time_range: 时间范围（天数）
+            use_mock: MCP服务不可用时是否返回模拟数据（为False时返回None）
             
         Returns:
             班级表现数据字典
         """
         try:
             # 构建查询参数
-            end_date = datetime.now()
-            start_date = end_date - timedelta(days=time_range)
+            start_date, end_date = self._date_range(time_range)
             
             params = {
                 "class_id": class_id,
                 "subject": subject,
-                "start_date": start_date.isoformat(),
-                "end_date": end_date.isoformat()
+                "start_date": start_date,
+                "end_date": end_date
             }
             
             # 模拟MCP服务调用 - 实际使用时需要替换为真实的MCP接口
             if self.mcp_database_url:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                        f"{self.mcp_database_url}/api/class-performance",
-                        params=params,
-                        headers=self.headers
-                    ) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            return self._process_class_performance(data)
+                performance = await self._cached(
+                    ("class-performance", class_id, subject, time_range),
+                    lambda: self._fetch(self._class_performance_url, params, self._process_class_performance)
+                )
+                if performance is not None:
+                    return performance
             
             # 如果MCP服务不可用，返回模拟数据
-            return self._generate_mock_class_performance(class_id, subject)
+            return self._generate_mock_class_performance(class_id, subject) if use_mock else None
             
         except Exception as e:
-            logger.error(f"获取班级表现数据失败: {e}")
-            return self._generate_mock_class_performance(class_id, subject)
+            logger.error("获取班级表现数据失败: %s", e)
+            return self._generate_mock_class_performance(class_id, subject) if use_mock else None
     
     async def get_student_learning_status(self, student_ids: List[str], 
                                         subject: str) -> List[Dict[str, Any]]:
@@ -85,37 +411,120 @@ class StudentDataManager:
             学生学习状态列表
         """
         try:
-            params = {
-                "student_ids": ",".join(student_ids),
-                "subject": subject
-            }
-            
-            # 模拟MCP服务调用
+            # 模拟MCP服务调用（学生较多时分批并发请求）
             if self.mcp_database_url:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                        f"{self.mcp_database_url}/api/student-status",
-                        params=params,
-                        headers=self.headers
-                    ) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            return self._process_student_status(data)
+                chunks = [
+                    student_ids[i:i + _STATUS_CHUNK_SIZE]
+                    for i in range(0, len(student_ids), _STATUS_CHUNK_SIZE)
+                ]
+                results = await asyncio.gather(
+                    *(self._fetch_status_chunk(chunk, subject) for chunk in chunks)
+                )
+                if all(result is not None for result in results):
+                    return list(itertools.chain.from_iterable(results))
             
             # 返回模拟数据
             return self._generate_mock_student_status(student_ids, subject)
             
         except Exception as e:
-            logger.error(f"获取学生学习状态失败: {e}")
+            logger.error("获取学生学习状态失败: %s", e)
             return self._generate_mock_student_status(student_ids, subject)
     
-    async def get_knowledge_gaps(self, class_id: str, subject: str) -> List[Dict[str, Any]]:
+    async def iter_student_learning_status(self, student_ids: List[str], 
+                                           subject: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        逐个产出学生学习状态（边接收边处理，适合学生数量很多的场景）
+        
+        按批依次请求，每批的返回数据在接收过程中就逐条解析和处理，
+        不必等整个响应到达，也不在内存中同时保留完整的响应和处理结果
+        
+        Args:
+            student_ids: 学生ID列表
+            subject: 学科名称
+            
+        Yields:
+            学生学习状态；尚未产出任何数据时请求失败则改为产出模拟数据
+        """
+        yielded = False
+        try:
+            if self.mcp_database_url:
+                for i in range(0, len(student_ids), _STATUS_CHUNK_SIZE):
+                    params = {
+                        "student_ids": ",".join(student_ids[i:i + _STATUS_CHUNK_SIZE]),
+                        "subject": subject
+                    }
+                    async for rows in self._stream_status_rows(params):
+                        for row in rows:
+                            yielded = True
+                            yield row
+                return
+        except Exception as e:
+            if yielded:
+                logger.error("流式获取学生学习状态中断: %s", e)
+                raise
+            logger.error("获取学生学习状态失败: %s", e)
+        
+        for row in self._generate_mock_student_status(student_ids, subject):
+            yield row
+    
+    async def _stream_status_rows(self, params: Dict[str, Any]) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        流式请求学生状态接口，每收到一段数据就产出其中已完整解析的学生（已处理）
+        
+        安装了ijson时增量解析；否则读完整个响应后一次产出。
+        服务返回错误时抛出 httpx.HTTPStatusError
+        """
+        client = await self._get_client()
+        async with client.stream("GET", self._student_status_url, params=params) as response:
+            if response.status_code != 200:
+                raise httpx.HTTPStatusError(
+                    f"学生状态接口返回 {response.status_code}",
+                    request=response.request, response=response
+                )
+            
+            if ijson is None:
+                await response.aread()
+                yield self._process_student_status(_response_json(response))
+                return
+            
+            students = ijson.sendable_list()
+            parser = ijson.items_coro(students, "item", use_float=True)
+            async for chunk in response.aiter_bytes():
+                parser.send(chunk)
+                if students:
+                    yield self._process_student_status(students)
+                    del students[:]
+            parser.close()
+            if students:
+                yield self._process_student_status(students)
+    
+    async def _fetch_status_chunk(self, student_ids: List[str], 
+                                subject: str) -> Optional[List[Dict[str, Any]]]:
+        """查询一批学生的学习状态，服务返回错误时返回None"""
+        params = {
+            "student_ids": ",".join(student_ids),
+            "subject": subject
+        }
+        
+        async def fetch():
+            await self._get_client()  # 确保并发信号量已在当前事件循环中创建
+            async with self._semaphore:
+                try:
+                    return [row async for rows in self._stream_status_rows(params) for row in rows]
+                except httpx.HTTPStatusError:
+                    return None
+        
+        return await self._single_flight(("student-status", tuple(student_ids), subject), fetch)
+    
+    async def get_knowledge_gaps(self, class_id: str, subject: str,
+                                 use_mock: bool = True) -> Optional[List[Dict[str, Any]]]:
         """
         获取班级知识薄弱点分析
         
         Args:
             class_id: 班级ID
             subject: 学科名称
+            use_mock: MCP服务不可用时是否返回模拟数据（为False时返回None）
             
         Returns:
             知识薄弱点列表
@@ -128,22 +537,59 @@ class StudentDataManager:
             
             # 模拟MCP服务调用
             if self.mcp_database_url:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                        f"{self.mcp_database_url}/api/knowledge-gaps",
-                        params=params,
-                        headers=self.headers
-                    ) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            return self._process_knowledge_gaps(data)
+                knowledge_gaps = await self._cached(
+                    ("knowledge-gaps", class_id, subject),
+                    lambda: self._fetch(self._knowledge_gaps_url, params, self._process_knowledge_gaps)
+                )
+                if knowledge_gaps is not None:
+                    return knowledge_gaps
             
             # 返回模拟数据
-            return self._generate_mock_knowledge_gaps(class_id, subject)
+            return self._generate_mock_knowledge_gaps(class_id, subject) if use_mock else None
             
         except Exception as e:
-            logger.error(f"获取知识薄弱点失败: {e}")
-            return self._generate_mock_knowledge_gaps(class_id, subject)
+            logger.error("获取知识薄弱点失败: %s", e)
+            return self._generate_mock_knowledge_gaps(class_id, subject) if use_mock else None
+    
+    async def fetch_all_for_class(self, class_id: str, subject: str,
+                                  student_ids: Optional[List[str]] = None,
+                                  time_range: int = 30) -> Dict[str, Any]:
+        """
+        并发获取班级的全部学情数据（总耗时取决于最慢的一个接口，而不是各接口之和）
+        
+        Args:
+            class_id: 班级ID
+            subject: 学科名称
+            student_ids: 学生ID列表，为空时不查询学生学习状态
+            time_range: 班级表现的时间范围（天数）
+            
+        Returns:
+            包含 class_performance、knowledge_gaps、student_status 的字典，
+            单个接口失败时该项使用模拟数据，不影响其他项
+        """
+        fetches = [
+            self.get_class_performance(class_id, subject, time_range),
+            self.get_knowledge_gaps(class_id, subject)
+        ]
+        if student_ids:
+            fetches.append(self.get_student_learning_status(student_ids, subject))
+        
+        results = await asyncio.gather(*fetches, return_exceptions=True)
+        fallbacks = (
+            lambda: self._generate_mock_class_performance(class_id, subject),
+            lambda: self._generate_mock_knowledge_gaps(class_id, subject),
+            lambda: self._generate_mock_student_status(student_ids, subject)
+        )
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                logger.error("并发获取学情数据失败: %s", result)
+                results[i] = fallbacks[i]()
+        
+        return {
+            "class_performance": results[0],
+            "knowledge_gaps": results[1],
+            "student_status": results[2] if student_ids else []
+        }
     
     def _process_class_performance(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """处理班级表现数据"""
@@ -153,119 +599,60 @@ class StudentDataManager:
             "excellence_rate": data.get("excellence_rate", 0),
             "difficulty_distribution": data.get("difficulty_distribution", {}),
             "common_mistakes": data.get("common_mistakes", []),
-            "improvement_trends": data.get("improvement_trends", [])
+            "improvement_trends": _trends_to_columns(data.get("improvement_trends", []))
         }
     
     def _process_student_status(self, data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """处理学生状态数据"""
-        processed_data = []
-        for student in data:
-            processed_data.append({
+        """
+        处理学生状态数据
+        
+        缺省的列表字段用空元组，不为每行新建空列表；水平、学习风格和动机标签驻留，
+        大量学生的相同标签只保留一份
+        """
+        return [
+            {
                 "student_id": student.get("student_id"),
                 "name": student.get("name", "学生"),
-                "current_level": student.get("current_level", "中等"),
-                "learning_style": student.get("learning_style", "视觉型"),
-                "weak_areas": student.get("weak_areas", []),
-                "strong_areas": student.get("strong_areas", []),
+                "current_level": _intern(student.get("current_level", "中等")),
+                "learning_style": _intern(student.get("learning_style", "视觉型")),
+                "weak_areas": student.get("weak_areas", ()),
+                "strong_areas": student.get("strong_areas", ()),
                 "attention_span": student.get("attention_span", 20),  # 分钟
-                "motivation_level": student.get("motivation_level", "中等")
-            })
-        return processed_data
+                "motivation_level": _intern(student.get("motivation_level", "中等"))
+            }
+            for student in data
+        ]
     
     def _process_knowledge_gaps(self, data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """处理知识薄弱点数据"""
-        processed_gaps = []
-        for gap in data:
-            processed_gaps.append({
+        """处理知识薄弱点数据（缺省的列表字段用空元组，不为每行新建空列表）"""
+        return [
+            {
                 "knowledge_point": gap.get("knowledge_point"),
                 "mastery_rate": gap.get("mastery_rate", 0),
                 "difficulty_level": gap.get("difficulty_level", "中等"),
-                "prerequisite_skills": gap.get("prerequisite_skills", []),
-                "common_errors": gap.get("common_errors", []),
-                "recommended_practice": gap.get("recommended_practice", [])
-            })
-        return processed_gaps
+                "prerequisite_skills": gap.get("prerequisite_skills", ()),
+                "common_errors": gap.get("common_errors", ()),
+                "recommended_practice": gap.get("recommended_practice", ())
+            }
+            for gap in data
+        ]
     
     def _generate_mock_class_performance(self, class_id: str, subject: str) -> Dict[str, Any]:
-        """生成模拟班级表现数据"""
-        return {
-            "class_id": class_id,
-            "subject": subject,
-            "average_score": 76.5,
-            "pass_rate": 0.85,
-            "excellence_rate": 0.32,
-            "difficulty_distribution": {
-                "基础题": 0.78,
-                "中等题": 0.65,
-                "难题": 0.42
-            },
-            "common_mistakes": [
-                "计算错误较多",
-                "理解题意不准确",
-                "解题步骤不完整"
-            ],
-            "improvement_trends": [
-                {"week": 1, "score": 72.0},
-                {"week": 2, "score": 74.5},
-                {"week": 3, "score": 76.5}
-            ]
-        }
+        """生成模拟班级表现数据（逐层复制嵌套字典，调用方修改不会影响lru_cache中的模板）"""
+        performance = dict(_mock_class_performance(class_id, subject))
+        performance["difficulty_distribution"] = dict(performance["difficulty_distribution"])
+        performance["improvement_trends"] = dict(performance["improvement_trends"])
+        return performance
     
     def _generate_mock_student_status(self, student_ids: List[str], 
                                     subject: str) -> List[Dict[str, Any]]:
-        """生成模拟学生状态数据"""
-        mock_data = []
-        learning_styles = ["视觉型", "听觉型", "动手型", "阅读型"]
-        levels = ["优秀", "良好", "中等", "待提高"]
-        motivations = ["高", "中等", "较低"]
-        
-        for i, student_id in enumerate(student_ids):
-            mock_data.append({
-                "student_id": student_id,
-                "name": f"学生{i+1}",
-                "current_level": levels[i % len(levels)],
-                "learning_style": learning_styles[i % len(learning_styles)],
-                "weak_areas": ["几何证明", "应用题"] if subject == "数学" else ["阅读理解", "作文"],
-                "strong_areas": ["计算", "代数"] if subject == "数学" else ["基础知识", "文言文"],
-                "attention_span": 15 + (i % 3) * 10,
-                "motivation_level": motivations[i % len(motivations)]
-            })
-        
-        return mock_data
+        """生成模拟学生状态数据（每行为独立副本，列表类字段为不可变元组）"""
+        return [dict(row) for row in _mock_student_status(tuple(student_ids), subject)]
     
     def _generate_mock_knowledge_gaps(self, class_id: str, 
                                     subject: str) -> List[Dict[str, Any]]:
-        """生成模拟知识薄弱点数据"""
-        if subject == "数学":
-            return [
-                {
-                    "knowledge_point": "二次函数",
-                    "mastery_rate": 0.45,
-                    "difficulty_level": "较难",
-                    "prerequisite_skills": ["一次函数", "代数运算"],
-                    "common_errors": ["顶点坐标计算错误", "图像性质理解不清"],
-                    "recommended_practice": ["多做图像题", "加强基础运算"]
-                },
-                {
-                    "knowledge_point": "几何证明",
-                    "mastery_rate": 0.38,
-                    "difficulty_level": "难",
-                    "prerequisite_skills": ["几何基本概念", "逻辑推理"],
-                    "common_errors": ["证明步骤不严谨", "定理应用错误"],
-                    "recommended_practice": ["模仿例题", "逐步分析"]
-                }
-            ]
-        else:
-            return [
-                {
-                    "knowledge_point": "阅读理解",
-                    "mastery_rate": 0.52,
-                    "difficulty_level": "中等",
-                    "prerequisite_skills": ["词汇量", "语法基础"],
-                    "common_errors": ["理解偏差", "答题不完整"],
-                    "recommended_practice": ["多读多练", "归纳总结"]
-                }
-            ]
+        """生成模拟知识薄弱点数据（每行为独立副本，列表类字段为不可变元组）"""
+        return [dict(gap) for gap in _mock_knowledge_gaps(subject)]
     
     def analyze_class_needs(self, class_performance: Dict[str, Any], 
                           knowledge_gaps: List[Dict[str, Any]]) -> Dict[str, Any]:
@@ -287,14 +674,29 @@ class StudentDataManager:
             "special_attention": []
         }
         
-        # 分析优先教学主题
-        for gap in knowledge_gaps:
-            if gap["mastery_rate"] < 0.5:
-                analysis["priority_topics"].append({
-                    "topic": gap["knowledge_point"],
-                    "urgency": "高" if gap["mastery_rate"] < 0.4 else "中",
-                    "mastery_rate": gap["mastery_rate"]
-                })
+        # 分析优先教学主题（薄弱点较多时一次比较全部掌握率，只逐条处理需要优先教学的条目）
+        if len(knowledge_gaps) >= _VECTORIZE_MIN_GAPS:
+            rates = np.fromiter(
+                (gap["mastery_rate"] for gap in knowledge_gaps),
+                dtype=np.float64, count=len(knowledge_gaps)
+            )
+            levels = _mastery_levels(rates)
+            indices = np.flatnonzero(levels)
+            priority_gaps = zip(indices.tolist(), (levels[indices] == 2).tolist())
+        else:
+            priority_gaps = [
+                (i, gap["mastery_rate"] < _URGENT_MASTERY)
+                for i, gap in enumerate(knowledge_gaps)
+                if gap["mastery_rate"] < _PRIORITY_MASTERY
+            ]
+        
+        for i, urgent in priority_gaps:
+            gap = knowledge_gaps[i]
+            analysis["priority_topics"].append({
+                "topic": gap["knowledge_point"],
+                "urgency": "高" if urgent else "中",
+                "mastery_rate": gap["mastery_rate"]
+            })
         
         # 推荐教学策略
         avg_score = class_performance.get("average_score", 0)
@@ -32,6 +32,12 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+@st.cache_resource
+def warmup_lesson_generator() -> bool:
+    """进程启动后只执行一次的预热（Streamlit每次交互都会重跑脚本，结果由cache_resource缓存）"""
+    lesson_generator.warmup()
+    return True
+
 class RAGEducationApp:
     """教育RAG系统Web应用类"""
     
@@ -455,20 +461,15 @@ class RAGEducationApp:
         if st.button("📊 开始分析"):
             with st.spinner("正在分析学情数据..."):
                 try:
-                    # 获取班级表现
-                    class_performance = asyncio.run(
-                        student_data_manager.get_class_performance(class_id, subject, time_range)
-                    )
-                    
-                    # 获取知识薄弱点
-                    knowledge_gaps = asyncio.run(
-                        student_data_manager.get_knowledge_gaps(class_id, subject)
+                    # 并发获取班级表现和知识薄弱点
+                    class_data = asyncio.run(
+                        student_data_manager.fetch_all_for_class(class_id, subject, time_range=time_range)
                     )
                     
                     # 显示结果
                     self.render_student_analysis({
-                        'class_performance': class_performance,
-                        'knowledge_gaps': knowledge_gaps
+                        'class_performance': class_data['class_performance'],
+                        'knowledge_gaps': class_data['knowledge_gaps']
                     })
                     
                 except Exception as e:
@@ -553,6 +554,7 @@ class RAGEducationApp:
 def main():
     """主函数"""
     try:
+        warmup_lesson_generator()
         app = RAGEducationApp()
         app.run()
     except Exception as e:
@@ -0,0 +1,57 @@
+"""
+生成结果缓存模块测试
+"""
+import pytest
+import sys
+from pathlib import Path
+
+# 添加src目录到路径
+sys.path.append(str(Path(__file__).parent.parent / "src"))
+
+from completion_cache import CompletionCache
+
+
+class TestCompletionCache:
+    """测试生成结果缓存"""
+    
+    def test_round_trip(self, tmp_path):
+        """测试写入后可读取"""
+        cache = CompletionCache(tmp_path / "completions.sqlite3")
+        
+        cache.put("gpt", "提示词", "教案内容")
+        
+        assert cache.get("gpt", "提示词") == "教案内容"
+    
+    def test_key_includes_model(self, tmp_path):
+        """测试不同模型的结果互不命中"""
+        cache = CompletionCache(tmp_path / "completions.sqlite3")
+        
+        cache.put("gpt-a", "提示词", "教案内容")
+        
+        assert cache.get("gpt-b", "提示词") is None
+    
+    def test_persists_across_instances(self, tmp_path):
+        """测试缓存持久化到磁盘"""
+        db_path = tmp_path / "completions.sqlite3"
+        CompletionCache(db_path).put("gpt", "提示词", "教案内容")
+        
+        assert CompletionCache(db_path).get("gpt", "提示词") == "教案内容"
+    
+    def test_evicts_least_recently_used(self, tmp_path):
+        """测试超出容量时淘汰最久未使用的条目"""
+        cache = CompletionCache(tmp_path / "completions.sqlite3", max_entries=2)
+        
+        cache.put("gpt", "first", "1")
+        cache.put("gpt", "second", "2")
+        cache.get("gpt", "first")
+        cache.put("gpt", "third", "3")
+        
+        assert len(cache) == 2
+        assert cache.get("gpt", "first") == "1"
+        assert cache.get("gpt", "second") is None
+        assert cache.get("gpt", "third") == "3"
+
+
+if __name__ == "__main__":
+    # 运行测试
+    pytest.main([__file__, "-v"])
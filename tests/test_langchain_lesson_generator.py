@@ -0,0 +1,69 @@
+"""
+LangChain教案生成模块测试
+"""
+import pytest
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# 添加项目根目录到路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+from src.langchain_lesson_generator import EnhancedLessonPlanRequest, LangChainLessonGenerator
+from src.semantic_cache import SemanticCache
+
+
+class TestLessonCacheScope:
+    """测试增强教案语义缓存的复用范围"""
+    
+    def _request(self, **kwargs):
+        fields = dict(
+            user_id="teacher_001",
+            class_id="CLASS_001",
+            subject="数学",
+            grade="三年级",
+            topic="分数的加法",
+            duration=45,
+            learning_objectives=["理解同分母分数加法"],
+            special_requirements=""
+        )
+        fields.update(kwargs)
+        return EnhancedLessonPlanRequest(**fields)
+    
+    def _scope(self, request):
+        return LangChainLessonGenerator._lesson_cache_scope(request)
+    
+    def test_identical_request_hits(self):
+        """测试相同请求命中语义缓存"""
+        cache = SemanticCache(threshold=0.95)
+        embedding = np.array([1.0, 0.0, 0.0])
+        
+        cache.insert(embedding, {"title": "旧教案"}, scope=self._scope(self._request()))
+        
+        assert cache.lookup(embedding, scope=self._scope(self._request())) == {"title": "旧教案"}
+    
+    @pytest.mark.parametrize("changes", [
+        {"topic": "分数的减法"},
+        {"duration": 40},
+        {"subject": "语文"},
+        {"grade": "四年级"},
+        {"learning_objectives": ["理解同分母分数加法", "会用图形表示分数"]},
+        {"special_requirements": "增加小组讨论"},
+        {"difficulty_level": "较难"},
+        {"teaching_style": "探究式"},
+    ])
+    def test_edited_request_misses(self, changes):
+        """测试只改动课题、课时等单个字段时，即使请求向量几乎相同也不复用旧教案"""
+        cache = SemanticCache(threshold=0.95)
+        embedding = np.array([1.0, 0.0, 0.0])
+        
+        cache.insert(embedding, {"title": "旧教案"}, scope=self._scope(self._request()))
+        
+        edited = self._scope(self._request(**changes))
+        assert cache.lookup(np.array([1.0, 0.01, 0.0]), scope=edited) is None
+
+
+if __name__ == "__main__":
+    # 运行测试
+    pytest.main([__file__, "-v"])
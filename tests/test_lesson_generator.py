@@ -0,0 +1,60 @@
+"""
+教案生成模块测试
+"""
+import pytest
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# 添加项目根目录到路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+from src.lesson_generator import LessonPlanRequest, _semantic_scope
+from src.semantic_cache import SemanticCache
+
+
+class TestSemanticScope:
+    """测试教案语义缓存的复用范围"""
+    
+    def _request(self, **kwargs):
+        fields = dict(
+            class_id="CLASS_001",
+            subject="数学",
+            grade="初二",
+            topic="二次函数",
+            duration=45,
+            learning_objectives=["理解顶点式"],
+            special_requirements=""
+        )
+        fields.update(kwargs)
+        return LessonPlanRequest(**fields)
+    
+    def test_identical_request_hits(self):
+        """测试相同请求命中语义缓存"""
+        cache = SemanticCache(threshold=0.95)
+        embedding = np.array([1.0, 0.0, 0.0])
+        
+        cache.insert(embedding, "旧教案", scope=_semantic_scope(self._request()))
+        
+        assert cache.lookup(embedding, scope=_semantic_scope(self._request())) == "旧教案"
+    
+    @pytest.mark.parametrize("changes", [
+        {"special_requirements": "增加小组讨论"},
+        {"duration": 90},
+        {"learning_objectives": ["理解顶点式", "会画图像"]},
+    ])
+    def test_edited_request_misses(self, changes):
+        """测试修改课时、教学目标或特殊要求后，即使提示词向量几乎相同也不复用旧教案"""
+        cache = SemanticCache(threshold=0.95)
+        embedding = np.array([1.0, 0.0, 0.0])
+        
+        cache.insert(embedding, "旧教案", scope=_semantic_scope(self._request()))
+        
+        edited = _semantic_scope(self._request(**changes))
+        assert cache.lookup(np.array([1.0, 0.01, 0.0]), scope=edited) is None
+
+
+if __name__ == "__main__":
+    # 运行测试
+    pytest.main([__file__, "-v"])
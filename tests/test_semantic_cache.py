@@ -0,0 +1,85 @@
+"""
+语义缓存模块测试
+"""
+import pytest
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# 添加src目录到路径
+sys.path.append(str(Path(__file__).parent.parent / "src"))
+
+from semantic_cache import SemanticCache
+
+
+class TestSemanticCache:
+    """测试语义缓存"""
+    
+    def test_hit_on_similar_embedding(self):
+        """测试相似向量命中缓存"""
+        cache = SemanticCache(threshold=0.9)
+        embedding = np.array([1.0, 0.0, 0.0])
+        
+        cache.insert(embedding, ["结果"])
+        
+        assert cache.lookup(np.array([1.0, 0.05, 0.0])) == ["结果"]
+    
+    def test_miss_on_dissimilar_embedding(self):
+        """测试不相似向量未命中"""
+        cache = SemanticCache(threshold=0.9)
+        cache.insert(np.array([1.0, 0.0, 0.0]), ["结果"])
+        
+        assert cache.lookup(np.array([0.0, 1.0, 0.0])) is None
+    
+    def test_scope_must_match(self):
+        """测试scope不同的条目互不命中"""
+        cache = SemanticCache()
+        embedding = np.array([1.0, 2.0, 3.0])
+        
+        cache.insert(embedding, "top5", scope=5)
+        cache.insert(embedding, "top3", scope=3)
+        
+        assert cache.lookup(embedding, scope=5) == "top5"
+        assert cache.lookup(embedding, scope=3) == "top3"
+        assert cache.lookup(embedding, scope=10) is None
+    
+    def test_expired_entries_are_ignored(self):
+        """测试过期条目不再命中"""
+        cache = SemanticCache(ttl_seconds=-1)
+        embedding = np.array([1.0, 0.0])
+        
+        cache.insert(embedding, "结果")
+        
+        assert cache.lookup(embedding) is None
+    
+    def test_evicts_least_recently_used(self):
+        """测试容量满时淘汰最久未使用的条目"""
+        cache = SemanticCache(max_size=2)
+        first, second, third = np.eye(3)
+        
+        cache.insert(first, "first")
+        cache.insert(second, "second")
+        cache.lookup(first)
+        cache.insert(third, "third")
+        
+        assert len(cache) == 2
+        assert cache.lookup(first) == "first"
+        assert cache.lookup(second) is None
+        assert cache.lookup(third) == "third"
+    
+    def test_clear(self):
+        """测试清空缓存"""
+        cache = SemanticCache()
+        embedding = np.array([1.0, 0.0])
+        cache.insert(embedding, "结果")
+        
+        cache.clear()
+        
+        assert len(cache) == 0
+        assert cache.lookup(embedding) is None
+
+
+if __name__ == "__main__":
+    # 运行测试
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,69 @@
+"""
+学生数据模块测试
+"""
+import pytest
+import sys
+from pathlib import Path
+
+# 添加项目根目录到路径
+sys.path.append(str(Path(__file__).parent.parent))
+
+from src import student_data
+
+
+# 含恰好等于0.4、0.5及其两侧最接近浮点数的掌握率，顺序打乱以检查输出顺序
+_MASTERY_RATES = [
+    0.5, 0.4, 0.49999999999999994, 0.39999999999999997, 0.5000000000000001,
+    0.4000000000000001, 0.0, 1.0, 0.45, 0.38, 0.52, 0.1, 0.9, 0.41, 0.5, 0.4,
+    0.25, 0.75
+]
+
+
+def _knowledge_gaps():
+    return [
+        {"knowledge_point": f"知识点{i}", "mastery_rate": rate}
+        for i, rate in enumerate(_MASTERY_RATES)
+    ]
+
+
+class TestAnalyzeClassNeeds:
+    """测试班级教学需求分析"""
+    
+    @pytest.mark.parametrize("njit", [student_data.njit, None], ids=["numba", "numpy"])
+    def test_vectorized_matches_scalar(self, monkeypatch, njit):
+        """测试薄弱点较多时的向量化路径与逐条比较的结果完全一致"""
+        manager = student_data.StudentDataManager()
+        performance = {"average_score": 76.5}
+        gaps = _knowledge_gaps()
+        assert len(gaps) >= student_data._VECTORIZE_MIN_GAPS
+        
+        monkeypatch.setattr(student_data, "njit", njit)
+        vectorized = manager.analyze_class_needs(performance, gaps)
+        
+        monkeypatch.setattr(student_data, "_VECTORIZE_MIN_GAPS", len(gaps) + 1)
+        scalar = manager.analyze_class_needs(performance, gaps)
+        
+        assert vectorized["priority_topics"] == scalar["priority_topics"]
+        assert vectorized == scalar
+    
+    def test_threshold_boundaries(self):
+        """测试掌握率恰好为0.4、0.5时的优先级和紧急度"""
+        manager = student_data.StudentDataManager()
+        gaps = _knowledge_gaps()
+        
+        topics = manager.analyze_class_needs({"average_score": 76.5}, gaps)["priority_topics"]
+        
+        expected = [
+            (gap["knowledge_point"], "高" if gap["mastery_rate"] < 0.4 else "中")
+            for gap in gaps if gap["mastery_rate"] < 0.5
+        ]
+        assert [(topic["topic"], topic["urgency"]) for topic in topics] == expected
+        urgency = {topic["mastery_rate"]: topic["urgency"] for topic in topics}
+        assert 0.5 not in urgency
+        assert urgency[0.4] == "中"
+        assert urgency[0.39999999999999997] == "高"
+        assert urgency[0.49999999999999994] == "中"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])